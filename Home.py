@@ -3,11 +3,10 @@
 import streamlit as st
 import os
 import sys
-from collections import Counter
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '.')))
 
-from app.database import crud
+from app.database import crud, init_db
 # Import the new function
 # from app.translator import initialize_state, t, language_selector, display_model_status
 
@@ -20,6 +19,9 @@ from app.database import crud
 # from app.warning_monitor import initialize_warning_monitor
 # warning_monitor = initialize_warning_monitor()
 
+# --- Initialize Database ---
+init_db()
+
 # --- Page Config ---
 st.set_page_config(
     page_title="AI Garment Generator",
@@ -52,8 +54,7 @@ def set_filter_and_switch(status_filter):
     st.rerun()
 
 try:
-    all_tasks = crud.get_all_tasks()
-    status_counts = Counter(task['status'] for task in all_tasks)
+    status_counts = crud.get_status_counts()
     
     prompt_stage_statuses = {"PENDING_APPROVAL": "orange"}
     photo_stage_statuses = {
@@ -43,6 +43,104 @@ DEFAULT_NAME_TAG_PROMPT = "data/prompts/name_tag/name_and_tags_sop.txt"
 # --- File Paths ---
 UPLOADS_DIR = "uploads"
 OUTPUTS_DIR = "outputs"
+# Downscaled copies of images prepared for vision calls, keyed by source hash.
+PROCESSED_IMAGES_DIR = "data/processed_images"
 
 # --- Database Configuration ---
-DATABASE_PATH = "app.db"
+# The application database lives at app.database.models.DATABASE_NAME.
+
+# --- Chat History Budget ---
+# Approximate prompt tokens call_ai_service may spend replaying earlier turns of a task.
+CHAT_HISTORY_TOKEN_BUDGET = 3000
+# Hard cap on the number of earlier turns read for a single call.
+CHAT_HISTORY_MAX_TURNS = 20
+
+
+# --- Bulk Generation ---
+# Number of AI requests bulk spec sheet generation keeps in flight at once.
+BULK_GENERATION_WORKERS = 8
+
+# --- AI Response Cache ---
+# SQLite database holding cached AI responses, separate from the application database.
+AI_CACHE_PATH = "data/ai_cache.db"
+# Cached responses older than this are discarded.
+AI_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+# Least recently used responses are evicted once the cache holds more than this.
+AI_CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+# --- Vision Image Preprocessing ---
+# Images are scaled to fit both limits before being sent to a vision model
+# (the high-detail tier: 2048 px on the long side, 768 px on the short side).
+VISION_MAX_LONG_SIDE = 2048
+VISION_MAX_SHORT_SIDE = 768
+# JPEG/WebP quality used when re-encoding.
+VISION_IMAGE_QUALITY = 85
+
+# --- OpenAI Rate Limiting ---
+# Starting budgets per model; they follow the x-ratelimit-* headers once responses arrive.
+RATE_LIMIT_DEFAULT_RPM = 500
+RATE_LIMIT_DEFAULT_TPM = 30000
+# Retries for 429, 5xx and connection errors, with jittered exponential backoff.
+RATE_LIMIT_MAX_RETRIES = 5
+RATE_LIMIT_BACKOFF_BASE_SECONDS = 1.0
+RATE_LIMIT_BACKOFF_MAX_SECONDS = 60.0
+# Consecutive failures that open a model's circuit, and how long it stays open.
+RATE_LIMIT_CIRCUIT_THRESHOLD = 5
+RATE_LIMIT_CIRCUIT_COOLDOWN_SECONDS = 30
+# Completion tokens charged against the token budget before the real usage is known.
+RATE_LIMIT_EXPECTED_COMPLETION_TOKENS = 800
+
+# --- HTTP Client ---
+# Connection pool shared by every OpenAI call in a process (see app.core.openai_client).
+HTTP_MAX_CONNECTIONS = 32
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 16
+HTTP_KEEPALIVE_EXPIRY_SECONDS = 30.0
+# Timeouts in seconds; reads are long because completions can take a while to arrive.
+HTTP_CONNECT_TIMEOUT_SECONDS = 10.0
+HTTP_READ_TIMEOUT_SECONDS = 120.0
+HTTP_WRITE_TIMEOUT_SECONDS = 30.0
+HTTP_POOL_TIMEOUT_SECONDS = 30.0
+
+# --- Background Jobs ---
+# Seconds a worker owns a claimed job before another worker may take it over;
+# workers extend the lease while the job is still running.
+JOB_LEASE_SECONDS = 120
+# Attempts before a job is moved to the dead-letter state.
+JOB_MAX_ATTEMPTS = 5
+# Delay before retrying a failed job, doubled on each further attempt.
+JOB_RETRY_BASE_SECONDS = 10
+JOB_RETRY_MAX_SECONDS = 600
+# How often an idle worker checks for new jobs, and how many processes `python -m app.worker` starts.
+# Each process runs every pipeline stage with its own pool of worker threads.
+WORKER_POLL_SECONDS = 2.0
+WORKER_PROCESSES = 1
+# Jobs at or above this priority go in the urgent lane: they are claimed before
+# everything else, and each stage keeps one worker thread for them alone.
+SCHEDULER_URGENT_PRIORITY = 100
+# Window over which the dashboard reports queue wait and per-batch throughput.
+SCHEDULER_METRICS_WINDOW_SECONDS = 60 * 60
+# A worker process that has not checked in for this long is no longer counted
+# as running (job_queue.count_active_workers).
+WORKER_HEARTBEAT_STALE_SECONDS = 30
+# How often each worker looks for tasks stuck in GENERATING with an expired lease or no job.
+GENERATION_SWEEP_INTERVAL_SECONDS = 30
+
+# --- Pipeline ---
+# How often each worker process feeds ready tasks into the pipeline stages (app.core.pipeline).
+PIPELINE_PUMP_INTERVAL_SECONDS = 5
+# Per stage: worker threads per process, requests started per minute per process,
+# attempts before dead-lettering, and the retry backoff (doubled on each attempt).
+PIPELINE_STAGE_SETTINGS = {
+    'spec_sheet': {'workers': 8, 'requests_per_minute': 60, 'max_attempts': 3, 'retry_base_seconds': 5, 'retry_max_seconds': 120},
+    'name_tags': {'workers': 4, 'requests_per_minute': 120, 'max_attempts': 3, 'retry_base_seconds': 5, 'retry_max_seconds': 120},
+    'image': {'workers': 2, 'requests_per_minute': 5, 'max_attempts': JOB_MAX_ATTEMPTS,
+              'retry_base_seconds': JOB_RETRY_BASE_SECONDS, 'retry_max_seconds': JOB_RETRY_MAX_SECONDS},
+}
+
+# --- Live Progress ---
+# How often the dashboard's progress panel polls task_events.
+PROGRESS_REFRESH_SECONDS = 3
+# Completions over this window set the per-batch rate used for the ETA.
+PROGRESS_ETA_WINDOW_SECONDS = 10 * 60
+# Workers delete task events older than this.
+TASK_EVENTS_RETENTION_SECONDS = 7 * 24 * 60 * 60
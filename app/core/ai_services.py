@@ -1,35 +1,20 @@
 # File: app/core/ai_services.py
 
 import openai
-from openai import OpenAI
 import os
-from dotenv import load_dotenv
 import base64
-from app.config import logger, DATABASE_PATH
+import json
+import mimetypes
+import sqlite3
+import time
+from app.config import logger, OUTPUTS_DIR, CHAT_HISTORY_TOKEN_BUDGET, CHAT_HISTORY_MAX_TURNS, RATE_LIMIT_EXPECTED_COMPLETION_TOKENS
 from app.constants import DEFAULT_MODELS, MODEL_CAPABILITIES, OPENAI_MODELS
+from app.database import crud
+from app import image_store
+from app.core import image_processing, rate_limiter, response_cache
 
-# Load environment variables from .env file
-load_dotenv()
-
-# Monkey patch httpx to handle the proxies argument issue
-import httpx
-original_init = httpx.Client.__init__
-
-def patched_init(self, *args, **kwargs):
-    # Remove proxies from kwargs if it exists
-    kwargs.pop('proxies', None)
-    return original_init(self, *args, **kwargs)
-
-httpx.Client.__init__ = patched_init
-
-def get_openai_client():
-    """Get or create OpenAI client with proper configuration."""
-    api_key = os.getenv('OPENAI_API_KEY')
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY environment variable is not set")
-    
-    # Create client - httpx proxy issue is handled by monkey patch above
-    return OpenAI(api_key=api_key)
+# The shared, pooled OpenAI client used by every AI call in the process
+from app.core.openai_client import get_openai_client
 
 def get_models_by_capability(capability):
     """
@@ -51,67 +36,117 @@ def get_available_openai_models():
         Dict with categorized models or None if error
     """
     try:
-        client = get_openai_client()
-        models = client.models.list()
+        models = get_openai_client().models.list()
         return [model.id for model in models.data]
     except Exception as e:
         logger.error(f"Failed to fetch OpenAI models: {e}")
         return []
 
-# Global client reference
-client = None
+def encode_image(image_path, sha256=None):
+    """
+    Encode an image as a base64 data URL, downscaled and re-encoded for vision models.
 
-def encode_image(image_path):
+    Falls back to the original bytes, with a MIME type guessed from the file name,
+    if the image cannot be decoded.
     """
-    Encode an image to a Base64 string.
+    try:
+        mime_type, data = image_processing.prepare_image(image_path, sha256=sha256)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Sending {image_path} unprocessed: {e}")
+        mime_type = mimetypes.guess_type(image_path)[0] or "image/jpeg"
+        with open(image_path, "rb") as image_file:
+            data = image_file.read()
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+def estimate_tokens(text):
+    """Rough token count for budgeting (about four characters per token)."""
+    return (len(text) + 3) // 4
+
+# 4 tiles x 170 tokens + 85 base tokens for a 2048/768-tier image.
+VISION_IMAGE_TOKENS = 765
+
+def estimate_request_tokens(messages):
+    """Estimate the tokens a chat request will use, including an allowance for the completion."""
+    total = RATE_LIMIT_EXPECTED_COMPLETION_TOKENS
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+            continue
+        for part in content:
+            total += estimate_tokens(part["text"]) if part["type"] == "text" else VISION_IMAGE_TOKENS
+    return total
+
+def load_history_messages(task_id, token_budget=CHAT_HISTORY_TOKEN_BUDGET, max_turns=CHAT_HISTORY_MAX_TURNS):
     """
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    Build chat messages from a task's most recent turns that fit within `token_budget`.
 
-def call_ai_service(user_message, task_id=None, model=DEFAULT_MODELS['vision'], image_path=None, test_mode=False):
+    Turns are read newest first and the oldest ones are dropped once the budget or
+    `max_turns` is reached; a short system note records how many were left out.
     """
-    Call the AI service with a user message, optional task ID for context, model selection, optional image input, and test mode.
-    If test_mode is True, return a mock response for testing purposes.
+    recent_turns = crud.get_chat_history(task_id, limit=max_turns)
+    kept = []
+    used_tokens = 0
+    for user_msg, ai_resp in reversed(recent_turns):
+        turn_tokens = estimate_tokens(user_msg) + estimate_tokens(ai_resp)
+        if used_tokens + turn_tokens > token_budget:
+            break
+        kept.append((user_msg, ai_resp))
+        used_tokens += turn_tokens
+
+    messages = []
+    omitted = 0
+    if len(kept) < len(recent_turns) or len(recent_turns) == max_turns:
+        omitted = crud.count_chat_turns(task_id) - len(kept)
+    if omitted > 0:
+        messages.append({
+            "role": "system",
+            "content": f"{omitted} earlier turns of this conversation were omitted to keep the prompt short.",
+        })
+    for user_msg, ai_resp in reversed(kept):
+        messages.append({"role": "user", "content": user_msg})
+        messages.append({"role": "assistant", "content": ai_resp})
+    logger.debug(f"Loaded {len(kept)} history turns (~{used_tokens} tokens, {omitted} omitted) for task {task_id}")
+    return messages
+
+def _test_mode_response(user_message, model, image_path):
+    response = f"[TEST MODE] AI response for prompt: '{user_message}' using model: {model}"
+    if image_path:
+        response = f"[TEST MODE] Spec sheet generated for image '{image_path}' with prompt: '{user_message}' using model: {model}"
+    logger.info(f"Test mode response: {response}")
+    return response
+
+def _prepare_request(user_message, task_id, model, image_path, response_format=None):
     """
-    import sqlite3
-    
-    logger.info(f"AI service called with model: {model}, task_id: {task_id}, test_mode: {test_mode}, has_image: {image_path is not None}")
-    
-    if test_mode:
-        # Return a mock response for testing
-        response = f"[TEST MODE] AI response for prompt: '{user_message}' using model: {model}"
-        if image_path:
-            response = f"[TEST MODE] Spec sheet generated for image '{image_path}' with prompt: '{user_message}' using model: {model}"
-        logger.info(f"Test mode response: {response}")
-        return response
-
-    # Prepare the conversation history if task_id is provided
-    conversation_history = []
+    Load the task's recent history and compute the response cache key for a request.
+
+    Returns:
+        (messages, image_sha256, cache_key); messages do not yet include the new user message.
+    """
+    messages = []
     if task_id:
         try:
-            conn = sqlite3.connect(DATABASE_PATH)
-            cursor = conn.cursor()
-            cursor.execute("SELECT user_message, ai_response FROM chat_history WHERE task_id = ?", (task_id,))
-            conversation_history = cursor.fetchall()
-            conn.close()
-            logger.debug(f"Retrieved {len(conversation_history)} conversation history items for task {task_id}")
+            messages = load_history_messages(task_id)
         except sqlite3.Error as e:
             logger.error(f"Database error retrieving conversation history: {e}")
             raise RuntimeError(f"Failed to retrieve conversation history: {e}")
+    try:
+        image_sha256 = image_store.hash_file(image_path) if image_path else None
+    except OSError as e:
+        logger.error(f"Failed to read image {image_path}: {e}")
+        raise RuntimeError(f"Failed to process image: {e}")
+    cache_key = response_cache.make_key(
+        model, messages + [{"role": "user", "content": user_message}], image_sha256, response_format
+    )
+    return messages, image_sha256, cache_key
 
-    # Format the conversation for the AI
-    messages = []
-    for user_msg, ai_resp in conversation_history:
-        messages.append({"role": "user", "content": user_msg})
-        messages.append({"role": "assistant", "content": ai_resp})
-
-    # Add the new user message
+def _append_user_message(messages, user_message, task_id, image_path, image_sha256):
     if image_path:
         try:
-            base64_image = encode_image(image_path)
+            image_url = encode_image(image_path, sha256=image_sha256)
             user_content = [
                 {"type": "text", "text": user_message},
-                {"type": "image_url", "image_url": f"data:image/jpeg;base64,{base64_image}"},
+                {"type": "image_url", "image_url": {"url": image_url}},
             ]
             logger.debug(f"Encoded image for task {task_id}")
         except Exception as e:
@@ -119,28 +154,296 @@ def call_ai_service(user_message, task_id=None, model=DEFAULT_MODELS['vision'],
             raise RuntimeError(f"Failed to process image: {e}")
     else:
         user_content = user_message
-
     messages.append({"role": "user", "content": user_content})
 
+def call_ai_service(user_message, task_id=None, model=DEFAULT_MODELS['vision'], image_path=None, test_mode=False, bypass_cache=False, response_format=None):
+    """
+    Call the AI service with a user message, optional task ID for context, model selection, optional image input, and test mode.
+    If test_mode is True, return a mock response for testing purposes.
+    Identical requests are answered from the response cache unless bypass_cache is True;
+    a bypassed call still stores its fresh response.
+    response_format is passed to the API as-is, e.g. to request JSON schema output.
+    """
+    logger.info(f"AI service called with model: {model}, task_id: {task_id}, test_mode: {test_mode}, has_image: {image_path is not None}")
+    
+    if test_mode:
+        return _test_mode_response(user_message, model, image_path)
+
+    # Prepare the most recent conversation history and answer identical requests from the cache
+    messages, image_sha256, cache_key = _prepare_request(user_message, task_id, model, image_path, response_format)
+    if not bypass_cache:
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            logger.info(f"AI response cache hit for task {task_id} with model {model}")
+            return cached_response
+
+    # Add the new user message
+    _append_user_message(messages, user_message, task_id, image_path, image_sha256)
+
     # Call OpenAI API using the specified model
     try:
         logger.info(f"Making OpenAI API call with model {model}")
-        # Get client if not already initialized
-        global client
-        if client is None:
-            client = get_openai_client()
-        
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages
-        )
+        openai_client = get_openai_client()
+
+        def send():
+            request = {"model": model, "messages": messages}
+            if response_format is not None:
+                request["response_format"] = response_format
+            raw_response = openai_client.chat.completions.with_raw_response.create(**request)
+            completion = raw_response.parse()
+            used_tokens = completion.usage.total_tokens if completion.usage else None
+            return completion, raw_response.headers, used_tokens
+
+        response = rate_limiter.call_with_limits(model, estimate_request_tokens(messages), send)
         ai_response = response.choices[0].message.content
         logger.info(f"OpenAI API call successful, response length: {len(ai_response)}")
+        if ai_response:
+            response_cache.put(cache_key, model, ai_response)
         return ai_response
+    except rate_limiter.CircuitOpenError as e:
+        logger.error(str(e))
+        raise
     except openai.APIError as e:
         logger.error(f"OpenAI API error: {e}")
         raise RuntimeError(f"Failed to call OpenAI API: {e}")
     except Exception as e:
         logger.error(f"Unexpected error in AI service: {e}")
         raise RuntimeError(f"Unexpected error: {e}")
-    
+
+# --- Structured Product Listing ---
+# JSON schema for the combined spec sheet, product name and tags call.
+PRODUCT_LISTING_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "spec_sheet": {"type": "string", "description": "The complete product spec sheet."},
+        "product_name": {"type": "string", "description": "A short, marketable name for the garment."},
+        "tags": {
+            "type": "object",
+            "properties": {
+                "type": {"type": "string"},
+                "color": {"type": "string"},
+                "gender": {"type": "string"},
+            },
+            "required": ["type", "color", "gender"],
+            "additionalProperties": False,
+        },
+    },
+    "required": ["spec_sheet", "product_name", "tags"],
+    "additionalProperties": False,
+}
+PRODUCT_LISTING_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "product_listing", "strict": True, "schema": PRODUCT_LISTING_SCHEMA},
+}
+
+def build_product_listing_prompt(spec_sheet_prompt, name_tag_prompt):
+    """Combine the spec sheet and name/tag instructions into one structured-output request."""
+    return (
+        f"{spec_sheet_prompt.strip()}\n\n"
+        f"In the same answer, also produce the product name and tags:\n{name_tag_prompt.strip()}\n\n"
+        "Return a single JSON object with the keys \"spec_sheet\" (the full spec sheet as text), "
+        "\"product_name\" and \"tags\"."
+    )
+
+def parse_product_listing(text):
+    """
+    Parse and validate a structured product listing response.
+
+    Returns:
+        Dict with 'spec_sheet', 'product_name' and 'tags' (a dict of strings).
+
+    Raises:
+        ValueError if the response is not valid JSON or does not match PRODUCT_LISTING_SCHEMA.
+    """
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Response is not valid JSON: {e}")
+    if not isinstance(data, dict):
+        raise ValueError("Response is not a JSON object")
+    if not isinstance(data.get("spec_sheet"), str) or not data["spec_sheet"].strip():
+        raise ValueError("Response is missing a non-empty 'spec_sheet'")
+    return {"spec_sheet": data["spec_sheet"].strip(), **_validate_name_and_tags(data)}
+
+def _validate_name_and_tags(data):
+    if not isinstance(data.get("product_name"), str) or not data["product_name"].strip():
+        raise ValueError("Response is missing a non-empty 'product_name'")
+    tags = data.get("tags")
+    if not isinstance(tags, dict):
+        raise ValueError("Response is missing the 'tags' object")
+    for key in PRODUCT_LISTING_SCHEMA["properties"]["tags"]["required"]:
+        if not isinstance(tags.get(key), str):
+            raise ValueError(f"Tag '{key}' is missing or not a string")
+    return {
+        "product_name": data["product_name"].strip(),
+        "tags": {key: value.strip() for key, value in tags.items() if isinstance(value, str) and value.strip()},
+    }
+
+def generate_product_listing(spec_sheet_prompt, name_tag_prompt, task_id=None, model=DEFAULT_MODELS['vision'], image_path=None, test_mode=False, bypass_cache=False):
+    """
+    Generate the spec sheet, product name and tags for a garment in one structured-output call.
+
+    A response that fails validation is requested once more, bypassing the cache.
+
+    Returns:
+        Dict from parse_product_listing().
+
+    Raises:
+        RuntimeError if the call fails or no valid listing comes back.
+    """
+    if test_mode:
+        return {
+            "spec_sheet": _test_mode_response(spec_sheet_prompt, model, image_path),
+            "product_name": "[TEST MODE] Product",
+            "tags": {"type": "Test", "color": "Test", "gender": "Unisex"},
+        }
+    prompt = build_product_listing_prompt(spec_sheet_prompt, name_tag_prompt)
+    for attempt in range(2):
+        text = call_ai_service(
+            prompt, task_id=task_id, model=model, image_path=image_path,
+            bypass_cache=bypass_cache or attempt > 0, response_format=PRODUCT_LISTING_RESPONSE_FORMAT,
+        )
+        try:
+            return parse_product_listing(text)
+        except ValueError as e:
+            logger.warning(f"Invalid product listing for task {task_id} (attempt {attempt + 1}): {e}")
+            error = e
+    raise RuntimeError(f"The AI service did not return a valid product listing: {error}")
+
+# Name and tags alone, for a spec sheet written elsewhere (e.g. streamed in New Task).
+NAME_TAGS_SCHEMA = {
+    "type": "object",
+    "properties": {key: PRODUCT_LISTING_SCHEMA["properties"][key] for key in ("product_name", "tags")},
+    "required": ["product_name", "tags"],
+    "additionalProperties": False,
+}
+NAME_TAGS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "name_and_tags", "strict": True, "schema": NAME_TAGS_SCHEMA},
+}
+
+def generate_name_and_tags(spec_sheet_text, name_tag_prompt, task_id=None, model="gpt-4o-mini", test_mode=False):
+    """
+    Generate a product name and tags from an existing spec sheet, in one text-only structured call.
+
+    Returns:
+        Dict with 'product_name' and 'tags'.
+
+    Raises:
+        RuntimeError if the call fails or the response does not match NAME_TAGS_SCHEMA.
+    """
+    if test_mode:
+        return {"product_name": "[TEST MODE] Product", "tags": {"type": "Test", "color": "Test", "gender": "Unisex"}}
+    prompt = (
+        f"{name_tag_prompt.strip()}\n\nSpec sheet:\n{spec_sheet_text.strip()}\n\n"
+        "Return a single JSON object with the keys \"product_name\" and \"tags\"."
+    )
+    text = call_ai_service(prompt, task_id=task_id, model=model, response_format=NAME_TAGS_RESPONSE_FORMAT)
+    try:
+        data = json.loads(text)
+        if not isinstance(data, dict):
+            raise ValueError("Response is not a JSON object")
+        return _validate_name_and_tags(data)
+    except ValueError as e:
+        raise RuntimeError(f"The AI service did not return a valid name and tags: {e}")
+
+def stream_ai_service(user_message, task_id=None, model=DEFAULT_MODELS['vision'], image_path=None, test_mode=False, bypass_cache=False):
+    """
+    Streaming variant of call_ai_service(): yields the response text in pieces as it arrives.
+
+    Takes the same arguments and uses the same history, cache and rate limits.
+    Only opening the stream is retried; an error once text has arrived raises
+    RuntimeError. The token estimate is settled against the usage reported in
+    the stream's last chunk. The complete response is cached when the stream
+    ends, and callers persist it themselves (st.write_stream returns the joined text).
+    """
+    logger.info(f"Streaming AI service called with model: {model}, task_id: {task_id}, test_mode: {test_mode}, has_image: {image_path is not None}")
+
+    if test_mode:
+        for word in _test_mode_response(user_message, model, image_path).split(" "):
+            yield word + " "
+        return
+
+    messages, image_sha256, cache_key = _prepare_request(user_message, task_id, model, image_path)
+    if not bypass_cache:
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            logger.info(f"AI response cache hit for task {task_id} with model {model}")
+            yield cached_response
+            return
+
+    _append_user_message(messages, user_message, task_id, image_path, image_sha256)
+
+    try:
+        logger.info(f"Opening OpenAI stream with model {model}")
+        openai_client = get_openai_client()
+
+        def send():
+            # include_usage adds a final chunk with the token usage. Passed through
+            # extra_body so SDK versions without a stream_options argument accept it.
+            raw_response = openai_client.chat.completions.with_raw_response.create(
+                model=model, messages=messages, stream=True,
+                extra_body={"stream_options": {"include_usage": True}},
+            )
+            return raw_response.parse(), raw_response.headers, None
+
+        estimated_tokens = estimate_request_tokens(messages)
+        stream = rate_limiter.call_with_limits(model, estimated_tokens, send)
+        parts = []
+        for chunk in stream:
+            usage = getattr(chunk, "usage", None)
+            if usage:
+                total_tokens = usage.get("total_tokens") if isinstance(usage, dict) else getattr(usage, "total_tokens", None)
+                if total_tokens is not None:
+                    rate_limiter.get_limiter(model).settle(estimated_tokens, total_tokens)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+        ai_response = "".join(parts)
+        logger.info(f"OpenAI stream complete, response length: {len(ai_response)}")
+        if ai_response:
+            response_cache.put(cache_key, model, ai_response)
+    except rate_limiter.CircuitOpenError as e:
+        logger.error(str(e))
+        raise
+    except openai.APIError as e:
+        logger.error(f"OpenAI API error: {e}")
+        raise RuntimeError(f"Failed to call OpenAI API: {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error in AI service: {e}")
+        raise RuntimeError(f"Unexpected error: {e}")
+
+def generate_image_from_prompt(final_prompt, product_code, model=DEFAULT_MODELS['image_generation'], size="1024x1024"):
+    """
+    Generate an image from a prompt and save it under OUTPUTS_DIR.
+
+    Returns:
+        Path of the saved PNG, or a message starting with "Error" on failure.
+    """
+    logger.info(f"Image generation called with model: {model}, product_code: {product_code}")
+    try:
+        openai_client = get_openai_client()
+
+        def send():
+            raw_response = openai_client.images.with_raw_response.generate(
+                model=model, prompt=final_prompt, size=size, n=1, response_format="b64_json"
+            )
+            return raw_response.parse(), raw_response.headers, None
+
+        # Image requests are limited by count; charge only the prompt against the token budget.
+        response = rate_limiter.call_with_limits(model, estimate_tokens(final_prompt), send)
+        image_bytes = base64.b64decode(response.data[0].b64_json)
+    except Exception as e:
+        logger.error(f"Image generation failed for {product_code}: {e}")
+        return f"Error generating image: {e}"
+
+    os.makedirs(OUTPUTS_DIR, exist_ok=True)
+    safe_code = "".join(c if c.isalnum() or c in "-_" else "_" for c in str(product_code))
+    output_path = os.path.join(OUTPUTS_DIR, f"{safe_code}_{int(time.time() * 1000)}.png")
+    with open(output_path, "wb") as f:
+        f.write(image_bytes)
+    logger.info(f"Saved generated image for {product_code} to {output_path}")
+    return output_path
@@ -0,0 +1,334 @@
+# File: app/core/fake_backend.py
+"""
+A local stand-in for the OpenAI API, for load tests and offline benchmarks.
+
+It serves chat completions (streamed and not), image generations and the model
+list over HTTP on localhost, so the real OpenAI client, rate limiter and retry
+code run unchanged. Point the app at it with OPENAI_BASE_URL:
+
+    python -m app.core.fake_backend --port 8765 --latency-ms 800 --error-rate-429 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 streamlit run Home.py
+
+Response text depends only on the seed, the model and the messages, so identical
+requests always get identical answers. Requests with a json_schema response_format
+get a JSON object shaped by the schema. Latency is drawn from a log-normal
+distribution around --latency-ms, completions are paced at --tokens-per-second,
+and 429/5xx errors are injected at the configured rates. With --rpm-limit the
+server also enforces a requests-per-minute quota and answers 429 with
+retry-after-ms once it is exceeded, like the real API.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_OPTIONS = {
+    "seed": 0,
+    # Median time before the first byte of a response, and the log-normal spread around it.
+    "latency_ms": 300.0,
+    "latency_sigma": 0.5,
+    # Completion pacing and length.
+    "tokens_per_second": 60.0,
+    "completion_tokens": 200,
+    # Probability that a request is answered with 429 or 500 instead.
+    "error_rate_429": 0.0,
+    "error_rate_5xx": 0.0,
+    # Requests per minute the server accepts before answering 429 (None for no limit).
+    "rpm_limit": None,
+    # Time an image generation takes.
+    "image_latency_ms": 2000.0,
+}
+
+MODELS = ["gpt-4o", "gpt-4o-mini", "gpt-3.5-turbo", "dall-e-3"]
+
+_WORDS = (
+    "cotton blend relaxed fit crew neck short sleeve ribbed cuffs soft hand feel "
+    "breathable fabric machine washable tailored silhouette contrast stitching "
+    "mid weight jersey knit drop shoulder garment dyed brushed interior classic "
+    "collar button placket side seam pockets tapered leg elastic waistband "
+    "recycled polyester lining moisture wicking stretch twill heavyweight fleece"
+).split()
+
+def _request_digest(seed, payload):
+    """Digest of everything that determines a response's content."""
+    material = json.dumps(
+        {"seed": seed, "model": payload.get("model"), "messages": payload.get("messages"), "prompt": payload.get("prompt")},
+        sort_keys=True,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def fake_completion_text(seed, payload, word_count):
+    """Deterministic pseudo spec-sheet text for a chat request."""
+    rng = random.Random(_request_digest(seed, payload))
+    lines = []
+    for index in range(0, word_count, 12):
+        words = [rng.choice(_WORDS) for _ in range(min(12, word_count - index))]
+        lines.append(f"- {' '.join(words).capitalize()}.")
+    return "\n".join(lines)
+
+def fake_structured_value(schema, rng, text):
+    """Build a value matching a JSON schema; a 'spec_sheet' field gets `text`."""
+    kind = schema.get("type")
+    if kind == "object":
+        properties = schema.get("properties", {})
+        return {
+            name: (text if name == "spec_sheet" else fake_structured_value(subschema, rng, text))
+            for name, subschema in properties.items()
+        }
+    if kind == "array":
+        return [fake_structured_value(schema.get("items", {}), rng, text) for _ in range(2)]
+    if kind in ("integer", "number"):
+        return rng.randint(1, 100)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    return " ".join(rng.choice(_WORDS) for _ in range(3)).title()
+
+def _estimate_prompt_tokens(messages):
+    tokens = 0
+    for message in messages or []:
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content) // 4 + 4
+        elif isinstance(content, list):
+            for part in content:
+                tokens += len(part.get("text", "")) // 4 if part.get("type") == "text" else 765
+    return tokens
+
+def fake_png(digest, size=64):
+    """A solid-colour PNG whose colour is taken from the request digest."""
+    red, green, blue = bytes.fromhex(digest[:6])
+    raw = b"".join(b"\x00" + bytes((red, green, blue)) * size for _ in range(size))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+class FakeBackend(ThreadingHTTPServer):
+    """The fake API server. `stats` counts requests and injected errors."""
+
+    daemon_threads = True
+
+    def __init__(self, address, **options):
+        unknown = set(options) - set(DEFAULT_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown fake backend options: {', '.join(sorted(unknown))}")
+        super().__init__(address, _Handler)
+        self.options = {**DEFAULT_OPTIONS, **options}
+        self.stats = {"requests": 0, "rate_limited": 0, "server_errors": 0}
+        self._lock = threading.Lock()
+        self._request_index = 0
+        self._recent_requests = deque()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def admit(self):
+        """
+        Decide how to answer the next request.
+
+        Returns:
+            (rng, status, retry_after_ms): a per-request random generator, and
+            200, 429 or 500 with the delay to suggest for a 429.
+        """
+        with self._lock:
+            index = self._request_index
+            self._request_index += 1
+            self.stats["requests"] += 1
+            now = time.monotonic()
+            rpm_limit = self.options["rpm_limit"]
+            if rpm_limit:
+                while self._recent_requests and now - self._recent_requests[0] >= 60:
+                    self._recent_requests.popleft()
+                if len(self._recent_requests) >= rpm_limit:
+                    self.stats["rate_limited"] += 1
+                    retry_after_ms = int((60 - (now - self._recent_requests[0])) * 1000) + 1
+                    return random.Random(f"{self.options['seed']}:{index}"), 429, retry_after_ms
+                self._recent_requests.append(now)
+        rng = random.Random(f"{self.options['seed']}:{index}")
+        roll = rng.random()
+        if roll < self.options["error_rate_429"]:
+            with self._lock:
+                self.stats["rate_limited"] += 1
+            return rng, 429, rng.randint(100, 2000)
+        if roll < self.options["error_rate_429"] + self.options["error_rate_5xx"]:
+            with self._lock:
+                self.stats["server_errors"] += 1
+            return rng, 500, None
+        return rng, 200, None
+
+    def latency(self, rng, median_ms):
+        """Seconds to wait before responding, drawn around `median_ms`."""
+        return median_ms / 1000 * math.exp(rng.gauss(0, self.options["latency_sigma"]))
+
+    def rate_limit_headers(self):
+        rpm_limit = self.options["rpm_limit"]
+        if not rpm_limit:
+            return {}
+        with self._lock:
+            remaining = max(0, rpm_limit - len(self._recent_requests))
+        return {"x-ratelimit-limit-requests": str(rpm_limit), "x-ratelimit-remaining-requests": str(remaining)}
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status, retry_after_ms=None):
+        if status == 429:
+            headers = {"retry-after-ms": str(retry_after_ms)} if retry_after_ms else {}
+            self._send_json(429, {"error": {"message": "Rate limit reached (fake backend)", "type": "requests", "code": "rate_limit_exceeded"}}, headers)
+        else:
+            self._send_json(status, {"error": {"message": "Injected server error (fake backend)", "type": "server_error", "code": None}})
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/v1/models":
+            self._send_json(200, {"object": "list", "data": [{"id": model, "object": "model", "created": 0, "owned_by": "fake"} for model in MODELS]})
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "Invalid JSON body", "type": "invalid_request_error"}})
+            return
+        path = self.path.rstrip("/")
+        if path == "/v1/chat/completions":
+            self._chat_completion(payload)
+        elif path == "/v1/images/generations":
+            self._image_generation(payload)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def _chat_completion(self, payload):
+        server = self.server
+        rng, status, retry_after_ms = server.admit()
+        time.sleep(server.latency(rng, server.options["latency_ms"]))
+        if status != 200:
+            self._send_error(status, retry_after_ms)
+            return
+
+        model = payload.get("model", "gpt-4o")
+        text = fake_completion_text(server.options["seed"], payload, server.options["completion_tokens"])
+        completion_tokens = len(text.split())
+        response_format = payload.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            schema = response_format.get("json_schema", {}).get("schema", {})
+            text = json.dumps(fake_structured_value(schema, random.Random(_request_digest(server.options["seed"], payload)), text))
+        elif response_format.get("type") == "json_object":
+            text = json.dumps({"text": text})
+        prompt_tokens = _estimate_prompt_tokens(payload.get("messages"))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        completion_id = f"chatcmpl-fake-{_request_digest(server.options['seed'], payload)[:16]}"
+        seconds_per_token = 1.0 / server.options["tokens_per_second"]
+
+        if not payload.get("stream"):
+            time.sleep(completion_tokens * seconds_per_token)
+            self._send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            }, server.rate_limit_headers())
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        for name, value in server.rate_limit_headers().items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta, finish_reason=None):
+            chunk = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        event({"role": "assistant", "content": ""})
+        for word in text.split(" "):
+            time.sleep(seconds_per_token)
+            event({"content": word + " "})
+        event({}, "stop")
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            chunk = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [], "usage": usage,
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _image_generation(self, payload):
+        server = self.server
+        rng, status, retry_after_ms = server.admit()
+        time.sleep(server.latency(rng, server.options["image_latency_ms"]))
+        if status != 200:
+            self._send_error(status, retry_after_ms)
+            return
+        image = base64.b64encode(fake_png(_request_digest(server.options["seed"], payload))).decode("ascii")
+        count = int(payload.get("n") or 1)
+        self._send_json(200, {
+            "created": int(time.time()),
+            "data": [{"b64_json": image, "revised_prompt": payload.get("prompt")} for _ in range(count)],
+        }, server.rate_limit_headers())
+
+def start_fake_backend(host="127.0.0.1", port=0, **options):
+    """
+    Start a fake backend on a background thread and return it.
+
+    Use `server.base_url` as the client's base_url, and `server.shutdown()` to stop it.
+    Port 0 picks a free port.
+    """
+    server = FakeBackend((host, port), **options)
+    thread = threading.Thread(target=server.serve_forever, name="fake-openai-backend", daemon=True)
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local fake OpenAI API for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    for name, default in DEFAULT_OPTIONS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, default=default,
+                            type=int if name in ("seed", "completion_tokens", "rpm_limit") else float)
+    args = vars(parser.parse_args())
+    host, port = args.pop("host"), args.pop("port")
+    server = FakeBackend((host, port), **args)
+    print(f"Fake OpenAI backend listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
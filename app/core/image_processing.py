@@ -0,0 +1,84 @@
+# File: app/core/image_processing.py
+"""
+Prepares images for vision model calls.
+
+Vision models downscale large images on their side anyway (high detail fits the
+image within 2048x2048 and then scales the short side to 768), so sending the
+original upload only inflates the request. prepare_image() applies the EXIF
+orientation, resizes to that tier and re-encodes: JPEG for opaque images, WebP
+when there is transparency. Results are cached on disk by the source file's
+SHA-256, so repeated calls with the same image skip the work.
+"""
+import io
+import os
+import tempfile
+
+from PIL import Image, ImageOps
+
+from app.config import logger, PROCESSED_IMAGES_DIR, VISION_MAX_LONG_SIDE, VISION_MAX_SHORT_SIDE, VISION_IMAGE_QUALITY
+from app import image_store
+
+# Part of every cache file name; bump it when the processing below changes.
+PROCESSING_VERSION = 1
+
+_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp"}
+
+def target_size(width, height, max_long_side=VISION_MAX_LONG_SIDE, max_short_side=VISION_MAX_SHORT_SIDE):
+    """Return the size an image is scaled to: never larger than the original, within both limits."""
+    scale = min(1.0, max_long_side / max(width, height), max_short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def _has_alpha(image):
+    return image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+
+def process_image(data):
+    """
+    Orient, downscale and re-encode raw image bytes.
+
+    Returns:
+        (format, bytes) where format is "JPEG" or "WEBP".
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        size = target_size(*image.size)
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        output = io.BytesIO()
+        if _has_alpha(image):
+            image.convert("RGBA").save(output, "WEBP", quality=VISION_IMAGE_QUALITY, method=4)
+            return "WEBP", output.getvalue()
+        image.convert("RGB").save(output, "JPEG", quality=VISION_IMAGE_QUALITY, optimize=True)
+        return "JPEG", output.getvalue()
+
+def _cache_path(sha256, image_format):
+    return os.path.join(
+        PROCESSED_IMAGES_DIR, sha256[:2],
+        f"{sha256}-v{PROCESSING_VERSION}-{VISION_MAX_LONG_SIDE}x{VISION_MAX_SHORT_SIDE}-q{VISION_IMAGE_QUALITY}{_EXTENSIONS[image_format]}",
+    )
+
+def prepare_image(image_path, sha256=None):
+    """
+    Return (mime_type, bytes) ready to send to a vision model, using the cache when possible.
+
+    Args:
+        sha256: Digest of the file, if the caller has already computed it.
+    """
+    sha256 = sha256 or image_store.hash_file(image_path)
+    for image_format in ("JPEG", "WEBP"):
+        cached_path = _cache_path(sha256, image_format)
+        if os.path.exists(cached_path):
+            with open(cached_path, "rb") as f:
+                return _MIME_TYPES[image_format], f.read()
+
+    with open(image_path, "rb") as f:
+        original = f.read()
+    image_format, processed = process_image(original)
+    cached_path = _cache_path(sha256, image_format)
+    os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cached_path), suffix=".part")
+    with os.fdopen(fd, "wb") as f:
+        f.write(processed)
+    os.replace(temp_path, cached_path)
+    logger.info(f"Prepared {image_path} for vision: {len(original)} -> {len(processed)} bytes ({image_format})")
+    return _MIME_TYPES[image_format], processed
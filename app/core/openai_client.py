@@ -0,0 +1,121 @@
+# File: app/core/openai_client.py
+"""
+The process-wide OpenAI client and the pooled HTTP client under it.
+
+Every AI entry point, including worker threads and scripts, uses the client from
+get_openai_client(). That client sits on one httpx.Client with explicit
+connection limits, timeouts and keep-alive, so connections (and their TLS
+handshakes) are reused across calls. HTTP/2 is used when the optional h2
+package is installed. Both clients are thread-safe. A forked child process
+builds its own instead of sharing the parent's sockets.
+
+The OpenAI client gets the same timeouts explicitly, so the SDK's own
+ten-minute default never replaces the tuned read timeout.
+"""
+import atexit
+import os
+import threading
+
+import httpx
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from app.config import (
+    logger,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_KEEPALIVE_EXPIRY_SECONDS,
+    HTTP_CONNECT_TIMEOUT_SECONDS,
+    HTTP_READ_TIMEOUT_SECONDS,
+    HTTP_WRITE_TIMEOUT_SECONDS,
+    HTTP_POOL_TIMEOUT_SECONDS,
+)
+
+load_dotenv()
+
+_lock = threading.Lock()
+_http_client = None
+_openai_client = None
+_owner_pid = None
+
+def _http2_available():
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def _timeout():
+    return httpx.Timeout(
+        connect=HTTP_CONNECT_TIMEOUT_SECONDS,
+        read=HTTP_READ_TIMEOUT_SECONDS,
+        write=HTTP_WRITE_TIMEOUT_SECONDS,
+        pool=HTTP_POOL_TIMEOUT_SECONDS,
+    )
+
+def _build_http_client():
+    http2 = _http2_available()
+    logger.info(
+        f"Creating shared HTTP client (max {HTTP_MAX_CONNECTIONS} connections, "
+        f"{HTTP_MAX_KEEPALIVE_CONNECTIONS} keep-alive, http2={http2})"
+    )
+    return httpx.Client(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        timeout=_timeout(),
+        follow_redirects=True,
+    )
+
+def _reset_after_fork():
+    """Drop clients inherited from a parent process; their sockets belong to the parent."""
+    global _http_client, _openai_client, _owner_pid
+    if _owner_pid != os.getpid():
+        _http_client = None
+        _openai_client = None
+        _owner_pid = os.getpid()
+
+def get_http_client():
+    """Return this process's shared, pooled httpx.Client."""
+    global _http_client
+    with _lock:
+        _reset_after_fork()
+        if _http_client is None:
+            _http_client = _build_http_client()
+        return _http_client
+
+def get_openai_client():
+    """
+    Return this process's shared OpenAI client, creating it on first use.
+
+    OPENAI_BASE_URL points it at another server, such as app.core.fake_backend.
+    The SDK's own retries are disabled; rate_limiter retries instead.
+    """
+    global _openai_client
+    http_client = get_http_client()
+    with _lock:
+        if _openai_client is None:
+            api_key = os.getenv('OPENAI_API_KEY')
+            base_url = os.getenv('OPENAI_BASE_URL') or None
+            if not api_key:
+                if not base_url:
+                    raise ValueError("OPENAI_API_KEY environment variable is not set")
+                api_key = "not-needed-for-local-backend"
+            _openai_client = OpenAI(
+                api_key=api_key, base_url=base_url, timeout=_timeout(), max_retries=0, http_client=http_client,
+            )
+        return _openai_client
+
+def close_clients():
+    """Close the shared clients; the next get_openai_client() call creates new ones."""
+    global _http_client, _openai_client
+    with _lock:
+        if _http_client is not None and _owner_pid == os.getpid():
+            _http_client.close()
+        _http_client = None
+        _openai_client = None
+
+atexit.register(close_clients)
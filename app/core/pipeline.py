@@ -0,0 +1,136 @@
+# File: app/core/pipeline.py
+"""
+The task pipeline, declared as a graph of stages.
+
+    spec_sheet ──> name_tags ──> [approval] ──> image
+
+A stage takes tasks that meet its ready condition and have no job of an
+upstream stage (its `after` edges) still queued or running, queues one job per
+task in the durable job queue and runs them with its own worker pool, rate limit and
+retry policy (PIPELINE_STAGE_SETTINGS). pump() feeds every stage. The workers
+started by `python -m app.worker` call it periodically, so new tasks get spec
+sheets, names and tags without anyone pressing a button, and approved tasks
+go on to image generation. Because each stage has its own pool and budget, the
+slow image stage cannot hold up the text stages.
+
+spec_sheet writes the name and tags too (one structured call), so name_tags
+only handles tasks whose spec sheet was written elsewhere, such as the
+streamed spec sheets from New Task.
+"""
+import threading
+import time
+
+from app.config import logger, PIPELINE_STAGE_SETTINGS
+from app.database import job_queue
+from app.core import workflow_manager
+from app.core.rate_limiter import TokenBucket
+
+class Stage:
+    """
+    One node of the pipeline.
+
+    Args:
+        name: Key into PIPELINE_STAGE_SETTINGS.
+        kind: The job kind its jobs are queued under.
+        after: Names of the stages that feed it. A task waits while it has a
+            queued or running job of any of them.
+        ready_sql: SQL condition on tasks that makes a task ready for the stage.
+        run: Handler called as run(job, worker_id); raises to have the job retried.
+        on_dead: Optional callback(job) for a job that ran out of attempts.
+        queued_status: Status a task moves to when its job is queued.
+        once: Never queue a task for this stage again once it has had a job.
+    """
+
+    def __init__(self, name, kind, after, ready_sql, run, on_dead=None, queued_status=None, once=False):
+        settings = PIPELINE_STAGE_SETTINGS[name]
+        self.name = name
+        self.kind = kind
+        self.after = tuple(after)
+        self.ready_sql = ready_sql
+        self.run = run
+        self.on_dead = on_dead
+        self.queued_status = queued_status
+        self.once = once
+        self.workers = settings['workers']
+        self.max_attempts = settings['max_attempts']
+        self.retry_base_seconds = settings['retry_base_seconds']
+        self.retry_max_seconds = settings['retry_max_seconds']
+        self._requests = TokenBucket(settings['requests_per_minute'])
+        self._lock = threading.Lock()
+
+    def throttle(self):
+        """Block until the stage's request budget allows another job to start."""
+        while True:
+            with self._lock:
+                delay = self._requests.wait_time(1, time.monotonic())
+                if delay <= 0:
+                    self._requests.take(1)
+                    return
+            time.sleep(delay)
+
+    def ready_condition(self):
+        """Return the stage's ready_sql gated on its upstream stages, with the parameters it needs."""
+        if not self.after:
+            return self.ready_sql, ()
+        upstream_kinds = [STAGES_BY_NAME[name].kind for name in self.after]
+        placeholders = ", ".join("?" for _ in upstream_kinds)
+        return f"""({self.ready_sql}) AND NOT EXISTS (
+            SELECT 1 FROM jobs AS upstream WHERE upstream.task_id = tasks.id
+              AND upstream.kind IN ({placeholders}) AND upstream.status IN ('queued', 'running'))""", tuple(upstream_kinds)
+
+    def feed(self):
+        """Queue a job for every ready task that does not have one. Returns how many were queued."""
+        ready_sql, params = self.ready_condition()
+        return job_queue.enqueue_ready_tasks(
+            self.kind, ready_sql, params, new_status=self.queued_status,
+            max_attempts=self.max_attempts, include_finished=self.once,
+        )
+
+    def fail(self, job, worker_id, error):
+        """Record a failed attempt with the stage's retry policy. Returns the job's new status."""
+        return job_queue.fail(
+            job['id'], worker_id, error,
+            base_seconds=self.retry_base_seconds, max_seconds=self.retry_max_seconds,
+        )
+
+# --- Stages ---
+# In dependency order; pump() feeds them in this order.
+STAGES = [
+    Stage(
+        'spec_sheet', workflow_manager.LISTING_JOB, after=(),
+        ready_sql="status = 'NEW' AND COALESCE(uploaded_image_paths, '') <> ''",
+        run=workflow_manager.run_listing_job, on_dead=workflow_manager.on_listing_dead, once=True,
+    ),
+    Stage(
+        'name_tags', workflow_manager.NAME_TAGS_JOB, after=('spec_sheet',),
+        ready_sql="status IN ('PENDING_APPROVAL', 'APPROVED') AND spec_sheet_text IS NOT NULL AND product_name IS NULL",
+        run=workflow_manager.run_name_tags_job, once=True,
+    ),
+    Stage(
+        # Gated on approval; `after` makes it wait for naming still in progress.
+        'image', workflow_manager.IMAGE_GENERATION_JOB, after=('name_tags',),
+        ready_sql="status = 'APPROVED'",
+        run=workflow_manager.run_image_generation_job, on_dead=workflow_manager.on_image_generation_dead,
+        queued_status='GENERATING',
+    ),
+]
+STAGES_BY_KIND = {stage.kind: stage for stage in STAGES}
+STAGES_BY_NAME = {stage.name: stage for stage in STAGES}
+
+def pump():
+    """
+    Feed every stage its ready tasks. Safe to run from several processes at once.
+
+    Returns:
+        Dict mapping stage name to the number of jobs queued.
+    """
+    queued = {}
+    for stage in STAGES:
+        try:
+            queued[stage.name] = stage.feed()
+        except Exception as e:
+            logger.error(f"Pipeline pump failed for stage {stage.name}: {e}")
+            queued[stage.name] = 0
+    if any(queued.values()):
+        logger.info("Pipeline queued " + ", ".join(f"{count} {name}" for name, count in queued.items() if count))
+    return queued
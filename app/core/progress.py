@@ -0,0 +1,130 @@
+# File: app/core/progress.py
+"""
+Live batch progress, followed through the task_events log.
+
+A BatchProgress reads per-batch status counts once, then keeps them current by
+applying only the events added since its last poll. A dashboard refresh costs
+one indexed query on task_events instead of reloading the tasks, and every
+session sees changes made by workers and other users as they land.
+"""
+import time
+from collections import deque
+
+from app.config import PROGRESS_ETA_WINDOW_SECONDS
+from app.database import crud
+
+# Statuses that still have automated work ahead of them (spec sheet, image).
+PENDING_STATUSES = ('NEW', 'APPROVED', 'GENERATING')
+# Event types written by workers rather than triggers; shown in the activity feed.
+JOB_EVENT_TYPES = ('job_failed', 'job_dead')
+
+class BatchProgress:
+    """Per-batch task counts, completion rates and recent activity, updated incrementally."""
+
+    def __init__(self, eta_window_seconds=PROGRESS_ETA_WINDOW_SECONDS):
+        self.eta_window_seconds = eta_window_seconds
+        self.counts = {}
+        self.completions = {}
+        # Events up to this id are already included in a batch's counts.
+        self.batch_since = {}
+        self.last_event_id = 0
+        # task id -> id of the latest event that touched it.
+        self.task_changes = {}
+        self.recent_events = deque(maxlen=10)
+        self._load_batches(None)
+
+    def _load_batches(self, batch_ids):
+        snapshot = crud.get_batch_progress_snapshot(
+            PENDING_STATUSES, batch_ids, completions_since=time.time() - self.eta_window_seconds
+        )
+        for batch_id, counts in snapshot['counts'].items():
+            self.counts[batch_id] = counts
+            self.completions[batch_id] = deque(snapshot['completions'][batch_id])
+            self.batch_since[batch_id] = snapshot['last_event_id']
+        if batch_ids is None:
+            self.last_event_id = snapshot['last_event_id']
+
+    def _apply(self, batch_id, event):
+        counts = self.counts[batch_id]
+        old_status, new_status = event['old_status'], event['new_status']
+        if old_status and event['event_type'] in ('status', 'deleted'):
+            counts[old_status] = counts.get(old_status, 0) - 1
+        if new_status and event['event_type'] in ('status', 'created'):
+            counts[new_status] = counts.get(new_status, 0) + 1
+        if event['event_type'] == 'status' and old_status in PENDING_STATUSES and new_status not in PENDING_STATUSES:
+            self.completions[batch_id].append(event['created_at'])
+
+    def poll(self, limit=1000, max_pages=10):
+        """
+        Apply the events added since the last poll.
+
+        Returns:
+            Number of events read.
+        """
+        read = 0
+        new_batches = set()
+        for _ in range(max_pages):
+            events = crud.get_task_events(self.last_event_id, limit)
+            for event in events:
+                self.last_event_id = event['id']
+                if event['task_id'] is not None:
+                    self.task_changes[event['task_id']] = event['id']
+                if event['event_type'] in JOB_EVENT_TYPES or event['new_status'] == 'ERROR':
+                    self.recent_events.append(event)
+                batch_id = event['batch_id'] or ''
+                if batch_id not in self.counts:
+                    # A batch that just got work; its counts are read below.
+                    if event['new_status'] in PENDING_STATUSES:
+                        new_batches.add(batch_id)
+                    continue
+                if event['id'] > self.batch_since[batch_id]:
+                    self._apply(batch_id, event)
+            read += len(events)
+            if len(events) < limit:
+                break
+        if new_batches:
+            self._load_batches(sorted(new_batches))
+        return read
+
+    def changed_tasks(self, task_ids, since_event_id):
+        """Return which of `task_ids` changed after `since_event_id`."""
+        return [task_id for task_id in task_ids if self.task_changes.get(task_id, 0) > since_event_id]
+
+    def summary(self, now=None):
+        """
+        Describe every followed batch, busiest first.
+
+        Returns:
+            List of dicts with 'batch_id' (None for tasks without a batch), 'total',
+            'pending', 'done', 'fraction_done', 'counts' (status -> count),
+            'rate_per_minute' over the ETA window, and 'eta_seconds' (None when
+            nothing has finished recently or nothing is left).
+        """
+        now = now or time.time()
+        cutoff = now - self.eta_window_seconds
+        batches = []
+        for batch_id, counts in self.counts.items():
+            counts = {status: count for status, count in counts.items() if count > 0}
+            total = sum(counts.values())
+            if total == 0:
+                continue
+            completions = self.completions[batch_id]
+            while completions and completions[0] < cutoff:
+                completions.popleft()
+            pending = sum(counts.get(status, 0) for status in PENDING_STATUSES)
+            rate_per_second = 0.0
+            if completions:
+                # At least a minute, so one quick completion does not promise a tiny ETA.
+                rate_per_second = len(completions) / max(60.0, now - completions[0])
+            batches.append({
+                'batch_id': batch_id or None,
+                'total': total,
+                'pending': pending,
+                'done': total - pending,
+                'fraction_done': (total - pending) / total,
+                'counts': counts,
+                'rate_per_minute': rate_per_second * 60,
+                'eta_seconds': pending / rate_per_second if pending and rate_per_second else None,
+            })
+        batches.sort(key=lambda batch: (batch['pending'], batch['total']), reverse=True)
+        return batches
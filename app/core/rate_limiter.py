@@ -0,0 +1,238 @@
+# File: app/core/rate_limiter.py
+"""
+Client-side rate limiting, retries and circuit breaking for OpenAI calls.
+
+Every model has a ModelLimiter shared by all threads in the process. It keeps two
+token buckets, one for requests per minute and one for tokens per minute. Both
+start from the configured defaults and follow the x-ratelimit-* headers the API
+returns. A 429 pauses the whole model for its retry-after time rather than only
+the thread that hit it. Transient failures (429, 5xx, connection errors) are retried with
+jittered exponential backoff, and after RATE_LIMIT_CIRCUIT_THRESHOLD consecutive
+failures the model's circuit opens and calls fail fast for a cooldown period.
+"""
+import random
+import re
+import threading
+import time
+
+import openai
+
+from app.config import (
+    logger,
+    RATE_LIMIT_DEFAULT_RPM,
+    RATE_LIMIT_DEFAULT_TPM,
+    RATE_LIMIT_MAX_RETRIES,
+    RATE_LIMIT_BACKOFF_BASE_SECONDS,
+    RATE_LIMIT_BACKOFF_MAX_SECONDS,
+    RATE_LIMIT_CIRCUIT_THRESHOLD,
+    RATE_LIMIT_CIRCUIT_COOLDOWN_SECONDS,
+)
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a model whose circuit breaker is open."""
+
+class TokenBucket:
+    """
+    A token bucket refilled continuously at `capacity` per minute.
+
+    The level may go negative when a request turns out to cost more than was
+    taken for it; later callers then wait until the debt is repaid.
+    """
+
+    def __init__(self, capacity_per_minute):
+        self.capacity = float(capacity_per_minute)
+        self.level = float(capacity_per_minute)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.capacity / 60.0)
+        self.updated_at = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` can be taken (0 if it can be taken now)."""
+        self._refill(now)
+        # A request larger than the whole bucket only waits for a full bucket.
+        needed = min(amount, self.capacity) - self.level
+        return 0.0 if needed <= 0 else needed * 60.0 / self.capacity
+
+    def take(self, amount):
+        self.level -= amount
+
+    def sync(self, limit=None, remaining=None):
+        """Adopt the limit and remaining count reported by the server."""
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.level = min(self.level, float(remaining))
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def parse_duration(value):
+    """Parse a reset header such as '1s', '6m0s' or '20ms' into seconds."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+def retry_after_seconds(headers):
+    """Return the server-requested delay from retry-after-ms or retry-after, if any."""
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    return parse_duration(headers.get("retry-after"))
+
+def _int_header(headers, name):
+    value = headers.get(name)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+class ModelLimiter:
+    """Request and token budgets, server-imposed pauses and the circuit breaker for one model."""
+
+    def __init__(self, model, rpm=RATE_LIMIT_DEFAULT_RPM, tpm=RATE_LIMIT_DEFAULT_TPM):
+        self.model = model
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, estimated_tokens):
+        """Block until one request and `estimated_tokens` tokens fit the budget, then take them."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.circuit_open_until:
+                    raise CircuitOpenError(
+                        f"Circuit open for {self.model}: calls resume in {self.circuit_open_until - now:.0f}s"
+                    )
+                delay = max(
+                    self.paused_until - now,
+                    self.requests.wait_time(1, now),
+                    self.tokens.wait_time(estimated_tokens, now),
+                )
+                if delay <= 0:
+                    self.requests.take(1)
+                    self.tokens.take(estimated_tokens)
+                    return
+            time.sleep(delay)
+
+    def settle(self, estimated_tokens, used_tokens):
+        """Correct the token budget once a request's real usage is known."""
+        with self._lock:
+            self.tokens.take(used_tokens - estimated_tokens)
+
+    def refund(self, estimated_tokens):
+        """Return the tokens taken for a request that failed before using any."""
+        with self._lock:
+            self.tokens.take(-estimated_tokens)
+
+    def record_success(self, headers=None, estimated_tokens=0, used_tokens=None):
+        """Reset the failure count, settle the token estimate and adopt any rate-limit headers."""
+        with self._lock:
+            self.consecutive_failures = 0
+            if used_tokens is not None:
+                self.tokens.take(used_tokens - estimated_tokens)
+            if headers:
+                self.requests.sync(
+                    _int_header(headers, "x-ratelimit-limit-requests"),
+                    _int_header(headers, "x-ratelimit-remaining-requests"),
+                )
+                self.tokens.sync(
+                    _int_header(headers, "x-ratelimit-limit-tokens"),
+                    _int_header(headers, "x-ratelimit-remaining-tokens"),
+                )
+
+    def record_failure(self, pause_seconds=None):
+        """Count a transient failure, pause the model if the server asked to, and maybe open the circuit."""
+        with self._lock:
+            now = time.monotonic()
+            if pause_seconds:
+                self.paused_until = max(self.paused_until, now + pause_seconds)
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= RATE_LIMIT_CIRCUIT_THRESHOLD:
+                self.circuit_open_until = now + RATE_LIMIT_CIRCUIT_COOLDOWN_SECONDS
+                self.consecutive_failures = 0
+                logger.warning(
+                    f"Opening circuit for {self.model} for {RATE_LIMIT_CIRCUIT_COOLDOWN_SECONDS}s "
+                    f"after {RATE_LIMIT_CIRCUIT_THRESHOLD} consecutive failures"
+                )
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(model):
+    """Return the process-wide limiter for a model, creating it on first use."""
+    with _limiters_lock:
+        limiter = _limiters.get(model)
+        if limiter is None:
+            limiter = _limiters[model] = ModelLimiter(model)
+        return limiter
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff for the given attempt (0-based)."""
+    ceiling = min(RATE_LIMIT_BACKOFF_MAX_SECONDS, RATE_LIMIT_BACKOFF_BASE_SECONDS * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+def _is_transient(error):
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+def call_with_limits(model, estimated_tokens, send, max_retries=RATE_LIMIT_MAX_RETRIES):
+    """
+    Send a request under the model's rate limits, retrying transient failures.
+
+    Args:
+        estimated_tokens: Prompt plus expected completion tokens, charged up front.
+        send: Callable making one attempt. It returns (result, headers, used_tokens);
+            headers and used_tokens may be None.
+
+    Returns:
+        The result of the first successful attempt.
+
+    Raises:
+        CircuitOpenError if the model's circuit is open, or the last error once
+        retries are exhausted or the error is not transient.
+    """
+    limiter = get_limiter(model)
+    attempt = 0
+    while True:
+        limiter.acquire(estimated_tokens)
+        try:
+            result, headers, used_tokens = send()
+        except openai.APIError as e:
+            # A failed attempt reports no usage, so it gives back what it was charged.
+            limiter.refund(estimated_tokens)
+            if not _is_transient(e):
+                raise
+            headers = getattr(getattr(e, "response", None), "headers", None)
+            delay = retry_after_seconds(headers)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            # A 429 pauses every caller of the model; other failures only back off this one.
+            limiter.record_failure(delay if isinstance(e, openai.RateLimitError) else None)
+            if attempt >= max_retries:
+                raise
+            logger.warning(f"{model} call failed ({e.__class__.__name__}); retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            attempt += 1
+            # Jitter on top of the delay keeps paused callers from retrying in lockstep.
+            time.sleep(delay + random.uniform(0, RATE_LIMIT_BACKOFF_BASE_SECONDS))
+            continue
+        limiter.record_success(headers, estimated_tokens, used_tokens)
+        return result
@@ -0,0 +1,146 @@
+# File: app/core/response_cache.py
+"""
+On-disk cache of AI responses.
+
+Responses are stored in their own SQLite database (AI_CACHE_PATH), keyed by a
+SHA-256 over the model, the normalized chat messages and the SHA-256 of any
+attached image. Entries expire after AI_CACHE_TTL_SECONDS, and the least recently
+used ones are evicted once the cache grows past AI_CACHE_MAX_BYTES.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from app.config import logger, AI_CACHE_PATH, AI_CACHE_TTL_SECONDS, AI_CACHE_MAX_BYTES
+
+# Bump to invalidate every cached response, e.g. when the request format changes.
+CACHE_FORMAT_VERSION = 1
+# A hit only rewrites last_used_at when it is older than this, so hits stay read-only.
+TOUCH_INTERVAL_SECONDS = 60
+
+_local = threading.local()
+
+RESPONSES_TABLE = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+def _get_connection():
+    """Return the calling thread's connection to the cache database."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "path", None) == AI_CACHE_PATH:
+        return conn
+    cache_dir = os.path.dirname(AI_CACHE_PATH)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    conn = sqlite3.connect(AI_CACHE_PATH, timeout=5, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(RESPONSES_TABLE)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used_at ON responses (last_used_at)")
+    _local.conn = conn
+    _local.path = AI_CACHE_PATH
+    return conn
+
+def _normalize_text(text):
+    """Collapse whitespace so cosmetic differences in a prompt still hit the cache."""
+    return " ".join(str(text).split())
+
+def make_key(model, messages, image_sha256=None, response_format=None):
+    """
+    Build the cache key for a request.
+
+    Args:
+        messages: Chat messages without the image attachment; string contents are
+            whitespace-normalized.
+        image_sha256: Digest of the attached image, if any.
+        response_format: The request's response_format, if it asks for structured output.
+    """
+    normalized = [
+        {"role": message["role"], "content": _normalize_text(message["content"])}
+        for message in messages
+    ]
+    request = {"v": CACHE_FORMAT_VERSION, "model": model, "messages": normalized, "image": image_sha256}
+    if response_format is not None:
+        request["response_format"] = response_format
+    material = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def get(key):
+    """Return the cached response for a key, or None if it is missing or expired."""
+    try:
+        conn = _get_connection()
+        row = conn.execute(
+            "SELECT response, created_at, last_used_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        response, created_at, last_used_at = row
+        now = time.time()
+        if now - created_at > AI_CACHE_TTL_SECONDS:
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            return None
+        if now - last_used_at > TOUCH_INTERVAL_SECONDS:
+            conn.execute("UPDATE responses SET last_used_at = ? WHERE key = ?", (now, key))
+        return response
+    except sqlite3.Error as e:
+        logger.warning(f"AI response cache read failed: {e}")
+        return None
+
+def put(key, model, response):
+    """Store a response, then evict expired and least recently used entries if needed."""
+    try:
+        conn = _get_connection()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model, response, size_bytes, created_at, last_used_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, response, len(response.encode("utf-8")), now, now),
+        )
+        evict()
+    except sqlite3.Error as e:
+        logger.warning(f"AI response cache write failed: {e}")
+
+def evict(max_bytes=None):
+    """
+    Delete expired entries, then the least recently used ones until the cache fits `max_bytes`.
+
+    Returns:
+        Number of entries removed.
+    """
+    max_bytes = AI_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    conn = _get_connection()
+    removed = conn.execute(
+        "DELETE FROM responses WHERE created_at < ?", (time.time() - AI_CACHE_TTL_SECONDS,)
+    ).rowcount
+    total = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM responses").fetchone()[0]
+    if total <= max_bytes:
+        return removed
+    # Walk entries oldest-used first until enough bytes are freed.
+    doomed = []
+    for key, size_bytes in conn.execute("SELECT key, size_bytes FROM responses ORDER BY last_used_at"):
+        if total <= max_bytes:
+            break
+        doomed.append((key,))
+        total -= size_bytes
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+    return removed + len(doomed)
+
+def clear():
+    """Remove every cached response."""
+    _get_connection().execute("DELETE FROM responses")
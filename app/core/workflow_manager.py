@@ -1,51 +1,277 @@
 # File: app/core/workflow_manager.py
 
-from app.database import crud
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from app.config import (
+    logger, BULK_GENERATION_WORKERS, DEFAULT_SPEC_SHEET_PROMPT, DEFAULT_NAME_TAG_PROMPT,
+    JOB_LEASE_SECONDS, PIPELINE_STAGE_SETTINGS,
+)
+from app.database import crud, job_queue
 from app.core import ai_services
 
+# Used when the configured SOP prompt files are missing.
+BULK_SPEC_SHEET_PROMPT = "Describe this garment product in detail for e-commerce."
+BULK_NAME_TAG_PROMPT = "Give the garment a short, marketable product name and tag its type, color and gender."
+
+# --- Image Generation Jobs ---
+# Image generation runs in background workers (python -m app.worker); the UI only enqueues.
+IMAGE_GENERATION_JOB = "generate_image"
+BASE_MODEL_PROMPT = "professional photograph of a female model wearing the garment, full body shot, studio lighting, hyperrealistic, 8k"
+
+def build_image_prompt(spec_sheet_text):
+    """Return the image generation prompt for a spec sheet."""
+    return f"{BASE_MODEL_PROMPT}, {spec_sheet_text or ''}"
+
 def bulk_generate_images(task_ids: list):
     """
-    Handles the logic for bulk-generating images for selected tasks.
-    It will only process tasks that are in the 'APPROVED' status.
+    Queues image generation for the selected tasks.
+    It will only queue tasks that are in the 'APPROVED' status; they move to
+    'GENERATING' and background workers pick them up.
     """
     if not task_ids:
         return "No tasks were selected."
 
-    # 1. Filter for tasks that are actually ready for generation
-    approved_tasks_to_process = []
-    for task_id in task_ids:
-        task = crud.get_task_by_id(task_id)
-        if task and task['status'] == 'APPROVED':
-            approved_tasks_to_process.append(task)
-    
-    if not approved_tasks_to_process:
+    approved_ids = [
+        task['id'] for task in crud.get_tasks_by_ids(task_ids, columns=['id', 'status'])
+        if task['status'] == 'APPROVED'
+    ]
+    if not approved_ids:
         return "No tasks with 'APPROVED' status were selected."
 
-    # 2. Update status of all selected tasks to 'GENERATING' first
-    # This provides immediate feedback to the user on the dashboard.
-    for task in approved_tasks_to_process:
-        crud.update_task_status(task['id'], 'GENERATING')
-
-    # 3. Now, process each task one by one
-    success_count = 0
-    error_count = 0
-    for task in approved_tasks_to_process:
-        print(f"Generating image for Task ID: {task['id']}...")
-        
-        # Reconstruct the final prompt
-        base_model_prompt = "professional photograph of a female model wearing the garment, full body shot, studio lighting, hyperrealistic, 8k"
-        final_prompt = f"{base_model_prompt}, {task['spec_sheet_text']}"
-        
-        # Call the AI service
+    # Status change and jobs commit together, so no task is left GENERATING without a job.
+    with crud.unit_of_work():
+        crud.update_status_many(approved_ids, 'GENERATING')
+        queued = job_queue.enqueue_many(IMAGE_GENERATION_JOB, approved_ids)
+    return f"Queued {queued} tasks for image generation. Background workers will process them."
+
+def set_task_priority(task_ids, priority):
+    """
+    Change the scheduling priority of tasks, including jobs they already have queued.
+
+    Priorities at or above SCHEDULER_URGENT_PRIORITY put a task in the urgent lane.
+
+    Returns:
+        Number of tasks updated.
+    """
+    with crud.unit_of_work():
+        updated = crud.update_priority_many(task_ids, priority)
+        job_queue.set_task_priority(task_ids, priority)
+    return updated
+
+def queue_image_generation(task_id, redo_prompt=""):
+    """
+    Queue image generation for one task, optionally with redo instructions.
+
+    Returns:
+        True if a job was queued, False if the task already has one pending.
+    """
+    payload = {"redo_prompt": redo_prompt} if redo_prompt else None
+    with crud.unit_of_work():
+        job_id = job_queue.enqueue(IMAGE_GENERATION_JOB, task_id, payload)
+        if job_id is not None:
+            crud.update_task_status(task_id, 'GENERATING')
+    return job_id is not None
+
+def run_image_generation_job(job, worker_id):
+    """
+    Worker handler for IMAGE_GENERATION_JOB. Raises to have the job retried.
+
+    The worker leases the task for the duration of the call, so a crash mid-way
+    is spotted by sweep_stuck_generations(). Tasks that were deleted or moved out
+    of 'GENERATING' in the meantime are skipped.
+    """
+    task = crud.get_task_by_id(job['task_id'])
+    if not task or task['status'] != 'GENERATING':
+        logger.info(f"Skipping image job {job['id']}: task {job['task_id']} is no longer waiting for generation")
+        return
+    if not crud.acquire_generation_lease(task['id'], worker_id, JOB_LEASE_SECONDS):
+        raise RuntimeError(f"Task {task['id']} is leased to another worker")
+    try:
+        redo_prompt = job['payload'].get('redo_prompt', '')
+        final_prompt = build_image_prompt(task.get('spec_sheet_text'))
+        if redo_prompt:
+            final_prompt = f"{task.get('final_prompt') or final_prompt}, {redo_prompt}"
         generated_path = ai_services.generate_image_from_prompt(final_prompt, task['product_code'])
-        
-        # Process the result
         if "Error" in generated_path:
-            crud.update_task_status(task['id'], 'ERROR')
-            error_count += 1
-        else:
-            crud.add_generated_image_to_task(task['id'], final_prompt, generated_path)
-            success_count += 1
-            
-    return f"Bulk generation complete. Success: {success_count}, Errors: {error_count}."
+            raise RuntimeError(generated_path)
+        # Also clears the lease.
+        crud.add_generated_image_to_task(task['id'], final_prompt, generated_path, redo_prompt)
+    except Exception:
+        crud.release_generation_lease(task['id'], worker_id)
+        raise
+
+def on_image_generation_dead(job):
+    """Called when an image job runs out of attempts: flag its task for attention."""
+    crud.update_task_status(job['task_id'], 'ERROR')
+
+def sweep_stuck_generations():
+    """
+    Recover GENERATING tasks whose worker died, or that never got a job.
+
+    Each one loses its expired lease and its job is queued again, after a backoff
+    that grows with the job's attempts; a task without a job gets a new one. A job
+    that has used all its attempts is dead-lettered and its task set to ERROR
+    instead. Safe to run from several workers at once.
+
+    Returns:
+        Dict with the number of tasks 'requeued' and 'failed'.
+    """
+    result = {'requeued': 0, 'failed': 0}
+    for task in crud.get_stuck_generating_tasks(IMAGE_GENERATION_JOB):
+        attempts = task['attempts'] or 0
+        with crud.unit_of_work():
+            crud.release_generation_lease(task['id'], task['lease_owner'])
+            if task['max_attempts'] is not None and attempts >= task['max_attempts']:
+                crud.update_task_status(task['id'], 'ERROR')
+                job_queue.dead_letter_task_job(
+                    IMAGE_GENERATION_JOB, task['id'], f"Gave up after {attempts} generation attempts"
+                )
+                result['failed'] += 1
+            else:
+                job_queue.reschedule_task_job(IMAGE_GENERATION_JOB, task['id'], job_queue.retry_delay(attempts))
+                result['requeued'] += 1
+    if result['requeued'] or result['failed']:
+        logger.warning(f"Recovered stuck generations: {result['requeued']} requeued, {result['failed']} failed")
+    return result
+
+
+def _read_prompt(path, fallback):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return fallback
+
+def _generate_listing(task, spec_sheet_prompt, name_tag_prompt, model):
+    """Generate one task's spec sheet, name and tags from its first uploaded image. Runs in a worker thread."""
+    image_paths = [path for path in (task.get('uploaded_image_paths') or '').split(',') if path]
+    if not image_paths or not os.path.exists(image_paths[0]):
+        raise RuntimeError("Task has no uploaded image on disk")
+    return ai_services.generate_product_listing(
+        spec_sheet_prompt, name_tag_prompt, task_id=task['id'], model=model, image_path=image_paths[0]
+    )
+
+# --- Listing Jobs ---
+# Handlers for the text stages of app.core.pipeline.
+LISTING_JOB = "generate_listing"
+NAME_TAGS_JOB = "generate_name_tags"
+LISTING_MODEL = "gpt-4o"
+NAME_TAGS_MODEL = "gpt-4o-mini"
+
+def run_listing_job(job, worker_id):
+    """Worker handler for LISTING_JOB: spec sheet, name and tags for a NEW task, which then awaits approval."""
+    task = crud.get_task_by_id(job['task_id'])
+    if not task or task['status'] != 'NEW':
+        logger.info(f"Skipping listing job {job['id']}: task {job['task_id']} is no longer new")
+        return
+    spec_sheet_prompt = _read_prompt(DEFAULT_SPEC_SHEET_PROMPT, BULK_SPEC_SHEET_PROMPT)
+    name_tag_prompt = _read_prompt(DEFAULT_NAME_TAG_PROMPT, BULK_NAME_TAG_PROMPT)
+    listing = _generate_listing(task, spec_sheet_prompt, name_tag_prompt, LISTING_MODEL)
+    if not crud.save_product_listing(task['id'], listing['spec_sheet'], listing['product_name'], listing['tags']):
+        logger.info(f"Discarding listing job {job['id']}: task {job['task_id']} got a spec sheet elsewhere")
+
+def prepare_spec_sheet_tasks(task_ids):
+    """
+    Pick the tasks among `task_ids` that can get a spec sheet: they have images but no spec sheet.
+
+    Spec sheets are only saved for NEW tasks, so one whose earlier attempt ended
+    in ERROR goes back to NEW.
+
+    Returns:
+        The eligible task dicts, with 'id' and 'uploaded_image_paths'.
+    """
+    with crud.unit_of_work():
+        tasks = crud.get_tasks_by_ids(task_ids, columns=['id', 'status', 'uploaded_image_paths', 'spec_sheet_text'])
+        eligible = [
+            task for task in tasks
+            if task['status'] in ('NEW', 'ERROR') and task.get('uploaded_image_paths') and not task.get('spec_sheet_text')
+        ]
+        for task in eligible:
+            if task['status'] == 'ERROR':
+                crud.update_task_status(task['id'], 'NEW')
+    return eligible
+
+def queue_spec_sheets(task_ids):
+    """
+    Queue spec sheet, name and tag generation for the eligible tasks among `task_ids`.
+
+    The pipeline workers (`python -m app.worker`) do the generation; without a
+    running worker the jobs wait. See bulk_generate_spec_sheets() for generating
+    in the calling process instead.
+
+    Returns:
+        Number of jobs queued; tasks that already have one pending are skipped.
+    """
+    with crud.unit_of_work():
+        tasks = prepare_spec_sheet_tasks(task_ids)
+        return job_queue.enqueue_many(
+            LISTING_JOB, [task['id'] for task in tasks],
+            max_attempts=PIPELINE_STAGE_SETTINGS['spec_sheet']['max_attempts'],
+        )
+
+def on_listing_dead(job):
+    """Called when a listing job runs out of attempts: flag its task for attention."""
+    task = crud.get_task_by_id(job['task_id'])
+    if task and task['status'] == 'NEW':
+        crud.update_task_status(task['id'], 'ERROR')
+
+def run_name_tags_job(job, worker_id):
+    """Worker handler for NAME_TAGS_JOB: name and tag a task whose spec sheet came without them."""
+    task = crud.get_task_by_id(job['task_id'])
+    if not task or task.get('product_name') or not task.get('spec_sheet_text'):
+        return
+    name_tag_prompt = _read_prompt(DEFAULT_NAME_TAG_PROMPT, BULK_NAME_TAG_PROMPT)
+    result = ai_services.generate_name_and_tags(task['spec_sheet_text'], name_tag_prompt, task_id=task['id'], model=NAME_TAGS_MODEL)
+    crud.update_task_with_ai_data(task['id'], result['product_name'], result['tags'])
+
+def bulk_generate_spec_sheets(tasks, spec_sheet_prompt=None, name_tag_prompt=None, model="gpt-4o",
+                              max_workers=BULK_GENERATION_WORKERS, on_progress=None):
+    """
+    Generate spec sheets, product names and tags for many tasks, running up to `max_workers` AI requests at once.
+
+    Each task takes one structured-output call (ai_services.generate_product_listing)
+    and its result is saved through crud as soon as it finishes, so a failure or an
+    interrupted run keeps everything completed so far. Database writes happen in the
+    calling thread; only the AI requests run in the pool. As with listing jobs, a
+    result is only saved while its task is still NEW.
+
+    Args:
+        tasks: Task dicts with at least 'id' and 'uploaded_image_paths'.
+        spec_sheet_prompt, name_tag_prompt: Instructions; default to the configured SOP prompt files.
+        on_progress: Optional callable(done, total, task_id, error) called in the
+            calling thread after each task finishes; error is None on success.
+
+    Returns:
+        Dict with 'succeeded' (list of task ids), 'skipped' (task ids that got a
+        spec sheet elsewhere meanwhile) and 'errors' (task id -> message).
+    """
+    spec_sheet_prompt = spec_sheet_prompt or _read_prompt(DEFAULT_SPEC_SHEET_PROMPT, BULK_SPEC_SHEET_PROMPT)
+    name_tag_prompt = name_tag_prompt or _read_prompt(DEFAULT_NAME_TAG_PROMPT, BULK_NAME_TAG_PROMPT)
+    tasks = list(tasks)
+    result = {'succeeded': [], 'skipped': [], 'errors': {}}
+    if not tasks:
+        return result
 
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks))),
+                            thread_name_prefix="spec-sheet") as executor:
+        futures = {
+            executor.submit(_generate_listing, task, spec_sheet_prompt, name_tag_prompt, model): task['id']
+            for task in tasks
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            task_id = futures[future]
+            error = None
+            try:
+                listing = future.result()
+                if crud.save_product_listing(task_id, listing['spec_sheet'], listing['product_name'], listing['tags']):
+                    result['succeeded'].append(task_id)
+                else:
+                    result['skipped'].append(task_id)
+            except Exception as e:
+                error = str(e)
+                result['errors'][task_id] = error
+                logger.error(f"Error generating spec sheet for task {task_id}: {e}")
+            if on_progress:
+                on_progress(done, len(tasks), task_id, error)
+    return result
@@ -0,0 +1,2 @@
+# Database package initialization
+from .migrations import init_db
@@ -2,165 +2,874 @@
 import sqlite3
 import os
 import json
-from .models import create_connection
+import threading
+import time
+from contextlib import contextmanager
+from app import image_store
+from . import models
+from . import spec_storage
+from .models import get_connection
+
+# --- Unit of Work ---
+class UnitOfWork:
+    """A write transaction on the calling thread's shared connection."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._after_commit = []
+
+    def after_commit(self, callback):
+        """Call `callback()` once the outermost transaction has committed; a rollback discards it."""
+        self._after_commit.append(callback)
+
+    def execute(self, sql, params=()):
+        return self.conn.execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.conn.executemany(sql, seq_of_params)
+
+_uow_state = threading.local()
+
+@contextmanager
+def unit_of_work():
+    """
+    Run a group of crud calls as one atomic transaction.
+
+    The transaction starts with BEGIN IMMEDIATE, so it holds the write lock from
+    the first statement and concurrent sessions queue behind it instead of
+    interleaving. Nested unit_of_work() blocks, including the ones inside other
+    crud functions, join the outermost transaction, which commits once on exit
+    and rolls back if anything raises:
+
+        with crud.unit_of_work():
+            crud.add_initial_spec_sheet(task_id, spec_text)
+            crud.update_task_with_ai_data(task_id, name, tags)
+    """
+    current = getattr(_uow_state, 'current', None)
+    if current is not None:
+        yield current
+        return
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    uow = UnitOfWork(conn)
+    _uow_state.current = uow
+    try:
+        yield uow
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        _uow_state.current = None
+    for callback in uow._after_commit:
+        callback()
 
 # --- Task Functions ---
 def create_task(product_code, uploaded_image_paths, batch_id):
-    conn = create_connection()
-    if conn is None: return None
     paths_str = ",".join(uploaded_image_paths)
     sql = ''' INSERT INTO tasks(product_code, uploaded_image_paths, status, batch_id) VALUES(?,?,?,?) '''
-    try:
-        cur = conn.cursor()
-        cur.execute(sql, (product_code, paths_str, 'NEW', batch_id))
-        conn.commit()
-        return cur.lastrowid
-    finally:
-        conn.close()
+    with unit_of_work() as uow:
+        cur = uow.execute(sql, (product_code, paths_str, 'NEW', batch_id))
+    return cur.lastrowid
+
+def create_tasks_bulk(tasks):
+    """
+    Create many tasks in a single transaction.
+
+    Args:
+        tasks: Iterable of (product_code, uploaded_image_paths, batch_id) tuples.
+
+    Returns:
+        List of the new task ids, in input order.
+    """
+    rows = [(product_code, ",".join(paths), 'NEW', batch_id) for product_code, paths, batch_id in tasks]
+    if not rows:
+        return []
+    sql = ''' INSERT INTO tasks(product_code, uploaded_image_paths, status, batch_id) VALUES(?,?,?,?) '''
+    with unit_of_work() as uow:
+        uow.executemany(sql, rows)
+        # The transaction holds the write lock, so AUTOINCREMENT hands out consecutive ids.
+        last_id = uow.execute("SELECT last_insert_rowid()").fetchone()[0]
+    return list(range(last_id - len(rows) + 1, last_id + 1))
 
 def update_task_status(task_id, new_status):
-    conn = create_connection()
-    if conn is None: return False
     sql = ''' UPDATE tasks SET status = ? WHERE id = ?'''
-    try:
-        cur = conn.cursor()
-        cur.execute(sql, (new_status, task_id))
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+    with unit_of_work() as uow:
+        uow.execute(sql, (new_status, task_id))
+    return True
+
+def update_status_many(task_ids, new_status):
+    """Set the status of every task in `task_ids` in one statement. Returns the number of tasks updated."""
+    if not task_ids:
+        return 0
+    sql = ''' UPDATE tasks SET status = ? WHERE id IN (SELECT value FROM json_each(?))'''
+    with unit_of_work() as uow:
+        cur = uow.execute(sql, (new_status, json.dumps(list(task_ids))))
+    return cur.rowcount
+
+def update_priority_many(task_ids, priority):
+    """Set the scheduling priority of every task in `task_ids`. Returns the number of tasks updated."""
+    if not task_ids:
+        return 0
+    sql = ''' UPDATE tasks SET priority = ? WHERE id IN (SELECT value FROM json_each(?))'''
+    with unit_of_work() as uow:
+        cur = uow.execute(sql, (int(priority), json.dumps(list(task_ids))))
+    return cur.rowcount
 
 def get_task_by_id(task_id):
-    conn = create_connection()
-    if conn is None: return None
-    try:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM tasks WHERE id=?", (task_id,))
-        task = cur.fetchone()
-        return dict(task) if task else None
-    finally:
-        conn.close()
+    conn = get_connection()
+    task = conn.execute("SELECT * FROM tasks WHERE id=?", (task_id,)).fetchone()
+    return dict(task) if task else None
+
+def get_tasks_by_ids(task_ids, columns=None):
+    """
+    Fetch several tasks in one query.
+
+    The ids are bound as a single JSON array, so there is no limit on how many
+    can be requested. Missing ids are skipped; the rest keep their input order.
+    """
+    if not task_ids:
+        return []
+    columns = list(columns or TASK_COLUMNS)
+    unknown = set(columns) - set(TASK_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown task columns: {', '.join(sorted(unknown))}")
+    if 'id' not in columns:
+        columns.append('id')
+    task_ids = list(task_ids)
+    conn = get_connection()
+    rows = conn.execute(
+        f"SELECT {', '.join(columns)} FROM tasks WHERE id IN (SELECT value FROM json_each(?))",
+        (json.dumps(task_ids),),
+    ).fetchall()
+    tasks_by_id = {row['id']: dict(row) for row in rows}
+    return [tasks_by_id[task_id] for task_id in task_ids if task_id in tasks_by_id]
 
 def get_all_tasks():
-    conn = create_connection()
-    if conn is None: return []
-    try:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM tasks ORDER BY created_at DESC")
-        rows = cur.fetchall()
-        return [dict(row) for row in rows]
-    finally:
-        conn.close()
+    conn = get_connection()
+    rows = conn.execute("SELECT * FROM tasks ORDER BY created_at DESC").fetchall()
+    return [dict(row) for row in rows]
+
+# Columns callers may request from query_tasks(); id and created_at are always
+# included because they form the pagination cursor.
+TASK_COLUMNS = (
+    'id', 'product_code', 'status', 'uploaded_image_paths', 'spec_sheet_text',
+    'final_prompt', 'generated_image_path', 'redo_prompt', 'created_at',
+    'product_name', 'product_tags', 'batch_id',
+)
+
+def parse_tag_label(label):
+    """Split a "Key: Value" tag label, as shown in the dashboard, into (key, value)."""
+    key, _, value = label.partition(':')
+    return key.strip(), value.strip()
+
+def _task_filters(status=None, tags=None, batch_id=None, search=None):
+    """Build the WHERE clauses and parameters shared by query_tasks() and count_tasks()."""
+    clauses, params = [], []
+    if status:
+        statuses = [status] if isinstance(status, str) else list(status)
+        clauses.append(f"status IN ({','.join('?' for _ in statuses)})")
+        params.extend(statuses)
+    if batch_id:
+        clauses.append("batch_id = ?")
+        params.append(batch_id)
+    if search:
+        match_query = build_match_query(search)
+        if match_query:
+            clauses.append("id IN (SELECT rowid FROM tasks_fts WHERE tasks_fts MATCH ?)")
+            params.append(match_query)
+    if tags:
+        subquery, tag_params = _tag_match_subquery(tags)
+        clauses.append(f"id IN ({subquery})")
+        params.extend(tag_params)
+    return clauses, params
+
+def query_tasks(status=None, tags=None, batch_id=None, search=None, after_cursor=None, limit=50, columns=None):
+    """
+    Fetch one page of tasks, newest first, with all filtering done in SQL.
+
+    Args:
+        status: A status string or a list of statuses to match.
+        tags: "Key: Value" labels or (key, value) pairs; a task must carry all of them.
+        batch_id: Only return tasks from this batch.
+        search: Free text matched against the full-text index; see search_tasks().
+        after_cursor: The cursor returned with the previous page, or None for the first page.
+        limit: Maximum number of tasks to return.
+        columns: Task columns to select; defaults to all of them.
+
+    Returns:
+        Tuple of (tasks, next_cursor). next_cursor is None on the last page.
+    """
+    columns = list(columns or TASK_COLUMNS)
+    unknown = set(columns) - set(TASK_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown task columns: {', '.join(sorted(unknown))}")
+    for required in ('id', 'created_at'):
+        if required not in columns:
+            columns.append(required)
+
+    clauses, params = _task_filters(status, tags, batch_id, search)
+    if after_cursor:
+        clauses.append("(created_at, id) < (?, ?)")
+        params.extend(after_cursor)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    sql = f"SELECT {', '.join(columns)} FROM tasks {where} ORDER BY created_at DESC, id DESC LIMIT ?"
+
+    conn = get_connection()
+    # Fetch one extra row to learn whether another page follows.
+    rows = conn.execute(sql, params + [limit + 1]).fetchall()
+    tasks = [dict(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = (tasks[-1]['created_at'], tasks[-1]['id'])
+    return tasks, next_cursor
+
+def count_tasks(status=None, tags=None, batch_id=None, search=None):
+    """Count the tasks matching the same filters as query_tasks()."""
+    clauses, params = _task_filters(status, tags, batch_id, search)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    conn = get_connection()
+    return conn.execute(f"SELECT COUNT(*) FROM tasks {where}", params).fetchone()[0]
+
+def get_status_counts():
+    """
+    Return a dict mapping each status to its number of tasks.
+
+    Reads the trigger-maintained task_status_counts table, so the cost depends on
+    the number of statuses rather than the number of tasks.
+    """
+    conn = get_connection()
+    rows = conn.execute("SELECT status, count FROM task_status_counts WHERE count > 0").fetchall()
+    return {row['status']: row['count'] for row in rows}
+
+def recount_status_counts():
+    """Rebuild task_status_counts from a GROUP BY over tasks and return the fresh counts."""
+    with unit_of_work() as uow:
+        for statement in models.TASK_STATUS_COUNTS_REBUILD:
+            uow.execute(statement)
+    return get_status_counts()
+
+# --- Search Functions ---
+def build_match_query(text):
+    """
+    Turn free text typed by a user into a safe FTS5 MATCH expression.
+
+    Every whitespace-separated term becomes a quoted prefix query and all terms
+    must match, so punctuation in SKUs such as "TS-1042" cannot break the syntax.
+    """
+    terms = [term.replace('"', '""') for term in text.split()]
+    return " ".join(f'"{term}"*' for term in terms if term.strip('"'))
+
+def search_tasks(query, limit=20):
+    """
+    Full-text search over product codes, names and spec sheets, best matches first.
+
+    Returns:
+        List of dicts with the task's id, product_code, product_name, status,
+        created_at, its bm25 `rank` (lower is better) and a `snippet` of the best
+        matching column with the matched terms wrapped in ** for Markdown.
+    """
+    match_query = build_match_query(query or "")
+    if not match_query:
+        return []
+    conn = get_connection()
+    rows = conn.execute(
+        '''SELECT tasks.id, tasks.product_code, tasks.product_name, tasks.status, tasks.created_at,
+                  bm25(tasks_fts, 10.0, 5.0, 1.0, 1.0) AS rank,
+                  snippet(tasks_fts, -1, '**', '**', '…', 12) AS snippet
+           FROM tasks_fts JOIN tasks ON tasks.id = tasks_fts.rowid
+           WHERE tasks_fts MATCH ?
+           ORDER BY rank
+           LIMIT ?''',
+        (match_query, limit),
+    ).fetchall()
+    return [dict(row) for row in rows]
 
 def delete_tasks_by_ids(task_ids: list):
-    conn = create_connection()
-    if conn is None or not task_ids: return False
-    for task_id in task_ids:
-        task = get_task_by_id(task_id)
-        if task:
-            if task.get('uploaded_image_paths'):
-                for path in task['uploaded_image_paths'].split(','):
-                    if os.path.exists(path): os.remove(path)
-            if task.get('generated_image_path'):
-                if os.path.exists(task['generated_image_path']): os.remove(task['generated_image_path'])
-    try:
-        cur = conn.cursor()
-        placeholders = ','.join('?' for _ in task_ids)
-        cur.execute(f'DELETE FROM spec_sheet_versions WHERE task_id IN ({placeholders})', task_ids)
-        cur.execute(f'DELETE FROM tasks WHERE id IN ({placeholders})', task_ids)
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+    if not task_ids: return False
+    tasks = get_tasks_by_ids(task_ids, columns=['id', 'uploaded_image_paths', 'generated_image_path'])
+    paths = set()
+    for task in tasks:
+        paths.update(path for path in (task.get('uploaded_image_paths') or '').split(',') if path)
+        if task.get('generated_image_path'):
+            paths.add(task['generated_image_path'])
+    placeholders = ','.join('?' for _ in task_ids)
+    with unit_of_work() as uow:
+        # Dropping the task_images rows releases each image's reference; files
+        # still used by other tasks are kept by purge_unreferenced_images().
+        uow.execute(f'DELETE FROM task_images WHERE task_id IN ({placeholders})', task_ids)
+        uow.execute(f'DELETE FROM task_tags WHERE task_id IN ({placeholders})', task_ids)
+        uow.execute(f'DELETE FROM spec_sheet_versions WHERE task_id IN ({placeholders})', task_ids)
+        uow.execute(f'DELETE FROM tasks WHERE id IN ({placeholders})', task_ids)
+        # Files the image store does not manage (saved before it existed) are removed directly.
+        blob_paths = {row['path'] for row in uow.execute(
+            "SELECT path FROM image_blobs WHERE path IN (SELECT value FROM json_each(?))", (json.dumps(sorted(paths)),)
+        )}
+        # Only remove files once the rows referencing them are gone.
+        for path in paths - blob_paths:
+            uow.after_commit(lambda path=path: image_store.remove_file(path))
+    purge_unreferenced_images()
+    return True
 
 def update_task_with_ai_data(task_id, product_name, tags_dict):
-    conn = create_connection()
-    if conn is None: return False
     tags_str = json.dumps(tags_dict)
     sql = ''' UPDATE tasks SET product_name = ?, product_tags = ? WHERE id = ?'''
-    try:
-        cur = conn.cursor()
-        cur.execute(sql, (product_name, tags_str, task_id))
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+    with unit_of_work() as uow:
+        uow.execute(sql, (product_name, tags_str, task_id))
+        uow.execute("DELETE FROM task_tags WHERE task_id = ?", (task_id,))
+        uow.executemany(
+            "INSERT OR IGNORE INTO task_tags(task_id, key, value) VALUES(?,?,?)",
+            [(task_id, key, value) for key, value in normalize_tags(tags_dict)],
+        )
+    return True
+
+def save_product_listing(task_id, spec_sheet_text, product_name, tags_dict):
+    """
+    Store a generated spec sheet together with its product name and tags, in one transaction.
+
+    Only a task still in NEW takes the listing, so a spec sheet written
+    meanwhile (New Task, a retry, an edit) is never overwritten.
+
+    Returns:
+        True if the listing was saved, False if the task is gone or no longer NEW.
+    """
+    with unit_of_work():
+        if not add_initial_spec_sheet(task_id, spec_sheet_text, only_if_new=True):
+            return False
+        update_task_with_ai_data(task_id, product_name, tags_dict)
+    return True
 
 # --- Spec Sheet Version Functions ---
+# Versions are stored as snapshots and reverse deltas; see spec_storage.py.
+# Allocates the next version number inside the INSERT itself, so the number and
+# the row are written atomically.
+_INSERT_SPEC_VERSION_SQL = '''INSERT INTO spec_sheet_versions(task_id, version_number, author, storage, compressed, payload)
+    SELECT ?, COALESCE(MAX(version_number), 0) + 1, ?, ?, ?, ? FROM spec_sheet_versions WHERE task_id = ?'''
+_SPEC_VERSION_META_COLUMNS = "id, task_id, version_number, author, created_at, storage, length(payload) AS stored_bytes"
+
+def _latest_version_row(conn_or_uow, task_id):
+    return conn_or_uow.execute(
+        "SELECT id, version_number, author, created_at, storage, compressed, payload "
+        "FROM spec_sheet_versions WHERE task_id = ? ORDER BY version_number DESC LIMIT 1",
+        (task_id,),
+    ).fetchone()
+
 def create_spec_sheet_version(task_id, spec_text, author="AI"):
-    conn = create_connection()
-    if conn is None: return None
-    cur = conn.cursor()
-    cur.execute("SELECT MAX(version_number) FROM spec_sheet_versions WHERE task_id = ?", (task_id,))
-    max_version = cur.fetchone()[0]
-    next_version = 1 if max_version is None else max_version + 1
-    sql = '''INSERT INTO spec_sheet_versions(task_id, version_number, spec_text, author) VALUES(?,?,?,?)'''
-    try:
-        cur.execute(sql, (task_id, next_version, spec_text, author))
-        conn.commit()
-        return cur.lastrowid
-    finally:
-        conn.close()
+    with unit_of_work() as uow:
+        previous = _latest_version_row(uow, task_id)
+        storage, payload, compressed = spec_storage.encode_full(spec_text)
+        cur = uow.execute(_INSERT_SPEC_VERSION_SQL, (task_id, author, storage, compressed, payload, task_id))
+        uow.execute("UPDATE tasks_fts SET latest_spec = ? WHERE rowid = ?", (spec_text, task_id))
+        # The previous latest version becomes a delta against the new one,
+        # unless it is one of the periodic snapshots.
+        if previous is not None and not spec_storage.is_snapshot_version(previous['version_number']):
+            previous_text = spec_storage.decode(previous['storage'], previous['payload'], previous['compressed'])
+            storage, payload, compressed = spec_storage.encode_delta(spec_text, previous_text)
+            uow.execute(
+                "UPDATE spec_sheet_versions SET storage = ?, compressed = ?, payload = ? WHERE id = ?",
+                (storage, compressed, payload, previous['id']),
+            )
+    return cur.lastrowid
+
+def get_latest_spec_version(task_id):
+    """Return the newest spec sheet version of a task, decoded from a single row, or None."""
+    row = _latest_version_row(get_connection(), task_id)
+    if row is None:
+        return None
+    version = {key: row[key] for key in ('id', 'version_number', 'author', 'created_at')}
+    version['task_id'] = task_id
+    version['spec_text'] = spec_storage.decode(row['storage'], row['payload'], row['compressed'])
+    return version
+
+def list_spec_versions(task_id):
+    """Return version metadata (number, author, date, storage size) without decoding any text, newest first."""
+    conn = get_connection()
+    rows = conn.execute(
+        f"SELECT {_SPEC_VERSION_META_COLUMNS} FROM spec_sheet_versions WHERE task_id = ? ORDER BY version_number DESC",
+        (task_id,),
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+def _materialize_versions(rows):
+    """Decode rows ordered newest first, each delta against the row before it."""
+    versions = []
+    newer_text = None
+    for row in rows:
+        text = spec_storage.decode(row['storage'], row['payload'], row['compressed'], base_text=newer_text)
+        version = {key: row[key] for key in ('id', 'task_id', 'version_number', 'author', 'created_at')}
+        version['spec_text'] = text
+        versions.append(version)
+        newer_text = text
+    return versions
+
+def get_spec_version(task_id, version_number):
+    """
+    Return one spec sheet version with its text, or None.
+
+    Only the rows between the requested version and the nearest newer snapshot
+    are read and decoded.
+    """
+    conn = get_connection()
+    rows = conn.execute(
+        '''SELECT id, task_id, version_number, author, created_at, storage, compressed, payload
+           FROM spec_sheet_versions
+           WHERE task_id = ? AND version_number >= ?
+             AND version_number <= (SELECT MIN(version_number) FROM spec_sheet_versions
+                                    WHERE task_id = ? AND version_number >= ? AND storage = ?)
+           ORDER BY version_number DESC''',
+        (task_id, version_number, task_id, version_number, spec_storage.STORAGE_FULL),
+    ).fetchall()
+    if not rows or rows[-1]['version_number'] != version_number:
+        return None
+    return _materialize_versions(rows)[-1]
 
 def get_spec_sheet_versions(task_id):
-    conn = create_connection()
-    if conn is None: return []
-    try:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM spec_sheet_versions WHERE task_id = ? ORDER BY version_number ASC", (task_id,))
-        rows = cur.fetchall()
-        return [dict(row) for row in rows]
-    finally:
-        conn.close()
+    """Return every version of a task's spec sheet with its text, oldest first."""
+    conn = get_connection()
+    rows = conn.execute(
+        "SELECT id, task_id, version_number, author, created_at, storage, compressed, payload "
+        "FROM spec_sheet_versions WHERE task_id = ? ORDER BY version_number DESC",
+        (task_id,),
+    ).fetchall()
+    return list(reversed(_materialize_versions(rows)))
+
+def add_initial_spec_sheet(task_id, spec_sheet_text, only_if_new=False):
+    """
+    Store a generated spec sheet as a new version and move the task to PENDING_APPROVAL.
+
+    Args:
+        only_if_new: Write nothing unless the task is still NEW, checked in the
+            same transaction, so a spec sheet saved meanwhile by a pipeline worker
+            or another session is never overwritten.
 
-def add_initial_spec_sheet(task_id, spec_sheet_text):
-    create_spec_sheet_version(task_id, spec_sheet_text, author="AI")
-    conn = create_connection()
-    if conn is None: return False
+    Returns:
+        True if the spec sheet was saved.
+    """
     sql = ''' UPDATE tasks SET spec_sheet_text = ?, status = ? WHERE id = ?'''
-    try:
-        cur = conn.cursor()
-        cur.execute(sql, (spec_sheet_text, 'PENDING_APPROVAL', task_id))
-        conn.commit()
-        return True
-    finally:
-        conn.close()
+    with unit_of_work() as uow:
+        if only_if_new and not uow.execute("SELECT 1 FROM tasks WHERE id = ? AND status = 'NEW'", (task_id,)).fetchone():
+            return False
+        create_spec_sheet_version(task_id, spec_sheet_text, author="AI")
+        uow.execute(sql, (spec_sheet_text, 'PENDING_APPROVAL', task_id))
+    return True
+
+def add_spec_sheets_bulk(spec_sheets, author="AI"):
+    """
+    Store generated spec sheets for many tasks in a single transaction.
+
+    Each task gets a new spec sheet version and moves to PENDING_APPROVAL, as in
+    add_initial_spec_sheet().
+
+    Args:
+        spec_sheets: Dict mapping task id to spec sheet text.
+    """
+    if not spec_sheets:
+        return 0
+    items = list(spec_sheets.items())
+    with unit_of_work() as uow:
+        for task_id, text in items:
+            create_spec_sheet_version(task_id, text, author=author)
+        uow.executemany(
+            ''' UPDATE tasks SET spec_sheet_text = ?, status = ? WHERE id = ?''',
+            [(text, 'PENDING_APPROVAL', task_id) for task_id, text in items],
+        )
+    return len(items)
 
 def save_spec_sheet_edit(task_id, edited_spec_text):
-    versions = get_spec_sheet_versions(task_id)
-    latest_version_text = versions[-1]['spec_text'] if versions else ""
-    if edited_spec_text != latest_version_text:
-        create_spec_sheet_version(task_id, edited_spec_text, author="USER")
-    conn = create_connection()
-    if conn is None: return False
     sql = ''' UPDATE tasks SET spec_sheet_text = ? WHERE id = ?'''
-    try:
-        cur = conn.cursor()
-        cur.execute(sql, (edited_spec_text, task_id))
-        conn.commit()
-        print(f"Saved edits for task {task_id}.")
-        return True
-    finally:
-        conn.close()
+    with unit_of_work() as uow:
+        latest = get_latest_spec_version(task_id)
+        latest_version_text = latest['spec_text'] if latest else ""
+        if edited_spec_text != latest_version_text:
+            create_spec_sheet_version(task_id, edited_spec_text, author="USER")
+        uow.execute(sql, (edited_spec_text, task_id))
+    print(f"Saved edits for task {task_id}.")
+    return True
 
 def approve_spec_sheet(task_id, final_spec_text):
-    save_spec_sheet_edit(task_id, final_spec_text)
-    return update_task_status(task_id, 'APPROVED')
+    with unit_of_work():
+        save_spec_sheet_edit(task_id, final_spec_text)
+        return update_task_status(task_id, 'APPROVED')
 
 def add_generated_image_to_task(task_id, final_prompt, generated_image_path, redo_prompt=""):
-    conn = create_connection()
-    if conn is None: return False
-    sql = ''' UPDATE tasks SET final_prompt = ?, generated_image_path = ?, redo_prompt = ?, status = ? WHERE id = ?'''
+    # Move the new image into the content-addressed store; a replaced image is
+    # released and purged once nothing references it.
+    stored = None
+    if generated_image_path and os.path.isfile(generated_image_path):
+        stored = image_store.store_file(generated_image_path, move=True)
+    sql = ''' UPDATE tasks SET final_prompt = ?, generated_image_path = ?, redo_prompt = ?, status = ?,
+              lease_owner = NULL, lease_expires_at = NULL WHERE id = ?'''
+    with unit_of_work() as uow:
+        if stored:
+            stored = _register_images(uow, [stored])[0]
+            generated_image_path = stored.path
+        if uow.execute("SELECT 1 FROM tasks WHERE id = ?", (task_id,)).fetchone() is None:
+            # Deleted while generating: the image stays unreferenced, so a later purge removes it.
+            return False
+        if stored:
+            set_task_images(task_id, [stored], role='generated')
+        uow.execute(sql, (final_prompt, generated_image_path, redo_prompt, 'PENDING_IMAGE_REVIEW', task_id))
+    purge_unreferenced_images()
+    return True
+
+# --- Generation Lease Functions ---
+# A task being generated is leased to one worker (lease_owner, lease_expires_at
+# as Unix epoch seconds). An expired lease means the worker died mid-generation.
+def acquire_generation_lease(task_id, owner, lease_seconds):
+    """
+    Lease a GENERATING task to `owner`.
+
+    Attempts are counted on the task's job (jobs.attempts), not here.
+
+    Returns:
+        False if the task is not GENERATING or another owner holds an unexpired lease.
+    """
+    now = time.time()
+    with unit_of_work() as uow:
+        cur = uow.execute(
+            """UPDATE tasks SET lease_owner = ?, lease_expires_at = ?
+               WHERE id = ? AND status = 'GENERATING'
+                 AND (lease_owner IS NULL OR lease_owner = ? OR lease_expires_at < ?)""",
+            (owner, now + lease_seconds, task_id, owner, now),
+        )
+    return cur.rowcount == 1
+
+def renew_generation_lease(task_id, owner, lease_seconds):
+    """Extend `owner`'s lease on a task. Returns False if it no longer holds it."""
+    with unit_of_work() as uow:
+        cur = uow.execute(
+            "UPDATE tasks SET lease_expires_at = ? WHERE id = ? AND lease_owner = ?",
+            (time.time() + lease_seconds, task_id, owner),
+        )
+    return cur.rowcount == 1
+
+def release_generation_lease(task_id, owner=None):
+    """Clear a task's lease; with `owner`, only if that owner still holds it."""
+    sql = "UPDATE tasks SET lease_owner = NULL, lease_expires_at = NULL WHERE id = ?"
+    params = [task_id]
+    if owner is not None:
+        sql += " AND lease_owner = ?"
+        params.append(owner)
+    with unit_of_work() as uow:
+        uow.execute(sql, params)
+    return True
+
+def get_stuck_generating_tasks(job_kind, limit=100):
+    """
+    Return GENERATING tasks that nothing is working on.
+
+    That is tasks whose lease has expired, and unleased tasks without an
+    unfinished `job_kind` job (left over from a crash, or from before the job queue).
+    Each comes with its unfinished job's 'attempts' and 'max_attempts', or None
+    for both when it has no such job.
+    """
+    conn = get_connection()
+    rows = conn.execute(
+        """SELECT tasks.id, tasks.lease_owner, jobs.attempts, jobs.max_attempts
+           FROM tasks LEFT JOIN jobs ON jobs.task_id = tasks.id AND jobs.kind = ?
+                                    AND jobs.status IN ('queued', 'running')
+           WHERE tasks.status = 'GENERATING'
+             AND (tasks.lease_expires_at < ? OR (tasks.lease_owner IS NULL AND jobs.id IS NULL))
+           LIMIT ?""",
+        (job_kind, time.time(), limit),
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+# --- Task Event Functions ---
+# task_events is written by triggers on tasks (see models.TASK_EVENT_TRIGGERS);
+# these add worker events and read the log for app/core/progress.py.
+def record_task_event(task_id, event_type, message=None):
+    """Append an event for a task, tagged with the task's batch."""
+    with unit_of_work() as uow:
+        uow.execute(
+            "INSERT INTO task_events (task_id, batch_id, event_type, message) "
+            "VALUES (?, (SELECT batch_id FROM tasks WHERE id = ?), ?, ?)",
+            (task_id, task_id, event_type, message),
+        )
+    return True
+
+def get_task_events(after_id=0, limit=500):
+    """Return up to `limit` events with an id above `after_id`, oldest first."""
+    conn = get_connection()
+    rows = conn.execute(
+        "SELECT * FROM task_events WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+def get_batch_progress_snapshot(pending_statuses, batch_ids=None, completions_since=0):
+    """
+    Read the starting point for following batch progress through task_events.
+
+    Everything is read in one transaction, so applying the events after
+    'last_event_id' to the counts reproduces the live state exactly.
+
+    Args:
+        pending_statuses: Statuses that mean work is still to be done.
+        batch_ids: Batches to read, '' for tasks without a batch; defaults to every
+            batch with a task in a pending status.
+        completions_since: Epoch seconds from which to return completion times.
+
+    Returns:
+        Dict with 'last_event_id', 'counts' (batch -> status -> count) and
+        'completions' (batch -> list of epoch seconds a task left a pending status).
+    """
+    conn = get_connection()
+    statuses_json = json.dumps(list(pending_statuses))
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        conn.execute("BEGIN")
     try:
-        cur = conn.cursor()
-        cur.execute(sql, (final_prompt, generated_image_path, redo_prompt, 'PENDING_IMAGE_REVIEW', task_id))
-        conn.commit()
-        return True
+        last_event_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM task_events").fetchone()[0]
+        if batch_ids is None:
+            batch_ids = [row[0] for row in conn.execute(
+                "SELECT DISTINCT COALESCE(batch_id, '') FROM tasks WHERE status IN (SELECT value FROM json_each(?))",
+                (statuses_json,),
+            )]
+        batches_json = json.dumps(list(batch_ids))
+        counts = {batch_id: {} for batch_id in batch_ids}
+        for row in conn.execute(
+            """SELECT COALESCE(batch_id, '') AS batch_key, status, COUNT(*) AS count FROM tasks
+               WHERE batch_id IN (SELECT value FROM json_each(?))
+                  OR (batch_id IS NULL AND '' IN (SELECT value FROM json_each(?)))
+               GROUP BY batch_key, status""",
+            (batches_json, batches_json),
+        ):
+            counts[row['batch_key']][row['status']] = row['count']
+        completions = {batch_id: [] for batch_id in batch_ids}
+        for row in conn.execute(
+            """SELECT COALESCE(batch_id, '') AS batch_key, created_at FROM task_events
+               WHERE created_at >= ? AND event_type = 'status'
+                 AND old_status IN (SELECT value FROM json_each(?))
+                 AND new_status NOT IN (SELECT value FROM json_each(?))
+                 AND COALESCE(batch_id, '') IN (SELECT value FROM json_each(?))
+               ORDER BY id""",
+            (completions_since, statuses_json, statuses_json, batches_json),
+        ):
+            completions[row['batch_key']].append(row['created_at'])
     finally:
-        conn.close()
+        if own_transaction:
+            conn.execute("COMMIT")
+    return {'last_event_id': last_event_id, 'counts': counts, 'completions': completions}
+
+def prune_task_events(older_than_seconds):
+    """Delete events older than `older_than_seconds`. Returns how many were removed."""
+    with unit_of_work() as uow:
+        cur = uow.execute("DELETE FROM task_events WHERE created_at < ?", (time.time() - older_than_seconds,))
+    return cur.rowcount
+
+# --- Image Functions ---
+def set_task_images(task_id, images, role='upload'):
+    """
+    Replace the images a task uses for one role ('upload' or 'generated').
+
+    Args:
+        images: StoredImage tuples from app.image_store, in display order.
+    """
+    with unit_of_work() as uow:
+        images = _register_images(uow, images)
+        uow.execute("DELETE FROM task_images WHERE task_id = ? AND role = ?", (task_id, role))
+        uow.executemany(
+            "INSERT INTO task_images (task_id, role, position, sha256) VALUES (?, ?, ?, ?)",
+            [(task_id, role, position, image.sha256) for position, image in enumerate(images)],
+        )
+        if role == 'upload':
+            uow.execute(
+                "UPDATE tasks SET uploaded_image_paths = ? WHERE id = ?",
+                (",".join(image.path for image in images), task_id),
+            )
+    purge_unreferenced_images()
+    return True
+
+def _register_images(uow, images):
+    """
+    Add images to image_blobs and return them with the path each is registered under.
+
+    Content already registered under another path (an earlier upload with a
+    different extension, or a file registered in place by migration 8) keeps that
+    path, and the new copy is removed once the transaction commits.
+    """
+    uow.executemany(
+        "INSERT OR IGNORE INTO image_blobs (sha256, path, size_bytes) VALUES (?, ?, ?)",
+        [(image.sha256, image.path, image.size_bytes) for image in images],
+    )
+    registered = []
+    for image in images:
+        path = uow.execute("SELECT path FROM image_blobs WHERE sha256 = ?", (image.sha256,)).fetchone()['path']
+        if path != image.path:
+            uow.after_commit(lambda copy=image.path: image_store.remove_file(copy))
+            image = image._replace(path=path)
+        registered.append(image)
+    return registered
+
+def get_task_image_paths(task_id, role='upload'):
+    """Return the stored file paths of a task's images for one role, in display order."""
+    conn = get_connection()
+    rows = conn.execute(
+        '''SELECT image_blobs.path FROM task_images JOIN image_blobs USING (sha256)
+           WHERE task_images.task_id = ? AND task_images.role = ? ORDER BY task_images.position''',
+        (task_id, role),
+    ).fetchall()
+    return [row['path'] for row in rows]
+
+def purge_unreferenced_images():
+    """
+    Delete stored images no task references any more, and their files.
+
+    Runs only outside a unit of work, so files are never removed before the
+    transaction that released them has committed. Recently written files are
+    left for a later purge, as another session may be about to attach them.
+
+    Returns:
+        Number of images removed.
+    """
+    if getattr(_uow_state, 'current', None) is not None:
+        return 0
+    with unit_of_work() as uow:
+        rows = uow.execute("SELECT sha256, path FROM image_blobs WHERE ref_count <= 0").fetchall()
+        expired = [row for row in rows if not image_store.is_recent(row['path'])]
+        uow.executemany(
+            "DELETE FROM image_blobs WHERE sha256 = ? AND ref_count <= 0",
+            [(row['sha256'],) for row in expired],
+        )
+    for row in expired:
+        image_store.remove_file(row['path'])
+    return len(expired)
+
+# --- Chat History Functions ---
+def get_chat_history(task_id, limit=None):
+    """
+    Return a task's chat turns as (user_message, ai_response) tuples, oldest first.
+
+    With `limit`, only the most recent `limit` turns are read, newest first from
+    the (task_id, timestamp) index.
+    """
+    conn = get_connection()
+    sql = "SELECT user_message, ai_response FROM chat_history WHERE task_id = ? ORDER BY timestamp DESC, id DESC"
+    params = [task_id]
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    rows = conn.execute(sql, params).fetchall()
+    return [(row['user_message'], row['ai_response']) for row in reversed(rows)]
+
+def count_chat_turns(task_id):
+    conn = get_connection()
+    return conn.execute("SELECT COUNT(*) FROM chat_history WHERE task_id = ?", (task_id,)).fetchone()[0]
+
+# --- Table Browser Functions ---
+# Tables the Database View can page through. All are rowid tables, which the
+# browser's cursor relies on.
+BROWSABLE_TABLES = ('tasks', 'spec_sheet_versions', 'chat_history', 'interactions')
+BROWSER_FILTER_OPERATORS = ('=', '!=', '<', '<=', '>', '>=', 'LIKE', 'IS NULL', 'IS NOT NULL')
+
+def _check_browsable(table_name):
+    if table_name not in BROWSABLE_TABLES:
+        raise ValueError(f"Table '{table_name}' cannot be browsed")
+
+def get_table_columns(table_name):
+    """Return (name, declared type) for every column of a browsable table."""
+    _check_browsable(table_name)
+    conn = get_connection()
+    return [(row['name'], row['type']) for row in conn.execute(f"PRAGMA table_info({table_name})")]
+
+def estimate_row_count(table_name):
+    """
+    Approximate a table's row count without scanning it.
+
+    Uses the statistics ANALYZE stores in sqlite_stat1 when they exist, and
+    otherwise the span of the table's rowids.
+
+    Returns:
+        Tuple of (row_count, source), where source is 'statistics' or 'rowid range'.
+    """
+    _check_browsable(table_name)
+    conn = get_connection()
+    try:
+        row = conn.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1", (table_name,)).fetchone()
+    except sqlite3.OperationalError:
+        # sqlite_stat1 only exists once ANALYZE has run.
+        row = None
+    if row and row['stat']:
+        return int(row['stat'].split()[0]), 'statistics'
+    row = conn.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {table_name}").fetchone()
+    if row[0] is None:
+        return 0, 'rowid range'
+    return row[1] - row[0] + 1, 'rowid range'
+
+def analyze_database():
+    """Refresh the query planner statistics that estimate_row_count() reads."""
+    conn = get_connection()
+    conn.execute("PRAGMA analysis_limit = 1000")
+    conn.execute("ANALYZE")
+    conn.commit()
+
+def _after_cursor_clause(order_by, descending, cursor):
+    """Keyset condition selecting rows after `cursor` in (order_by, rowid) order, NULLs first ascending."""
+    value, last_rowid = cursor
+    if order_by is None:
+        return ("rowid < ?" if descending else "rowid > ?"), [last_rowid]
+    if not descending:
+        if value is None:
+            return f"(({order_by} IS NULL AND rowid > ?) OR {order_by} IS NOT NULL)", [last_rowid]
+        return f"({order_by} > ? OR ({order_by} = ? AND rowid > ?))", [value, value, last_rowid]
+    if value is None:
+        return f"({order_by} IS NULL AND rowid < ?)", [last_rowid]
+    return f"({order_by} < ? OR ({order_by} = ? AND rowid < ?) OR {order_by} IS NULL)", [value, value, last_rowid]
+
+def fetch_table_page(table_name, columns=None, filters=None, order_by=None, descending=False, after_cursor=None, limit=100):
+    """
+    Fetch one page of raw rows from a table, for the Database View browser.
+
+    Args:
+        table_name: One of BROWSABLE_TABLES.
+        columns: Columns to select; defaults to all of them.
+        filters: List of (column, operator, value) conditions, ANDed together.
+            Operators come from BROWSER_FILTER_OPERATORS; values are bound as parameters.
+        order_by: Column to sort by; None pages in rowid order.
+        descending: Sort newest/largest first.
+        after_cursor: The cursor returned with the previous page, or None for the first page.
+        limit: Maximum number of rows to return.
+
+    Returns:
+        Tuple of (column_names, rows, next_cursor). Rows are plain tuples and
+        next_cursor is None on the last page.
+    """
+    known_columns = [name for name, _ in get_table_columns(table_name)]
+    columns = list(columns or known_columns)
+    for column in columns + [column for column, _, _ in filters or []] + ([order_by] if order_by else []):
+        if column not in known_columns:
+            raise ValueError(f"Unknown column '{column}' in table '{table_name}'")
+
+    clauses, params = [], []
+    for column, operator, value in filters or []:
+        if operator not in BROWSER_FILTER_OPERATORS:
+            raise ValueError(f"Unsupported filter operator '{operator}'")
+        if operator in ('IS NULL', 'IS NOT NULL'):
+            clauses.append(f"{column} {operator}")
+        else:
+            clauses.append(f"{column} {operator} ?")
+            params.append(value)
+    if after_cursor:
+        clause, cursor_params = _after_cursor_clause(order_by, descending, after_cursor)
+        clauses.append(clause)
+        params.extend(cursor_params)
+
+    direction = "DESC" if descending else "ASC"
+    order = f"{order_by} {direction}, rowid {direction}" if order_by else f"rowid {direction}"
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    select = ", ".join(columns + ([order_by] if order_by else []) + ["rowid"])
+    sql = f"SELECT {select} FROM {table_name} {where} ORDER BY {order} LIMIT ?"
+
+    conn = get_connection()
+    # Fetch one extra row to learn whether another page follows.
+    raw_rows = conn.execute(sql, params + [limit + 1]).fetchall()
+    page = raw_rows[:limit]
+    next_cursor = None
+    if len(raw_rows) > limit:
+        last = page[-1]
+        next_cursor = (last[len(columns)] if order_by else None, last[-1])
+    rows = [tuple(row)[:len(columns)] for row in page]
+    return columns, rows, next_cursor
 
 # --- Translation Cache Functions (REMOVED) ---
 # All translation-related functions have been removed:
@@ -169,16 +878,37 @@ def add_generated_image_to_task(task_id, final_prompt, generated_image_path, red
 # - purge_old_translations()
 # - get_all_unique_source_texts()
 
+# --- Tag Functions ---
+def normalize_tags(tags_dict):
+    """Turn a tags dict into the (key, value) rows stored in task_tags."""
+    rows = []
+    for key, value in (tags_dict or {}).items():
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            value = json.dumps(value, separators=(",", ":"))
+        rows.append((str(key).strip().lower(), value.strip()))
+    return rows
+
+def _tag_match_subquery(tags):
+    """Build a subquery selecting the ids of tasks that carry every tag in `tags`."""
+    selects, params = [], []
+    for tag in tags:
+        key, value = parse_tag_label(tag) if isinstance(tag, str) else tag
+        selects.append("SELECT task_id FROM task_tags WHERE key = ? AND value = ?")
+        params.extend([key.strip().lower(), value])
+    return " INTERSECT ".join(selects), params
+
+def get_task_ids_by_tags(tags):
+    """Return the ids of tasks that carry all of the given "Key: Value" labels or (key, value) pairs."""
+    if not tags:
+        return []
+    subquery, params = _tag_match_subquery(tags)
+    conn = get_connection()
+    return [row[0] for row in conn.execute(subquery, params).fetchall()]
+
 def get_all_unique_tags():
-    all_tasks = get_all_tasks()
-    unique_tags = set()
-    for task in all_tasks:
-        tags_str = task.get('product_tags')
-        if tags_str:
-            try:
-                tags_dict = json.loads(tags_str)
-                for key, value in tags_dict.items():
-                    unique_tags.add(f"{key.title()}: {value}")
-            except (json.JSONDecodeError, TypeError):
-                continue
-    return sorted(list(unique_tags))
+    """Return every distinct tag as a sorted list of "Key: Value" labels."""
+    conn = get_connection()
+    rows = conn.execute("SELECT DISTINCT key, value FROM task_tags").fetchall()
+    return sorted(f"{row['key'].title()}: {row['value']}" for row in rows)
@@ -0,0 +1,419 @@
+# File: app/database/job_queue.py
+"""
+A durable job queue stored in the application database.
+
+Jobs are rows in the jobs table. A worker claims the oldest available job,
+which takes a lease on it for JOB_LEASE_SECONDS. While the job runs, the worker
+extends the lease with heartbeat(), then calls complete() or fail(). If the
+worker dies, its lease expires and another worker claims the job again. Every
+claim counts as an attempt. A job that fails, or whose lease expires, on its
+last attempt is dead-lettered: it stays in the table with status 'dead' and
+its last error until requeue_dead() puts it back.
+
+Claim order: jobs at or above SCHEDULER_URGENT_PRIORITY (the urgent lane) come
+first, highest priority first. Other jobs are shared between batches by
+weighted fair queuing. Each batch (a task's batch_id; tasks without one share
+the '' batch) has a virtual time in batch_shares that grows by 1/weight per
+claim, and the batch furthest behind goes next. Within a batch, higher priority
+jobs go first, then the oldest. A large batch therefore cannot starve a small
+one that arrives after it.
+"""
+import json
+import time
+
+from app.config import (
+    JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_RETRY_BASE_SECONDS, JOB_RETRY_MAX_SECONDS,
+    SCHEDULER_URGENT_PRIORITY, SCHEDULER_METRICS_WINDOW_SECONDS, WORKER_HEARTBEAT_STALE_SECONDS,
+)
+from .crud import unit_of_work, update_status_many
+from .models import get_connection
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_DEAD = 'dead'
+
+def _job_from_row(row):
+    job = dict(row)
+    job['payload'] = json.loads(job['payload']) if job['payload'] else {}
+    return job
+
+# Priority and batch are copied from the task, so claim() needs no join.
+_INSERT_JOB_SQL = """INSERT OR IGNORE INTO jobs (kind, task_id, payload, max_attempts, available_at, priority, batch_key)
+    VALUES (?, ?, ?, ?, ?,
+            COALESCE((SELECT priority FROM tasks WHERE id = ?), 0),
+            COALESCE((SELECT batch_id FROM tasks WHERE id = ?), ''))"""
+
+def _join_batches(uow, task_ids):
+    """
+    Give the batches of `task_ids` a place in the fair-share rotation.
+
+    A batch that is new, or has been idle, starts at the lowest virtual time among
+    batches with unfinished jobs, so it neither jumps ahead of them for long nor
+    waits behind the time they have already been served.
+    """
+    uow.execute(
+        f"""INSERT INTO batch_shares (batch_key, served)
+            SELECT DISTINCT COALESCE(tasks.batch_id, ''), COALESCE((
+                SELECT MIN(share.served) FROM batch_shares AS share
+                WHERE share.batch_key IN (SELECT batch_key FROM jobs WHERE status IN ('{STATUS_QUEUED}', '{STATUS_RUNNING}'))
+            ), 0)
+            FROM tasks WHERE tasks.id IN (SELECT value FROM json_each(?))
+            ON CONFLICT (batch_key) DO UPDATE SET served = MAX(served, excluded.served)""",
+        (json.dumps([task_id for task_id in task_ids if task_id is not None]),),
+    )
+
+def enqueue(kind, task_id=None, payload=None, max_attempts=JOB_MAX_ATTEMPTS, delay_seconds=0):
+    """
+    Add a job to the queue.
+
+    Returns:
+        The new job id, or None if the task already has an unfinished job of this kind.
+    """
+    with unit_of_work() as uow:
+        _join_batches(uow, [task_id])
+        cur = uow.execute(
+            _INSERT_JOB_SQL,
+            (kind, task_id, json.dumps(payload) if payload else None, max_attempts, time.time() + delay_seconds, task_id, task_id),
+        )
+    return cur.lastrowid if cur.rowcount else None
+
+def enqueue_many(kind, task_ids, payload=None, max_attempts=JOB_MAX_ATTEMPTS):
+    """Add one job per task in a single transaction. Returns how many were added."""
+    now = time.time()
+    payload_json = json.dumps(payload) if payload else None
+    with unit_of_work() as uow:
+        _join_batches(uow, task_ids)
+        cur = uow.executemany(
+            _INSERT_JOB_SQL,
+            [(kind, task_id, payload_json, max_attempts, now, task_id, task_id) for task_id in task_ids],
+        )
+    return cur.rowcount
+
+def claim(worker_id, kinds=None, lease_seconds=JOB_LEASE_SECONDS, urgent_only=False):
+    """
+    Take the next available job, leasing it to `worker_id`.
+
+    Available jobs are queued ones whose time has come, and running ones whose
+    lease has expired with attempts left; expired jobs on their last attempt are
+    left for dead_letter_expired(). The order is described in the module docstring.
+
+    Args:
+        urgent_only: Only take jobs in the urgent lane.
+
+    Returns:
+        The job as a dict (payload decoded), or None if nothing is available.
+    """
+    now = time.time()
+    kind_filter = ""
+    params = []
+    if kinds:
+        kind_filter = f"AND jobs.kind IN ({','.join('?' for _ in kinds)})"
+        params = list(kinds)
+    urgent = int(SCHEDULER_URGENT_PRIORITY)
+    if urgent_only:
+        kind_filter += f" AND jobs.priority >= {urgent}"
+    with unit_of_work() as uow:
+        row = uow.execute(
+            f"""UPDATE jobs SET status = ?, attempts = attempts + 1, lease_owner = ?, lease_expires_at = ?, claimed_at = ?,
+                       queue_wait_seconds = ? - (CASE WHEN status = ? THEN available_at ELSE lease_expires_at END)
+                WHERE id = (
+                    SELECT jobs.id FROM jobs LEFT JOIN batch_shares AS share ON share.batch_key = jobs.batch_key
+                    WHERE ((jobs.status = ? AND jobs.available_at <= ?)
+                           OR (jobs.status = ? AND jobs.lease_expires_at < ? AND jobs.attempts < jobs.max_attempts)) {kind_filter}
+                    ORDER BY jobs.priority >= {urgent} DESC,
+                             CASE WHEN jobs.priority >= {urgent} THEN 0 ELSE COALESCE(share.served, 0) END,
+                             jobs.priority DESC, jobs.available_at, jobs.id
+                    LIMIT 1
+                )
+                RETURNING *""",
+            [STATUS_RUNNING, worker_id, now + lease_seconds, now, now, STATUS_QUEUED,
+             STATUS_QUEUED, now, STATUS_RUNNING, now] + params,
+        ).fetchone()
+        if row is not None:
+            uow.execute(
+                "UPDATE batch_shares SET served = served + 1.0 / MAX(weight, 0.001) WHERE batch_key = ?",
+                (row['batch_key'],),
+            )
+    return _job_from_row(row) if row else None
+
+def dead_letter_expired(kinds=None):
+    """
+    Dead-letter running jobs whose lease expired on their last attempt.
+
+    Returns:
+        The dead-lettered jobs, for the caller to run the same dead-letter
+        handling as a job that failed its last attempt.
+    """
+    kind_filter = ""
+    params = []
+    if kinds:
+        kind_filter = f"AND kind IN ({','.join('?' for _ in kinds)})"
+        params = list(kinds)
+    with unit_of_work() as uow:
+        rows = uow.execute(
+            f"""UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires_at = NULL,
+                       last_error = 'Lease expired on the final attempt', finished_at = CURRENT_TIMESTAMP
+                WHERE status = ? AND lease_expires_at < ? AND attempts >= max_attempts {kind_filter}
+                RETURNING *""",
+            [STATUS_DEAD, STATUS_RUNNING, time.time()] + params,
+        ).fetchall()
+    return [_job_from_row(row) for row in rows]
+
+def heartbeat(job_id, worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """Extend a job's lease. Returns False if the worker no longer holds it."""
+    with unit_of_work() as uow:
+        cur = uow.execute(
+            "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND lease_owner = ? AND status = ?",
+            (time.time() + lease_seconds, job_id, worker_id, STATUS_RUNNING),
+        )
+    return cur.rowcount == 1
+
+def complete(job_id, worker_id):
+    """Mark a job done. Returns False if the worker no longer held its lease."""
+    with unit_of_work() as uow:
+        cur = uow.execute(
+            """UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires_at = NULL, finished_at = CURRENT_TIMESTAMP
+               WHERE id = ? AND lease_owner = ? AND status = ?""",
+            (STATUS_DONE, job_id, worker_id, STATUS_RUNNING),
+        )
+    return cur.rowcount == 1
+
+def retry_delay(attempts, base_seconds=JOB_RETRY_BASE_SECONDS, max_seconds=JOB_RETRY_MAX_SECONDS):
+    """Seconds to wait before the next attempt, doubling with each attempt made."""
+    return min(max_seconds, base_seconds * (2 ** max(0, attempts - 1)))
+
+def fail(job_id, worker_id, error, retry=True, base_seconds=JOB_RETRY_BASE_SECONDS, max_seconds=JOB_RETRY_MAX_SECONDS):
+    """
+    Record a failed attempt, scheduling a retry or dead-lettering the job.
+
+    Args:
+        retry: False dead-letters the job immediately, for errors retrying cannot fix.
+        base_seconds, max_seconds: The retry backoff, see retry_delay().
+
+    Returns:
+        The job's new status, or None if the worker no longer held its lease.
+    """
+    with unit_of_work() as uow:
+        row = uow.execute(
+            "SELECT attempts, max_attempts FROM jobs WHERE id = ? AND lease_owner = ? AND status = ?",
+            (job_id, worker_id, STATUS_RUNNING),
+        ).fetchone()
+        if row is None:
+            return None
+        if retry and row['attempts'] < row['max_attempts']:
+            uow.execute(
+                """UPDATE jobs SET status = ?, available_at = ?, lease_owner = NULL, lease_expires_at = NULL, last_error = ?
+                   WHERE id = ?""",
+                (STATUS_QUEUED, time.time() + retry_delay(row['attempts'], base_seconds, max_seconds), str(error), job_id),
+            )
+            return STATUS_QUEUED
+        uow.execute(
+            """UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires_at = NULL, last_error = ?, finished_at = CURRENT_TIMESTAMP
+               WHERE id = ?""",
+            (STATUS_DEAD, str(error), job_id),
+        )
+        return STATUS_DEAD
+
+def enqueue_ready_tasks(kind, ready_sql, params=(), new_status=None, max_attempts=JOB_MAX_ATTEMPTS,
+                        include_finished=False, limit=500):
+    """
+    Add a `kind` job for every task matching `ready_sql` that does not have one yet.
+
+    Args:
+        ready_sql: SQL condition on the tasks table, with `params` for its placeholders.
+        new_status: Status the queued tasks move to, in the same transaction.
+        include_finished: Also skip tasks whose `kind` job already finished or was
+            dead-lettered, so each task goes through it at most once.
+
+    Returns:
+        Number of jobs added.
+    """
+    job_filter = "" if include_finished else f"AND jobs.status IN ('{STATUS_QUEUED}', '{STATUS_RUNNING}')"
+    with unit_of_work() as uow:
+        rows = uow.execute(
+            f"""SELECT id FROM tasks
+                WHERE ({ready_sql})
+                  AND NOT EXISTS (SELECT 1 FROM jobs WHERE jobs.task_id = tasks.id AND jobs.kind = ? {job_filter})
+                ORDER BY id LIMIT ?""",
+            list(params) + [kind, limit],
+        ).fetchall()
+        task_ids = [row['id'] for row in rows]
+        if not task_ids:
+            return 0
+        if new_status:
+            update_status_many(task_ids, new_status)
+        return enqueue_many(kind, task_ids, max_attempts=max_attempts)
+
+def reschedule_task_job(kind, task_id, delay_seconds=0):
+    """
+    Make sure a task has a queued `kind` job, available after `delay_seconds`.
+
+    An unfinished job, even one still leased to a dead worker, is moved back to
+    the queue; otherwise a new job is added. Returns the job id.
+    """
+    with unit_of_work() as uow:
+        row = uow.execute(
+            """UPDATE jobs SET status = ?, available_at = ?, lease_owner = NULL, lease_expires_at = NULL
+               WHERE kind = ? AND task_id = ? AND status IN (?, ?)
+               RETURNING id""",
+            (STATUS_QUEUED, time.time() + delay_seconds, kind, task_id, STATUS_QUEUED, STATUS_RUNNING),
+        ).fetchone()
+        if row:
+            return row['id']
+        return enqueue(kind, task_id, delay_seconds=delay_seconds)
+
+def dead_letter_task_job(kind, task_id, reason):
+    """Dead-letter a task's unfinished `kind` job, if it has one."""
+    with unit_of_work() as uow:
+        uow.execute(
+            """UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires_at = NULL, last_error = ?, finished_at = CURRENT_TIMESTAMP
+               WHERE kind = ? AND task_id = ? AND status IN (?, ?)""",
+            (STATUS_DEAD, reason, kind, task_id, STATUS_QUEUED, STATUS_RUNNING),
+        )
+    return True
+
+def set_task_priority(task_ids, priority):
+    """Apply a new priority to the unfinished jobs of `task_ids`. Returns how many jobs changed."""
+    with unit_of_work() as uow:
+        cur = uow.execute(
+            f"""UPDATE jobs SET priority = ?
+                WHERE status IN ('{STATUS_QUEUED}', '{STATUS_RUNNING}') AND task_id IN (SELECT value FROM json_each(?))""",
+            (priority, json.dumps(list(task_ids))),
+        )
+    return cur.rowcount
+
+def set_batch_weight(batch_id, weight):
+    """Set a batch's fair-share weight; a batch with weight 2 gets twice the turns of one with weight 1."""
+    if weight <= 0:
+        raise ValueError("Batch weight must be positive")
+    with unit_of_work() as uow:
+        uow.execute(
+            "INSERT INTO batch_shares (batch_key, weight) VALUES (?, ?) ON CONFLICT (batch_key) DO UPDATE SET weight = excluded.weight",
+            (batch_id or '', float(weight)),
+        )
+    return True
+
+# --- Worker Heartbeats ---
+def record_worker_heartbeat(worker_id):
+    """Mark a worker process as running now."""
+    with unit_of_work() as uow:
+        uow.execute(
+            "INSERT INTO worker_heartbeats (worker_id, last_seen) VALUES (?, ?) "
+            "ON CONFLICT (worker_id) DO UPDATE SET last_seen = excluded.last_seen",
+            (worker_id, time.time()),
+        )
+    return True
+
+def remove_worker_heartbeat(worker_id):
+    """Forget a worker process that is shutting down."""
+    with unit_of_work() as uow:
+        uow.execute("DELETE FROM worker_heartbeats WHERE worker_id = ?", (worker_id,))
+    return True
+
+def count_active_workers(stale_seconds=WORKER_HEARTBEAT_STALE_SECONDS):
+    """Return how many worker processes have checked in within `stale_seconds`."""
+    conn = get_connection()
+    return conn.execute(
+        "SELECT COUNT(*) FROM worker_heartbeats WHERE last_seen >= ?", (time.time() - stale_seconds,)
+    ).fetchone()[0]
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def get_scheduler_metrics(window_seconds=SCHEDULER_METRICS_WINDOW_SECONDS):
+    """
+    Report scheduling latency and per-batch throughput over the last `window_seconds`.
+
+    Returns:
+        Dict with:
+        'latency': job kind -> {'claimed', 'avg_wait', 'p50_wait', 'p95_wait', 'max_wait',
+            'urgent_p95_wait'}, the seconds jobs claimed in the window spent waiting
+            (None when there were none).
+        'batches': list of {'batch_id', 'weight', 'queued', 'running', 'done', 'dead',
+            'throughput_per_hour'}, busiest first; counts other than queued/running are
+            for the window.
+    """
+    conn = get_connection()
+    since = time.time() - window_seconds
+    waits = {}
+    for row in conn.execute(
+        "SELECT kind, priority, queue_wait_seconds FROM jobs WHERE claimed_at >= ? AND queue_wait_seconds IS NOT NULL",
+        (since,),
+    ):
+        waits.setdefault(row['kind'], []).append((row['queue_wait_seconds'], row['priority']))
+    latency = {}
+    for kind, entries in waits.items():
+        values = sorted(max(0.0, wait) for wait, _ in entries)
+        urgent = sorted(max(0.0, wait) for wait, priority in entries if priority >= SCHEDULER_URGENT_PRIORITY)
+        latency[kind] = {
+            'claimed': len(values),
+            'avg_wait': sum(values) / len(values),
+            'p50_wait': _percentile(values, 0.50),
+            'p95_wait': _percentile(values, 0.95),
+            'max_wait': values[-1],
+            'urgent_p95_wait': _percentile(urgent, 0.95),
+        }
+
+    rows = conn.execute(
+        f"""SELECT jobs.batch_key,
+                   COALESCE(MAX(share.weight), 1.0) AS weight,
+                   SUM(jobs.status = '{STATUS_QUEUED}') AS queued,
+                   SUM(jobs.status = '{STATUS_RUNNING}') AS running,
+                   SUM(jobs.status = '{STATUS_DONE}' AND jobs.finished_at >= datetime('now', ?)) AS done,
+                   SUM(jobs.status = '{STATUS_DEAD}' AND jobs.finished_at >= datetime('now', ?)) AS dead
+            FROM jobs LEFT JOIN batch_shares AS share ON share.batch_key = jobs.batch_key
+            WHERE jobs.status IN ('{STATUS_QUEUED}', '{STATUS_RUNNING}') OR jobs.finished_at >= datetime('now', ?)
+            GROUP BY jobs.batch_key""",
+        (f"-{int(window_seconds)} seconds",) * 3,
+    ).fetchall()
+    batches = [
+        {
+            'batch_id': row['batch_key'] or None,
+            'weight': row['weight'],
+            'queued': row['queued'],
+            'running': row['running'],
+            'done': row['done'],
+            'dead': row['dead'],
+            'throughput_per_hour': row['done'] * 3600.0 / window_seconds,
+        }
+        for row in rows
+    ]
+    batches.sort(key=lambda batch: (batch['done'] + batch['queued'] + batch['running']), reverse=True)
+    return {'latency': latency, 'batches': batches}
+
+def get_job(job_id):
+    row = get_connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _job_from_row(row) if row else None
+
+def get_queue_counts(kind=None):
+    """Return a dict mapping job status to the number of jobs in it."""
+    sql = "SELECT status, COUNT(*) FROM jobs"
+    params = ()
+    if kind:
+        sql += " WHERE kind = ?"
+        params = (kind,)
+    rows = get_connection().execute(sql + " GROUP BY status", params).fetchall()
+    return {status: count for status, count in rows}
+
+def list_dead_jobs(limit=100):
+    """Return the most recently dead-lettered jobs, newest first."""
+    rows = get_connection().execute(
+        "SELECT * FROM jobs WHERE status = ? ORDER BY finished_at DESC, id DESC LIMIT ?", (STATUS_DEAD, limit)
+    ).fetchall()
+    return [_job_from_row(row) for row in rows]
+
+def requeue_dead(job_ids):
+    """Give dead-lettered jobs a fresh set of attempts. Returns how many were requeued."""
+    if not job_ids:
+        return 0
+    with unit_of_work() as uow:
+        # OR IGNORE skips jobs whose task has meanwhile got another unfinished job of the same kind.
+        cur = uow.execute(
+            """UPDATE OR IGNORE jobs SET status = ?, attempts = 0, available_at = ?, finished_at = NULL
+                WHERE status = ? AND id IN (SELECT value FROM json_each(?))""",
+            (STATUS_QUEUED, time.time(), STATUS_DEAD, json.dumps(list(job_ids))),
+        )
+    return cur.rowcount
@@ -0,0 +1,291 @@
+# File: app/database/migrations.py
+"""
+Versioned schema migrations for the application database.
+
+The schema version lives in SQLite's PRAGMA user_version. Each migration runs once,
+in its own transaction, and bumps user_version in the same commit. Call init_db()
+from application entry points; after the first call in a process it does nothing.
+"""
+import os
+import sqlite3
+import threading
+
+from . import models
+from . import spec_storage
+
+def _add_column_if_missing(cursor, table_name, column_name, column_definition):
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    if column_name not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_definition}")
+        print(f"Added column '{column_name}' to table '{table_name}'")
+
+def _drop_column_if_present(cursor, table_name, column_name):
+    # ALTER TABLE ... DROP COLUMN needs SQLite 3.35; older builds keep the column unused.
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        return
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    if column_name in [column[1] for column in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table_name} DROP COLUMN {column_name}")
+        print(f"Dropped column '{column_name}' from table '{table_name}'")
+
+# --- Migrations ---
+def _001_base_schema(cursor):
+    cursor.execute(models.TASKS_TABLE)
+    # Databases created before batches existed lack this column.
+    _add_column_if_missing(cursor, "tasks", "batch_id", "batch_id TEXT")
+    cursor.execute(models.SPEC_SHEET_VERSIONS_TABLE)
+    cursor.execute(models.INTERACTIONS_TABLE)
+    cursor.execute(models.CHAT_HISTORY_TABLE)
+
+def _002_task_tags(cursor):
+    cursor.execute(models.TASK_TAGS_TABLE)
+    cursor.execute(models.TASK_TAGS_INDEX)
+    cursor.execute(models.TASK_TAGS_BACKFILL)
+
+def _003_query_indexes(cursor):
+    # Every index on a rowid table ends in the rowid, so these also serve the
+    # dashboard's (created_at, id) keyset pagination.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status_created_at ON tasks (status, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_created_at ON tasks (created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_batch_id ON tasks (batch_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_spec_sheet_versions_task_version ON spec_sheet_versions (task_id, version_number)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_task_id ON chat_history (task_id)")
+
+def _004_task_status_counts(cursor):
+    cursor.execute(models.TASK_STATUS_COUNTS_TABLE)
+    for trigger in models.TASK_STATUS_COUNT_TRIGGERS:
+        cursor.execute(trigger)
+    for statement in models.TASK_STATUS_COUNTS_REBUILD:
+        cursor.execute(statement)
+
+def _005_compact_spec_sheet_versions(cursor):
+    # Rebuild spec_sheet_versions with snapshot/delta payloads in place of spec_text.
+    cursor.execute("""
+    CREATE TABLE spec_sheet_versions_compact (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_id INTEGER NOT NULL,
+        version_number INTEGER NOT NULL,
+        author TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        storage TEXT NOT NULL DEFAULT 'full',
+        compressed INTEGER NOT NULL DEFAULT 0,
+        payload BLOB NOT NULL,
+        FOREIGN KEY (task_id) REFERENCES tasks (id)
+    );
+    """)
+    rows = cursor.execute(
+        "SELECT id, task_id, version_number, author, created_at, spec_text "
+        "FROM spec_sheet_versions ORDER BY task_id, version_number, id"
+    ).fetchall()
+    history = {}
+    for row in rows:
+        history.setdefault(row[1], []).append(row)
+    for task_rows in history.values():
+        encoded = spec_storage.encode_history([(row[2], row[5]) for row in task_rows])
+        cursor.executemany(
+            "INSERT INTO spec_sheet_versions_compact "
+            "(id, task_id, version_number, author, created_at, storage, compressed, payload) "
+            "VALUES (?,?,?,?,?,?,?,?)",
+            [
+                (row[0], row[1], row[2], row[3], row[4], storage, compressed, payload)
+                for row, (_, storage, payload, compressed) in zip(task_rows, encoded)
+            ],
+        )
+    cursor.execute("DROP TABLE spec_sheet_versions")
+    cursor.execute("ALTER TABLE spec_sheet_versions_compact RENAME TO spec_sheet_versions")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_spec_sheet_versions_task_version ON spec_sheet_versions (task_id, version_number)")
+
+def _006_chat_history_recency_index(cursor):
+    # Serves newest-first history reads per task; supersedes the task_id-only index.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_task_timestamp ON chat_history (task_id, timestamp, id)")
+    cursor.execute("DROP INDEX IF EXISTS idx_chat_history_task_id")
+
+def _007_tasks_full_text_search(cursor):
+    cursor.execute(models.TASKS_FTS_TABLE)
+    for trigger in models.TASKS_FTS_TRIGGERS:
+        cursor.execute(trigger)
+    cursor.execute(
+        "INSERT INTO tasks_fts (rowid, product_code, product_name, spec_sheet_text) "
+        "SELECT id, product_code, product_name, spec_sheet_text FROM tasks"
+    )
+    latest_rows = cursor.execute(
+        """SELECT v.task_id, v.storage, v.payload, v.compressed FROM spec_sheet_versions v
+           WHERE v.version_number = (SELECT MAX(version_number) FROM spec_sheet_versions WHERE task_id = v.task_id)"""
+    ).fetchall()
+    cursor.executemany(
+        "UPDATE tasks_fts SET latest_spec = ? WHERE rowid = ?",
+        [(spec_storage.decode(storage, payload, compressed), task_id) for task_id, storage, payload, compressed in latest_rows],
+    )
+
+def _008_content_addressed_images(cursor):
+    from app import image_store
+
+    cursor.execute(models.IMAGE_BLOBS_TABLE)
+    cursor.execute(models.TASK_IMAGES_TABLE)
+    cursor.execute(models.TASK_IMAGES_INDEX)
+    for trigger in models.IMAGE_REF_COUNT_TRIGGERS:
+        cursor.execute(trigger)
+
+    # Register the files existing tasks already point at, in place.
+    tasks = cursor.execute(
+        "SELECT id, uploaded_image_paths, generated_image_path FROM tasks "
+        "WHERE uploaded_image_paths != '' OR generated_image_path IS NOT NULL"
+    ).fetchall()
+    for task_id, uploaded_paths, generated_path in tasks:
+        images = [("upload", path) for path in (uploaded_paths or "").split(",") if path]
+        if generated_path:
+            images.append(("generated", generated_path))
+        positions = {}
+        for role, path in images:
+            if not os.path.isfile(path):
+                continue
+            stored = image_store.register_existing_file(path)
+            cursor.execute(
+                "INSERT OR IGNORE INTO image_blobs (sha256, path, size_bytes) VALUES (?, ?, ?)",
+                (stored.sha256, stored.path, stored.size_bytes),
+            )
+            position = positions.get(role, 0)
+            positions[role] = position + 1
+            cursor.execute(
+                "INSERT INTO task_images (task_id, role, position, sha256) VALUES (?, ?, ?, ?)",
+                (task_id, role, position, stored.sha256),
+            )
+
+def _009_job_queue(cursor):
+    cursor.execute(models.JOBS_TABLE)
+    for index in models.JOBS_INDEXES:
+        cursor.execute(index)
+
+def _010_task_generation_leases(cursor):
+    # The worker generating a task holds a lease on it; see workflow_manager.sweep_stuck_generations().
+    _add_column_if_missing(cursor, "tasks", "lease_owner", "lease_owner TEXT")
+    _add_column_if_missing(cursor, "tasks", "lease_expires_at", "lease_expires_at REAL")
+    _add_column_if_missing(cursor, "tasks", "generation_attempts", "generation_attempts INTEGER NOT NULL DEFAULT 0")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_tasks_generating_lease ON tasks (lease_expires_at) WHERE status = 'GENERATING'"
+    )
+
+def _011_job_scheduling(cursor):
+    # Priority and batch are copied onto each job when it is queued; see job_queue.claim().
+    _add_column_if_missing(cursor, "tasks", "priority", "priority INTEGER NOT NULL DEFAULT 0")
+    _add_column_if_missing(cursor, "jobs", "priority", "priority INTEGER NOT NULL DEFAULT 0")
+    _add_column_if_missing(cursor, "jobs", "batch_key", "batch_key TEXT NOT NULL DEFAULT ''")
+    _add_column_if_missing(cursor, "jobs", "claimed_at", "claimed_at REAL")
+    _add_column_if_missing(cursor, "jobs", "queue_wait_seconds", "queue_wait_seconds REAL")
+    cursor.execute(
+        "UPDATE jobs SET batch_key = COALESCE((SELECT batch_id FROM tasks WHERE tasks.id = jobs.task_id), '') "
+        "WHERE task_id IS NOT NULL"
+    )
+    cursor.execute(models.BATCH_SHARES_TABLE)
+    # For the scheduler metrics' time windows.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_claimed_at ON jobs (claimed_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON jobs (finished_at)")
+
+def _012_task_events(cursor):
+    cursor.execute(models.TASK_EVENTS_TABLE)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_task_events_created_at ON task_events (created_at)")
+    for trigger in models.TASK_EVENT_TRIGGERS:
+        cursor.execute(trigger)
+
+def _013_drop_task_generation_attempts(cursor):
+    # Generation attempts are counted only on the task's job (jobs.attempts).
+    _drop_column_if_present(cursor, "tasks", "generation_attempts")
+
+def _014_unreferenced_images_index(cursor):
+    # Lets crud.purge_unreferenced_images() find released images without scanning image_blobs.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_image_blobs_unreferenced ON image_blobs (ref_count) WHERE ref_count <= 0")
+
+def _015_unique_spec_sheet_version_numbers(cursor):
+    # Racy numbering before version numbers were allocated inside the INSERT left
+    # duplicate (task_id, version_number) pairs. Migration 5 chained their deltas in
+    # (version_number, id) order, so renumbering in that order keeps them decodable.
+    rows = cursor.execute(
+        """SELECT id, task_id FROM spec_sheet_versions WHERE task_id IN (
+               SELECT task_id FROM spec_sheet_versions GROUP BY task_id, version_number HAVING COUNT(*) > 1)
+           ORDER BY task_id, version_number, id"""
+    ).fetchall()
+    numbers = {}
+    for version_id, task_id in rows:
+        numbers[task_id] = numbers.get(task_id, 0) + 1
+        cursor.execute("UPDATE spec_sheet_versions SET version_number = ? WHERE id = ?", (numbers[task_id], version_id))
+    cursor.execute("DROP INDEX IF EXISTS idx_spec_sheet_versions_task_version")
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_spec_sheet_versions_task_version_unique "
+        "ON spec_sheet_versions (task_id, version_number)"
+    )
+
+def _016_worker_heartbeats(cursor):
+    cursor.execute(models.WORKER_HEARTBEATS_TABLE)
+
+# (version, description, function). Append new migrations; never renumber or edit applied ones.
+MIGRATIONS = [
+    (1, "Base schema", _001_base_schema),
+    (2, "Normalized task_tags table", _002_task_tags),
+    (3, "Indexes for task, version and chat history queries", _003_query_indexes),
+    (4, "Trigger-maintained task_status_counts table", _004_task_status_counts),
+    (5, "Snapshot and delta storage for spec sheet versions", _005_compact_spec_sheet_versions),
+    (6, "Recency index on chat_history", _006_chat_history_recency_index),
+    (7, "FTS5 index over task codes, names and spec sheets", _007_tasks_full_text_search),
+    (8, "Content-addressed image_blobs and task_images tables", _008_content_addressed_images),
+    (9, "Durable jobs table for background workers", _009_job_queue),
+    (10, "Generation lease columns on tasks", _010_task_generation_leases),
+    (11, "Job priority, batch fair-share and scheduling metrics columns", _011_job_scheduling),
+    (12, "Append-only task_events log", _012_task_events),
+    (13, "Drop tasks.generation_attempts in favour of jobs.attempts", _013_drop_task_generation_attempts),
+    (14, "Partial index on unreferenced image_blobs", _014_unreferenced_images_index),
+    (15, "Unique spec sheet version numbers per task", _015_unique_spec_sheet_version_numbers),
+    (16, "worker_heartbeats table of running worker processes", _016_worker_heartbeats),
+]
+
+def get_schema_version(conn):
+    """Return the schema version recorded in the database."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn):
+    """
+    Apply every migration newer than the database's schema version.
+
+    Returns:
+        List of the migration versions that were applied.
+    """
+    applied = []
+    for version, description, apply in MIGRATIONS:
+        # Take the write lock before re-checking the version, so two processes
+        # starting together cannot both apply the same migration.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            apply(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied migration {version}: {description}")
+        applied.append(version)
+    if applied:
+        conn.execute("PRAGMA optimize")
+    return applied
+
+_init_lock = threading.Lock()
+_initialized_path = None
+
+def init_db():
+    """Bring the database schema up to date once per process."""
+    global _initialized_path
+    if _initialized_path == models.DATABASE_NAME:
+        return
+    with _init_lock:
+        if _initialized_path == models.DATABASE_NAME:
+            return
+        conn = models.create_connection()
+        if conn is None:
+            return
+        try:
+            if get_schema_version(conn) < MIGRATIONS[-1][0]:
+                migrate(conn)
+        finally:
+            conn.close()
+        _initialized_path = models.DATABASE_NAME
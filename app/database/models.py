@@ -1,18 +1,72 @@
 # File: app/database/models.py
+import os
 import sqlite3
+import threading
 
 DATABASE_NAME = "data/main.db"
 
+# --- Connection Settings ---
+# Milliseconds a connection waits on a locked database before raising "database is locked".
+BUSY_TIMEOUT_MS = 5000
+# Number of prepared statements sqlite3 keeps compiled per connection.
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+
+def _configure_connection(conn):
+    """Apply the pragmas every application connection should run with."""
+    # WAL lets readers keep reading while a writer commits.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    return conn
+
+def _connect():
+    db_dir = os.path.dirname(DATABASE_NAME)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(
+        DATABASE_NAME,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    return _configure_connection(conn)
+
 def create_connection():
-    """Create a database connection to the SQLite database."""
+    """Create a new, caller-owned database connection to the SQLite database."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = _connect()
         return conn
     except sqlite3.Error as e:
         print(e)
     return conn
 
+def get_connection():
+    """
+    Return the calling thread's shared database connection, opening it on first use.
+
+    The connection is reused across calls on the same thread, so callers must not
+    close it. Rows are returned as sqlite3.Row objects.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "path", None) == DATABASE_NAME:
+        return conn
+    if conn is not None:
+        conn.close()
+    conn = _connect()
+    conn.row_factory = sqlite3.Row
+    _local.conn = conn
+    _local.path = DATABASE_NAME
+    return conn
+
+def close_connection():
+    """Close the calling thread's shared connection, if one is open."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
 def add_column_if_not_exists(table_name, column_name, column_definition):
     """Add a column to an existing table if it doesn't already exist."""
     conn = create_connection()
@@ -38,6 +92,53 @@ def add_column_if_not_exists(table_name, column_name, column_definition):
             conn.close()
     return False
 
+# --- Table Definitions ---
+# These are applied by the numbered migrations in app/database/migrations.py.
+TASKS_TABLE = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    product_code TEXT,
+    status TEXT NOT NULL DEFAULT 'NEW',
+    uploaded_image_paths TEXT,
+    spec_sheet_text TEXT,
+    final_prompt TEXT,
+    generated_image_path TEXT,
+    redo_prompt TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    product_name TEXT,
+    product_tags TEXT,
+    batch_id TEXT
+);
+"""
+
+# Original layout. Migration 5 replaces spec_text with snapshot/delta payloads;
+# see app/database/spec_storage.py.
+SPEC_SHEET_VERSIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS spec_sheet_versions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id INTEGER NOT NULL,
+    version_number INTEGER NOT NULL,
+    spec_text TEXT NOT NULL,
+    author TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (task_id) REFERENCES tasks (id)
+);
+"""
+
+INTERACTIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS interactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id INTEGER,
+    step_name TEXT,
+    user_input TEXT,
+    ai_prompt TEXT,
+    ai_response TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    context TEXT,
+    FOREIGN KEY (task_id) REFERENCES tasks (id)
+);
+"""
+
 # Add a new table for chat history
 CHAT_HISTORY_TABLE = """
 CREATE TABLE IF NOT EXISTS chat_history (
@@ -50,94 +151,258 @@ CREATE TABLE IF NOT EXISTS chat_history (
 );
 """
 
+# Normalized product tags: one row per (task, key, value). The primary key serves
+# per-task lookups and the (key, value, task_id) index is the inverted index used
+# for distinct-tag listings and tag filtering.
+TASK_TAGS_TABLE = """
+CREATE TABLE IF NOT EXISTS task_tags (
+    task_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (task_id, key, value),
+    FOREIGN KEY (task_id) REFERENCES tasks (id)
+) WITHOUT ROWID;
+"""
+TASK_TAGS_INDEX = "CREATE INDEX IF NOT EXISTS idx_task_tags_key_value ON task_tags (key, value, task_id);"
+
+# Copies tags from the legacy product_tags JSON column into task_tags.
+TASK_TAGS_BACKFILL = """
+INSERT OR IGNORE INTO task_tags (task_id, key, value)
+SELECT tasks.id, lower(trim(tag.key)), trim(tag.value)
+FROM tasks, json_each(tasks.product_tags) AS tag
+WHERE json_valid(tasks.product_tags) AND json_type(tasks.product_tags) = 'object'
+  AND tag.value IS NOT NULL;
+"""
+
+# Per-status task counts, kept current by triggers on tasks so the overview pages
+# never have to scan the tasks table.
+TASK_STATUS_COUNTS_TABLE = """
+CREATE TABLE IF NOT EXISTS task_status_counts (
+    status TEXT PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+"""
+
+TASK_STATUS_COUNT_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_status_count_insert AFTER INSERT ON tasks
+    BEGIN
+        INSERT INTO task_status_counts (status, count) VALUES (NEW.status, 1)
+        ON CONFLICT (status) DO UPDATE SET count = count + 1;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_status_count_delete AFTER DELETE ON tasks
+    BEGIN
+        UPDATE task_status_counts SET count = count - 1 WHERE status = OLD.status;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_status_count_update AFTER UPDATE OF status ON tasks
+    WHEN OLD.status IS NOT NEW.status
+    BEGIN
+        UPDATE task_status_counts SET count = count - 1 WHERE status = OLD.status;
+        INSERT INTO task_status_counts (status, count) VALUES (NEW.status, 1)
+        ON CONFLICT (status) DO UPDATE SET count = count + 1;
+    END;
+    """,
+]
+
+# Rebuilds task_status_counts from the tasks table.
+TASK_STATUS_COUNTS_REBUILD = [
+    "DELETE FROM task_status_counts;",
+    "INSERT INTO task_status_counts (status, count) SELECT status, COUNT(*) FROM tasks GROUP BY status;",
+]
+
+# Full-text index over task codes, names and spec sheets. rowid is the task id.
+# The tasks columns are synced by triggers; latest_spec holds the decoded newest
+# spec sheet version and is written by crud, since versions are stored encoded.
+TASKS_FTS_TABLE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5(
+    product_code, product_name, spec_sheet_text, latest_spec,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+);
+"""
+
+TASKS_FTS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_fts_insert AFTER INSERT ON tasks
+    BEGIN
+        INSERT INTO tasks_fts (rowid, product_code, product_name, spec_sheet_text, latest_spec)
+        VALUES (NEW.id, NEW.product_code, NEW.product_name, NEW.spec_sheet_text, NULL);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_fts_update AFTER UPDATE OF product_code, product_name, spec_sheet_text ON tasks
+    BEGIN
+        UPDATE tasks_fts
+        SET product_code = NEW.product_code, product_name = NEW.product_name, spec_sheet_text = NEW.spec_sheet_text
+        WHERE rowid = NEW.id;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_fts_delete AFTER DELETE ON tasks
+    BEGIN
+        DELETE FROM tasks_fts WHERE rowid = OLD.id;
+    END;
+    """,
+]
+
+# Content-addressed images (see app/image_store.py). ref_count is maintained by
+# triggers on task_images, so an image is only deleted once no task uses it.
+IMAGE_BLOBS_TABLE = """
+CREATE TABLE IF NOT EXISTS image_blobs (
+    sha256 TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    ref_count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+) WITHOUT ROWID;
+"""
+
+# Images used by each task. role is 'upload' or 'generated'.
+TASK_IMAGES_TABLE = """
+CREATE TABLE IF NOT EXISTS task_images (
+    task_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (task_id, role, position),
+    FOREIGN KEY (task_id) REFERENCES tasks (id),
+    FOREIGN KEY (sha256) REFERENCES image_blobs (sha256)
+) WITHOUT ROWID;
+"""
+TASK_IMAGES_INDEX = "CREATE INDEX IF NOT EXISTS idx_task_images_sha256 ON task_images (sha256);"
+
+IMAGE_REF_COUNT_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_task_images_insert AFTER INSERT ON task_images
+    BEGIN
+        UPDATE image_blobs SET ref_count = ref_count + 1 WHERE sha256 = NEW.sha256;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_task_images_delete AFTER DELETE ON task_images
+    BEGIN
+        UPDATE image_blobs SET ref_count = ref_count - 1 WHERE sha256 = OLD.sha256;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_task_images_update AFTER UPDATE OF sha256 ON task_images
+    WHEN OLD.sha256 IS NOT NEW.sha256
+    BEGIN
+        UPDATE image_blobs SET ref_count = ref_count - 1 WHERE sha256 = OLD.sha256;
+        UPDATE image_blobs SET ref_count = ref_count + 1 WHERE sha256 = NEW.sha256;
+    END;
+    """,
+]
+
+# Durable background job queue (see job_queue.py). status is 'queued', 'running',
+# 'done' or 'dead'; times are Unix epoch seconds. A running job whose lease has
+# expired is claimable again, so work survives crashed or stopped workers.
+JOBS_TABLE = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    task_id INTEGER,
+    payload TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP,
+    FOREIGN KEY (task_id) REFERENCES tasks (id)
+);
+"""
+# Append-only log of task changes, polled by the dashboard by id (see app/core/progress.py).
+# Triggers record creation, status changes and deletion; workers add job events.
+# created_at is Unix epoch seconds.
+TASK_EVENTS_TABLE = """
+CREATE TABLE IF NOT EXISTS task_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id INTEGER,
+    batch_id TEXT,
+    event_type TEXT NOT NULL,
+    old_status TEXT,
+    new_status TEXT,
+    message TEXT,
+    created_at REAL NOT NULL DEFAULT ((julianday('now') - 2440587.5) * 86400.0)
+);
+"""
+
+TASK_EVENT_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_event_insert AFTER INSERT ON tasks
+    BEGIN
+        INSERT INTO task_events (task_id, batch_id, event_type, new_status)
+        VALUES (NEW.id, NEW.batch_id, 'created', NEW.status);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_event_status AFTER UPDATE OF status ON tasks
+    WHEN OLD.status IS NOT NEW.status
+    BEGIN
+        INSERT INTO task_events (task_id, batch_id, event_type, old_status, new_status)
+        VALUES (NEW.id, NEW.batch_id, 'status', OLD.status, NEW.status);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_event_delete AFTER DELETE ON tasks
+    BEGIN
+        INSERT INTO task_events (task_id, batch_id, event_type, old_status)
+        VALUES (OLD.id, OLD.batch_id, 'deleted', OLD.status);
+    END;
+    """,
+]
+
+# Weighted fair queuing state per batch (see job_queue.claim). `served` is the
+# batch's virtual time: jobs claimed so far divided by its weight.
+BATCH_SHARES_TABLE = """
+CREATE TABLE IF NOT EXISTS batch_shares (
+    batch_key TEXT PRIMARY KEY,
+    weight REAL NOT NULL DEFAULT 1.0,
+    served REAL NOT NULL DEFAULT 0.0
+) WITHOUT ROWID;
+"""
+# One row per running worker process, refreshed by its maintenance loop.
+WORKER_HEARTBEATS_TABLE = """
+CREATE TABLE IF NOT EXISTS worker_heartbeats (
+    worker_id TEXT PRIMARY KEY,
+    last_seen REAL NOT NULL
+) WITHOUT ROWID;
+"""
+JOBS_INDEXES = [
+    # Serves the claim query's scan over claimable jobs.
+    "CREATE INDEX IF NOT EXISTS idx_jobs_status_available_at ON jobs (status, available_at)",
+    # At most one unfinished job of each kind per task.
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_task ON jobs (kind, task_id) WHERE status IN ('queued', 'running')",
+]
+
 def create_tables():
     """Create all necessary database tables if they don't exist, and update schema if needed."""
+    from .migrations import migrate
+
     conn = create_connection()
     if conn is not None:
         try:
-            cursor = conn.cursor()
-
-            # --- tasks table with new 'batch_id' column ---
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS tasks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                product_code TEXT,
-                status TEXT NOT NULL DEFAULT 'NEW',
-                uploaded_image_paths TEXT,
-                spec_sheet_text TEXT,
-                final_prompt TEXT,
-                generated_image_path TEXT,
-                redo_prompt TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                product_name TEXT,
-                product_tags TEXT,
-                batch_id TEXT
-            );
-            """)
-
-            # Check if we need to add any missing columns to existing tasks table
-            cursor.execute("PRAGMA table_info(tasks)")
-            columns = [column[1] for column in cursor.fetchall()]
-
-            # Add batch_id column if it doesn't exist (for backward compatibility)
-            if 'batch_id' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE tasks ADD COLUMN batch_id TEXT")
-                    print("Added batch_id column to tasks table")
-                except sqlite3.Error as e:
-                    print(f"Could not add batch_id column: {e}")
-
-            print("SQLite 'tasks' table checked/created successfully.")
-
-            # --- spec_sheet_versions table ---
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS spec_sheet_versions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                task_id INTEGER NOT NULL,
-                version_number INTEGER NOT NULL,
-                spec_text TEXT NOT NULL,
-                author TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (task_id) REFERENCES tasks (id)
-            );
-            """)
-            print("SQLite 'spec_sheet_versions' table checked/created successfully.")
-
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS interactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                task_id INTEGER,
-                step_name TEXT,
-                user_input TEXT,
-                ai_prompt TEXT,
-                ai_response TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                context TEXT,
-                FOREIGN KEY (task_id) REFERENCES tasks (id)
-            );
-            """)
-            print("SQLite 'interactions' table checked/created successfully.")
-
-            # Create chat history table
-            cursor.execute(CHAT_HISTORY_TABLE)
-            print("SQLite 'chat_history' table checked/created successfully.")
-
-            conn.commit()
-
+            applied = migrate(conn)
+            if applied:
+                print(f"Applied database migrations: {', '.join(str(version) for version in applied)}")
+            else:
+                print("Database schema is up to date.")
         except sqlite3.Error as e:
             print(f"An error occurred while creating tables: {e}")
-            conn.rollback()
+            raise
         finally:
             conn.close()
     else:
         print("Error! Cannot create the database connection.")
 
-# Ensure the database is initialized when this module is imported
-try:
-    create_tables()
-except Exception as e:
-    print(f"An error occurred while initializing the database: {e}")
-
 if __name__ == "__main__":
     print("Initializing database...")
     try:
@@ -0,0 +1,110 @@
+# File: app/database/spec_storage.py
+"""
+Compact storage encoding for spec sheet versions.
+
+The newest version of a spec sheet, and every SNAPSHOT_INTERVAL-th version, is
+stored as a full snapshot. Every other version is stored as a reverse delta: the
+line edits that turn the next newer version back into it. Reading the latest
+version therefore decodes a single row, and any older version is rebuilt from the
+nearest newer snapshot with at most SNAPSHOT_INTERVAL - 1 deltas.
+
+Payloads are zlib-compressed whenever that makes them smaller.
+"""
+import difflib
+import json
+import zlib
+
+STORAGE_FULL = "full"
+STORAGE_DELTA = "delta"
+
+# Versions whose number is a multiple of this are kept as full snapshots.
+SNAPSHOT_INTERVAL = 10
+# Payloads shorter than this are never worth compressing.
+MIN_COMPRESS_BYTES = 64
+
+def is_snapshot_version(version_number):
+    """Return True if this version is always stored in full."""
+    return version_number % SNAPSHOT_INTERVAL == 0
+
+def _pack(data: bytes):
+    """Return (payload, compressed) for raw bytes, compressing only when it helps."""
+    if len(data) >= MIN_COMPRESS_BYTES:
+        packed = zlib.compress(data, 6)
+        if len(packed) < len(data):
+            return packed, 1
+    return data, 0
+
+def _unpack(payload, compressed):
+    data = bytes(payload)
+    return zlib.decompress(data) if compressed else data
+
+def encode_full(text):
+    """Encode a complete spec sheet. Returns (storage, payload, compressed)."""
+    payload, compressed = _pack(text.encode("utf-8"))
+    return STORAGE_FULL, payload, compressed
+
+def encode_delta(base_text, target_text):
+    """
+    Encode `target_text` as edits against `base_text`. Returns (storage, payload, compressed).
+
+    The delta is a JSON list of operations applied line by line to the base:
+    a positive int copies that many lines, a negative int skips that many lines,
+    and a string is inserted verbatim.
+    """
+    base_lines = base_text.splitlines(keepends=True)
+    target_lines = target_text.splitlines(keepends=True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, target_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append(i2 - i1)
+            continue
+        if i2 > i1:
+            ops.append(i1 - i2)
+        if j2 > j1:
+            ops.append("".join(target_lines[j1:j2]))
+    payload, compressed = _pack(json.dumps(ops, separators=(",", ":")).encode("utf-8"))
+    return STORAGE_DELTA, payload, compressed
+
+def decode(storage, payload, compressed, base_text=None):
+    """
+    Decode a stored payload back into spec sheet text.
+
+    Delta payloads need `base_text`, the text of the next newer version.
+    """
+    data = _unpack(payload, compressed)
+    if storage == STORAGE_FULL:
+        return data.decode("utf-8")
+    if base_text is None:
+        raise ValueError("A delta-encoded spec sheet version needs its base text to decode")
+    base_lines = base_text.splitlines(keepends=True)
+    position = 0
+    parts = []
+    for op in json.loads(data.decode("utf-8")):
+        if isinstance(op, str):
+            parts.append(op)
+        elif op > 0:
+            parts.extend(base_lines[position:position + op])
+            position += op
+        else:
+            position -= op
+    return "".join(parts)
+
+def encode_history(texts_by_version):
+    """
+    Encode a task's full version history.
+
+    Args:
+        texts_by_version: List of (version_number, text), oldest first.
+
+    Returns:
+        List of (version_number, storage, payload, compressed) in the same order.
+    """
+    encoded = []
+    for index, (version_number, text) in enumerate(texts_by_version):
+        is_latest = index == len(texts_by_version) - 1
+        if is_latest or is_snapshot_version(version_number):
+            encoded.append((version_number, *encode_full(text)))
+        else:
+            encoded.append((version_number, *encode_delta(texts_by_version[index + 1][1], text)))
+    return encoded
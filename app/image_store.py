@@ -0,0 +1,125 @@
+# app/image_store.py
+"""
+Content-addressed storage for uploaded and generated images.
+
+Every image is stored once under its SHA-256 digest, in sharded directories
+(uploads/blobs/ab/cd/<digest>.<ext>), so the same photo used for several SKUs
+takes disk space once. The extension comes from the first upload; the same
+bytes uploaded later under another extension reuse that file. Which tasks use which image, and how many references each
+image has, is tracked in the task_images and image_blobs tables (see crud).
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+from collections import namedtuple
+
+from .config import UPLOADS_DIR
+from .constants import ALLOWED_EXTENSIONS
+
+BLOB_DIR = os.path.join(UPLOADS_DIR, "blobs")
+CHUNK_SIZE = 1024 * 1024
+# Unreferenced images younger than this are kept, because an upload in another
+# session may be about to reference them.
+ORPHAN_GRACE_SECONDS = 600
+
+StoredImage = namedtuple("StoredImage", ["sha256", "path", "size_bytes"])
+
+def _extension_for(filename):
+    extension = os.path.splitext(filename or "")[1].lower()
+    return extension if extension in ALLOWED_EXTENSIONS else ".bin"
+
+def blob_path(sha256, extension):
+    """Return the sharded path an image with this digest is stored at."""
+    return os.path.join(BLOB_DIR, sha256[:2], sha256[2:4], f"{sha256}{extension}")
+
+def _existing_blob(sha256):
+    """Return the stored file for this digest, whatever its extension, or None."""
+    directory = os.path.dirname(blob_path(sha256, ""))
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return None
+    for name in names:
+        if os.path.splitext(name)[0] == sha256:
+            return os.path.join(directory, name)
+    return None
+
+def hash_file(path):
+    """Return the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def store_stream(stream, filename):
+    """
+    Store the contents of a binary stream, hashing it while it is written.
+
+    The data goes to a temporary file in the blob directory and is then renamed
+    into place. If an identical image is already stored, the temporary file is
+    discarded and the existing one is reused.
+
+    Returns:
+        StoredImage for the stored content.
+    """
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=BLOB_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+        sha256 = digest.hexdigest()
+        final_path = _existing_blob(sha256) or blob_path(sha256, _extension_for(filename))
+        if os.path.exists(final_path):
+            os.remove(temp_path)
+            # Refresh the timestamp so the orphan sweep leaves it alone for now.
+            os.utime(final_path)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(temp_path, final_path)
+        return StoredImage(sha256, final_path, size)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def save_upload(uploaded_file):
+    """Store a Streamlit UploadedFile (or any object with .name and .read())."""
+    if hasattr(uploaded_file, "seek"):
+        uploaded_file.seek(0)
+    return store_stream(uploaded_file, uploaded_file.name)
+
+def store_file(path, move=False):
+    """
+    Store an existing file, such as a freshly generated image.
+
+    With move=True the source file is removed once it is stored.
+    """
+    with open(path, "rb") as f:
+        stored = store_stream(f, path)
+    if move and os.path.abspath(path) != os.path.abspath(stored.path):
+        os.remove(path)
+    return stored
+
+def register_existing_file(path):
+    """Describe a file already on disk as a StoredImage without copying it."""
+    return StoredImage(hash_file(path), path, os.path.getsize(path))
+
+def is_recent(path):
+    """Return True if the file was written or reused within the orphan grace period."""
+    try:
+        return time.time() - os.path.getmtime(path) < ORPHAN_GRACE_SECONDS
+    except OSError:
+        return False
+
+def remove_file(path):
+    """Delete a stored image file if it still exists."""
+    if path and os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,211 @@
+# File: app/worker.py
+"""
+Background workers for the task pipeline (app/core/pipeline.py).
+
+    python -m app.worker                 # WORKER_PROCESSES worker processes
+    python -m app.worker --workers 4     # four processes
+    python -m app.worker --once          # run the pipeline until the queue is empty, then exit
+
+Each process runs a pool of threads per pipeline stage, sized by
+PIPELINE_STAGE_SETTINGS, plus one thread per stage reserved for the urgent
+lane. A thread claims one job of its stage at a time from the durable job queue
+(app/database/job_queue.py), keeps its lease alive while the handler runs, and
+marks it done or failed. A maintenance thread records the process's heartbeat
+(so the dashboard knows a worker is running) and feeds ready tasks into the
+stages every PIPELINE_PUMP_INTERVAL_SECONDS, and every GENERATION_SWEEP_INTERVAL_SECONDS
+requeues or fails tasks stuck in GENERATING whose worker died
+(workflow_manager.sweep_stuck_generations) and prunes old task events. Failed
+attempts are recorded in task_events for the dashboard's live progress panel.
+Throughput does not depend on anyone keeping a browser tab open. Ctrl+C or
+SIGTERM lets the current jobs finish before the process exits.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from app.config import (
+    logger, JOB_LEASE_SECONDS, WORKER_POLL_SECONDS, WORKER_PROCESSES,
+    GENERATION_SWEEP_INTERVAL_SECONDS, PIPELINE_PUMP_INTERVAL_SECONDS, TASK_EVENTS_RETENTION_SECONDS,
+)
+from app.database import crud, init_db, job_queue
+from app.core import pipeline
+from app.core.workflow_manager import sweep_stuck_generations
+
+class _LeaseKeeper(threading.Thread):
+    """Extends a job's lease, and its task's generation lease, every third of the lease period until stopped."""
+
+    def __init__(self, job, worker_id):
+        super().__init__(name=f"lease-{job['id']}", daemon=True)
+        self.job = job
+        self.worker_id = worker_id
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(JOB_LEASE_SECONDS / 3):
+            if not job_queue.heartbeat(self.job['id'], self.worker_id):
+                self.lost = True
+                logger.warning(f"{self.worker_id} lost the lease on job {self.job['id']}")
+                return
+            if self.job['task_id'] is not None:
+                crud.renew_generation_lease(self.job['task_id'], self.worker_id, JOB_LEASE_SECONDS)
+
+def handle_dead_job(job, reason):
+    """Run the stage's dead-letter callback and record the event, however the job died."""
+    stage = pipeline.STAGES_BY_KIND[job['kind']]
+    logger.error(f"Job {job['id']} ({job['kind']}) dead-lettered after {job['attempts']} attempts")
+    if stage.on_dead:
+        stage.on_dead(job)
+    if job['task_id'] is not None:
+        crud.record_task_event(job['task_id'], 'job_dead', reason)
+
+def run_job(job, worker_id):
+    """Run one claimed job under its stage's rate limit and record the outcome. Returns the job's final status."""
+    stage = pipeline.STAGES_BY_KIND[job['kind']]
+    keeper = _LeaseKeeper(job, worker_id)
+    keeper.start()
+    try:
+        stage.throttle()
+        stage.run(job, worker_id)
+    except Exception as e:
+        keeper.stopped.set()
+        logger.error(f"Job {job['id']} ({job['kind']}) attempt {job['attempts']} failed: {e}")
+        status = stage.fail(job, worker_id, e)
+        if status == job_queue.STATUS_DEAD:
+            handle_dead_job(job, f"{stage.name} attempt {job['attempts']} failed (gave up): {e}")
+        elif status is not None and job['task_id'] is not None:
+            crud.record_task_event(job['task_id'], 'job_failed', f"{stage.name} attempt {job['attempts']} failed (will retry): {e}")
+        return status
+    finally:
+        keeper.stopped.set()
+    if not job_queue.complete(job['id'], worker_id):
+        logger.warning(f"Job {job['id']} finished after {worker_id} lost its lease")
+        return None
+    return job_queue.STATUS_DONE
+
+def run_maintenance():
+    """Feed the pipeline, recover stuck generations and prune old task events once."""
+    pipeline.pump()
+    sweep_stuck_generations()
+    crud.prune_task_events(TASK_EVENTS_RETENTION_SECONDS)
+
+def _maintenance_loop(stop_event, process_id):
+    next_sweep = 0.0
+    while not stop_event.is_set():
+        try:
+            job_queue.record_worker_heartbeat(process_id)
+            pipeline.pump()
+            if time.monotonic() >= next_sweep:
+                sweep_stuck_generations()
+                crud.prune_task_events(TASK_EVENTS_RETENTION_SECONDS)
+                next_sweep = time.monotonic() + GENERATION_SWEEP_INTERVAL_SECONDS
+        except Exception as e:
+            logger.error(f"Pipeline maintenance failed: {e}")
+        stop_event.wait(PIPELINE_PUMP_INTERVAL_SECONDS)
+    try:
+        job_queue.remove_worker_heartbeat(process_id)
+    except Exception as e:
+        logger.error(f"Could not remove the heartbeat of {process_id}: {e}")
+
+def run_worker(worker_id=None, once=False, stop_event=None, stages=None, urgent_only=False):
+    """
+    Claim and run jobs until stopped.
+
+    Args:
+        once: Exit as soon as the queue has nothing available.
+        stop_event: threading.Event that ends the loop after the current job.
+        stages: Pipeline stages whose jobs to run; defaults to all of them.
+        urgent_only: Only run jobs in the urgent lane (see job_queue.claim).
+
+    Returns:
+        Number of jobs processed.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    stop_event = stop_event or threading.Event()
+    kinds = [stage.kind for stage in (stages or pipeline.STAGES)]
+    processed = 0
+    logger.info(f"Worker {worker_id} started for job kinds: {', '.join(kinds)}")
+    while not stop_event.is_set():
+        for dead_job in job_queue.dead_letter_expired(kinds):
+            handle_dead_job(dead_job, f"{dead_job['kind']} lease expired on the final attempt")
+        job = job_queue.claim(worker_id, kinds=kinds, urgent_only=urgent_only)
+        if job is None:
+            if once:
+                break
+            stop_event.wait(WORKER_POLL_SECONDS)
+            continue
+        logger.info(f"Worker {worker_id} running job {job['id']} ({job['kind']}, task {job['task_id']}, attempt {job['attempts']})")
+        run_job(job, worker_id)
+        processed += 1
+        if once:
+            # Jobs just finished may have made tasks ready for the next stage.
+            pipeline.pump()
+    logger.info(f"Worker {worker_id} stopped after {processed} jobs")
+    return processed
+
+def run_pipeline(stop_event, process_id=None):
+    """Run every stage's worker pool and the maintenance loop in this process until `stop_event` is set."""
+    process_id = process_id or f"{socket.gethostname()}:{os.getpid()}"
+    init_db()
+    threads = [threading.Thread(target=_maintenance_loop, args=(stop_event, process_id), name="pipeline-maintenance", daemon=True)]
+    for stage in pipeline.STAGES:
+        for index in range(stage.workers):
+            threads.append(threading.Thread(
+                target=run_worker, args=(f"{process_id}:{stage.name}-{index}", False, stop_event, [stage]),
+                name=f"{stage.name}-{index}", daemon=True,
+            ))
+        # Kept free for the urgent lane, so urgent tasks never wait behind a full pool.
+        threads.append(threading.Thread(
+            target=run_worker, args=(f"{process_id}:{stage.name}-urgent", False, stop_event, [stage], True),
+            name=f"{stage.name}-urgent", daemon=True,
+        ))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def _worker_process(index):
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    run_pipeline(stop_event, f"{socket.gethostname()}:{os.getpid()}:{index}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run background job workers.")
+    parser.add_argument("--workers", type=int, default=WORKER_PROCESSES, help="number of worker processes")
+    parser.add_argument("--once", action="store_true", help="process available jobs in this process, then exit")
+    args = parser.parse_args()
+
+    if args.once:
+        init_db()
+        run_maintenance()
+        run_worker(once=True)
+        return
+
+    # Migrate once up front so the workers do not race to do it.
+    init_db()
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_worker_process, args=(index,), name=f"worker-{index}") for index in range(args.workers)]
+    for process in processes:
+        process.start()
+    try:
+        while any(process.is_alive() for process in processes):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info("Stopping workers after their current jobs...")
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+    for process in processes:
+        process.join()
+
+if __name__ == "__main__":
+    main()
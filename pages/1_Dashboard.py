@@ -9,8 +9,10 @@ from PIL import Image
 
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from app.database import crud
+from app.config import SCHEDULER_URGENT_PRIORITY, SCHEDULER_METRICS_WINDOW_SECONDS, PROGRESS_REFRESH_SECONDS
+from app.database import crud, init_db, job_queue
 from app.core import workflow_manager
+from app.core.progress import BatchProgress
 # TEMPORARILY DISABLE WARNING MONITOR
 # from app.warning_monitor import initialize_warning_monitor
 
@@ -19,6 +21,9 @@ from app.core import workflow_manager
 
 logger = logging.getLogger(__name__)
 
+# --- Initialize Database ---
+init_db()
+
 # --- Initialize State ---
 st.set_page_config(page_title="Task Dashboard", layout="wide")
 st.title(f"📊 Task Dashboard")
@@ -40,13 +45,17 @@ if 'retry_task_id' in st.session_state:
                 image_path = image_paths[0] if image_paths else None
                 
                 if image_path and os.path.exists(image_path):
-                    from app.core.ai_services import call_ai_service
-                    ai_response = call_ai_service(prompt, task_id=task_id, model=model, image_path=image_path)
+                    from app.core.ai_services import stream_ai_service
+                    # Show the spec sheet as it streams in; write_stream returns the full text.
+                    # A retry skips the cache, which would only return the answer being retried.
+                    ai_response = st.write_stream(stream_ai_service(prompt, task_id=task_id, model=model, image_path=image_path, bypass_cache=True))
                     
                     if ai_response:
-                        crud.add_initial_spec_sheet(task_id, ai_response)
-                        crud.update_task_status(task_id, 'PENDING_APPROVAL')
-                        st.success("Spec sheet generated successfully!")
+                        # The pipeline may have written one meanwhile; only a task still NEW takes this one
+                        if crud.add_initial_spec_sheet(task_id, ai_response, only_if_new=True):
+                            st.success("Spec sheet generated successfully!")
+                        else:
+                            st.info("This task already got a spec sheet from the pipeline; the retry result was discarded.")
                     else:
                         st.error("Failed to generate spec sheet.")
                 else:
@@ -58,7 +67,17 @@ if 'retry_task_id' in st.session_state:
     del st.session_state['retry_task_id']
     st.rerun()
 
+# --- Pagination ---
+PAGE_SIZE = 50
+# The task columns this page renders; prompts and redo notes are never shown here.
+DASHBOARD_COLUMNS = [
+    'id', 'product_code', 'status', 'uploaded_image_paths', 'spec_sheet_text',
+    'generated_image_path', 'created_at', 'product_name', 'product_tags',
+]
+
 # --- Initialize session state ---
+if 'dashboard_cursors' not in st.session_state:
+    st.session_state.dashboard_cursors = [None]
 if 'selected_tasks' not in st.session_state:
     st.session_state.selected_tasks = set()
 if 'tag_filter' not in st.session_state:
@@ -83,8 +102,7 @@ def toggle_all_tasks(all_ids):
     else:
         st.session_state.selected_tasks = set()
 
-# --- Fetch all tasks and unique tags ---
-all_tasks = crud.get_all_tasks()
+# --- Fetch unique tags ---
 unique_tags = crud.get_all_unique_tags()
 
 # --- Filter Bar ---
@@ -104,26 +122,55 @@ with st.container():
             options=unique_tags,
             key="tag_filter"
         )
+    search_query = st.text_input(
+        "Search tasks",
+        key="task_search",
+        placeholder="SKU, product name or spec sheet text",
+    ).strip()
 
-# --- Apply Filters ---
-filtered_tasks = all_tasks
-if active_status_filter:
-    filtered_tasks = [task for task in filtered_tasks if task.get('status') == active_status_filter]
+# --- Search Results ---
+if search_query:
+    search_results = crud.search_tasks(search_query, limit=10)
+    with st.expander(f"🔎 Best matches for \"{search_query}\" ({len(search_results)})", expanded=True):
+        if not search_results:
+            st.caption("No tasks match this search.")
+        for result in search_results:
+            name = f" — {result['product_name']}" if result.get('product_name') else ""
+            st.markdown(
+                f"**{result['product_code'] or 'N/A'}**{name} · Task {result['id']} · "
+                f"{result['status'].replace('_', ' ').title()}"
+            )
+            if result.get('snippet'):
+                st.caption(result['snippet'])
 
-if st.session_state.tag_filter:
-    selected_tags = st.session_state.tag_filter
-    tasks_to_display = []
-    for task in filtered_tasks:
-        tags_str = task.get('product_tags')
-        if tags_str:
-            try:
-                tags_dict = json.loads(tags_str)
-                task_tags = {f"{k.title()}: {v}" for k, v in tags_dict.items()}
-                if set(selected_tags).issubset(task_tags):
-                    tasks_to_display.append(task)
-            except (json.JSONDecodeError, TypeError):
-                continue
-    filtered_tasks = tasks_to_display
+# --- Apply Filters (in SQL, one page at a time) ---
+filters = {
+    'status': active_status_filter,
+    'tags': st.session_state.tag_filter,
+    'search': search_query,
+}
+
+# Restart from the first page whenever the filters change.
+filter_signature = (active_status_filter, tuple(st.session_state.tag_filter), search_query)
+if st.session_state.get('dashboard_filter_signature') != filter_signature:
+    st.session_state.dashboard_filter_signature = filter_signature
+    st.session_state.dashboard_cursors = [None]
+
+page_cursor = st.session_state.dashboard_cursors[-1]
+filtered_tasks, next_cursor = crud.query_tasks(
+    **filters,
+    after_cursor=page_cursor,
+    limit=PAGE_SIZE,
+    columns=DASHBOARD_COLUMNS,
+)
+status_counts = crud.get_status_counts()
+total_count = sum(status_counts.values())
+if st.session_state.tag_filter or search_query:
+    filtered_count = crud.count_tasks(**filters)
+elif active_status_filter:
+    filtered_count = status_counts.get(active_status_filter, 0)
+else:
+    filtered_count = total_count
 
 all_task_ids = [task['id'] for task in filtered_tasks]
 
@@ -145,63 +192,48 @@ with col2:
             st.warning("No tasks selected.")
 
 with col3:
+    active_workers = job_queue.count_active_workers()
     if st.button("📝 Generate Spec Sheets", type="secondary"):
         if st.session_state.selected_tasks:
-            # Filter for tasks that don't have spec sheets yet
-            tasks_to_process = []
-            for task_id in st.session_state.selected_tasks:
-                task = crud.get_task_by_id(task_id)
-                if task and not task.get('spec_sheet_text'):
-                    tasks_to_process.append(task_id)
-            
-            if tasks_to_process:
-                with st.spinner("Generating spec sheets... This may take a few minutes."):
-                    success_count = 0
-                    error_count = 0
-                    
-                    for task_id in tasks_to_process:
-                        try:
-                            task = crud.get_task_by_id(task_id)
-                            if task and task.get('uploaded_image_paths'):
-                                # Use default prompt for bulk generation
-                                prompt = "Describe this garment product in detail for e-commerce."
-                                model = "gpt-4o"  # Use vision-capable model
-                                
-                                # Get image path
-                                image_paths = task['uploaded_image_paths'].split(',')
-                                image_path = image_paths[0] if image_paths else None
-                                
-                                if image_path and os.path.exists(image_path):
-                                    from app.core.ai_services import call_ai_service
-                                    ai_response = call_ai_service(prompt, task_id=task_id, model=model, image_path=image_path)
-                                    
-                                    if ai_response:
-                                        crud.add_initial_spec_sheet(task_id, ai_response)
-                                        crud.update_task_status(task_id, 'PENDING_APPROVAL')
-                                        success_count += 1
-                                    else:
-                                        error_count += 1
-                                else:
-                                    error_count += 1
-                            else:
-                                error_count += 1
-                        except Exception as e:
-                            logger.error(f"Error generating spec sheet for task {task_id}: {e}")
-                            error_count += 1
-                    
-                    st.success(f"Spec sheet generation complete. Success: {success_count}, Errors: {error_count}")
+            # Only tasks with images and no spec sheet; ones that ended in ERROR go back to NEW
+            if active_workers:
+                queued = workflow_manager.queue_spec_sheets(list(st.session_state.selected_tasks))
+                if queued:
+                    # A toast survives the rerun below
+                    st.toast(f"Queued {queued} spec sheets for the running workers. They appear as the workers finish.")
                     st.session_state.selected_tasks.clear()
                     st.rerun()
+                else:
+                    st.warning("No eligible tasks selected (tasks must have images but no spec sheets, and none queued already).")
             else:
-                st.warning("No eligible tasks selected (tasks must have images but no spec sheets).")
+                # No worker is running, so nothing would pick up queued jobs: generate here instead
+                tasks_to_process = workflow_manager.prepare_spec_sheet_tasks(list(st.session_state.selected_tasks))
+                if tasks_to_process:
+                    progress = st.progress(0.0, text=f"Generating spec sheets for {len(tasks_to_process)} tasks...")
+
+                    def report_progress(done, total, task_id, error):
+                        progress.progress(done / total, text=f"Generated {done} of {total} spec sheets")
+
+                    result = workflow_manager.bulk_generate_spec_sheets(tasks_to_process, on_progress=report_progress)
+                    st.toast(
+                        f"Spec sheet generation complete. Success: {len(result['succeeded'])}, "
+                        f"Already done elsewhere: {len(result['skipped'])}, Errors: {len(result['errors'])}"
+                    )
+                    st.session_state.selected_tasks.clear()
+                    st.rerun()
+                else:
+                    st.warning("No eligible tasks selected (tasks must have images but no spec sheets).")
         else:
             st.warning("No tasks selected.")
+    if active_workers:
+        st.caption(f"{active_workers} worker process(es) running; spec sheets are queued for them.")
+    else:
+        st.caption("No worker running (`python -m app.worker`); spec sheets are generated in this page.")
 
 with col4:
     if st.button("🚀 Generate Images", type="primary"):
         if st.session_state.selected_tasks:
-            with st.spinner("Starting bulk generation... This may take a long time. Please wait."):
-                result_message = workflow_manager.bulk_generate_images(list(st.session_state.selected_tasks))
+            result_message = workflow_manager.bulk_generate_images(list(st.session_state.selected_tasks))
             st.success(result_message)
             st.session_state.selected_tasks.clear()
             st.rerun()
@@ -216,12 +248,10 @@ with col5:
     if selected_status != "Select Status" and st.button("Apply Status Change"):
         if st.session_state.selected_tasks:
             updated_count = 0
-            for task_id in st.session_state.selected_tasks:
-                try:
-                    crud.update_task_status(task_id, selected_status)
-                    updated_count += 1
-                except Exception as e:
-                    logger.error(f"Error updating status for task {task_id}: {e}")
+            try:
+                updated_count = crud.update_status_many(list(st.session_state.selected_tasks), selected_status)
+            except Exception as e:
+                logger.error(f"Error updating status for selected tasks: {e}")
             
             st.success(f"Updated status to {selected_status} for {updated_count} tasks.")
             st.session_state.selected_tasks.clear()
@@ -229,10 +259,141 @@ with col5:
         else:
             st.warning("No tasks selected.")
 
+# --- Scheduling ---
+PRIORITY_OPTIONS = {"Normal": 0, "High": 10, "Urgent": SCHEDULER_URGENT_PRIORITY}
+prio_col1, prio_col2, _ = st.columns([2, 1, 2])
+with prio_col1:
+    selected_priority = st.selectbox(
+        "Set Priority:", list(PRIORITY_OPTIONS), key="bulk_priority_change",
+        help="Urgent tasks skip ahead of every batch. Other tasks are shared fairly between batches.",
+    )
+with prio_col2:
+    st.write("")
+    if st.button("Apply Priority"):
+        if st.session_state.selected_tasks:
+            updated_count = workflow_manager.set_task_priority(
+                list(st.session_state.selected_tasks), PRIORITY_OPTIONS[selected_priority]
+            )
+            st.success(f"Set priority to {selected_priority} for {updated_count} tasks.")
+            st.session_state.selected_tasks.clear()
+            st.rerun()
+        else:
+            st.warning("No tasks selected.")
+
+with st.expander("⏱️ Scheduler Metrics"):
+    metrics = job_queue.get_scheduler_metrics()
+    st.caption(f"Jobs claimed and finished in the last {SCHEDULER_METRICS_WINDOW_SECONDS // 60} minutes.")
+    if not metrics['latency']:
+        st.caption("No jobs have been claimed in this window.")
+    for kind, latency in metrics['latency'].items():
+        st.markdown(f"**{kind.replace('_', ' ').title()}**")
+        metric_cols = st.columns(4)
+        metric_cols[0].metric("Jobs started", latency['claimed'])
+        metric_cols[1].metric("Median wait", f"{latency['p50_wait']:.0f}s")
+        metric_cols[2].metric("95th pct wait", f"{latency['p95_wait']:.0f}s")
+        urgent_wait = latency['urgent_p95_wait']
+        metric_cols[3].metric("Urgent 95th pct wait", f"{urgent_wait:.0f}s" if urgent_wait is not None else "—")
+    if metrics['batches']:
+        st.markdown("**Batches**")
+        st.dataframe(
+            [
+                {
+                    "Batch": batch['batch_id'] or "(no batch)",
+                    "Weight": batch['weight'],
+                    "Queued": batch['queued'],
+                    "Running": batch['running'],
+                    "Done": batch['done'],
+                    "Failed": batch['dead'],
+                    "Done / hour": round(batch['throughput_per_hour'], 1),
+                }
+                for batch in metrics['batches']
+            ],
+            use_container_width=True,
+        )
+        weight_col1, weight_col2, weight_col3 = st.columns([2, 1, 1])
+        with weight_col1:
+            weight_batch = st.selectbox(
+                "Batch", [batch['batch_id'] or "" for batch in metrics['batches']],
+                format_func=lambda batch_id: batch_id or "(no batch)", key="weight_batch",
+            )
+        with weight_col2:
+            weight = st.number_input("Share weight", min_value=0.1, max_value=100.0, value=1.0, step=0.5, key="weight_value")
+        with weight_col3:
+            st.write("")
+            if st.button("Set Weight"):
+                job_queue.set_batch_weight(weight_batch, weight)
+                st.rerun()
+
+# --- Live Progress ---
+# Follows task_events, so workers' and other users' changes show up without reloading the tasks.
+if 'batch_progress' not in st.session_state:
+    st.session_state.batch_progress = BatchProgress()
+st.session_state.batch_progress.poll()
+# The task list below reflects every event up to this one.
+st.session_state.list_event_id = st.session_state.batch_progress.last_event_id
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m {seconds}s" if minutes else f"{seconds}s"
+
+def render_live_progress():
+    tracker = st.session_state.batch_progress
+    tracker.poll()
+    st.subheader("Live Progress")
+    batches = [batch for batch in tracker.summary() if batch['pending'] or batch['rate_per_minute']]
+    if not batches:
+        st.caption("No batches are being processed.")
+    for batch in batches:
+        label = batch['batch_id'] or "(no batch)"
+        eta = format_duration(batch['eta_seconds']) if batch['eta_seconds'] is not None else "—"
+        if not batch['pending']:
+            eta = "done"
+        st.progress(
+            batch['fraction_done'],
+            text=(
+                f"**{label}**: {batch['done']} of {batch['total']} processed · "
+                f"{batch['counts'].get('GENERATING', 0)} generating · "
+                f"{batch['rate_per_minute']:.1f}/min · ETA {eta}"
+            ),
+        )
+    if tracker.recent_events:
+        with st.expander(f"⚠️ Recent problems ({len(tracker.recent_events)})"):
+            for event in reversed(tracker.recent_events):
+                message = event['message'] or f"Task moved to {event['new_status']}"
+                st.caption(f"Task {event['task_id']}: {message}")
+    changed = tracker.changed_tasks(all_task_ids, st.session_state.list_event_id)
+    if changed:
+        st.info(f"{len(changed)} tasks on this page have changed since it was loaded.")
+        if st.button("Refresh Task List", key="refresh_task_list"):
+            st.rerun()
+
+# st.fragment reruns only this section on a timer (Streamlit 1.37+; 1.33-1.36 name it experimental_fragment).
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+if _fragment:
+    _fragment(run_every=PROGRESS_REFRESH_SECONDS)(render_live_progress)()
+else:
+    render_live_progress()
+    if st.button("🔄 Refresh Progress"):
+        st.rerun()
+
 st.divider()
 
 # --- Task List by Status ---
-st.subheader(f"Displaying Tasks ({len(filtered_tasks)} of {len(all_tasks)} total)")
+page_number = len(st.session_state.dashboard_cursors)
+st.subheader(f"Displaying Tasks ({len(filtered_tasks)} on page {page_number}, {filtered_count} matching of {total_count} total)")
+
+nav_col1, nav_col2, _ = st.columns([1, 1, 6])
+with nav_col1:
+    if st.button("⬅️ Previous Page", disabled=page_number == 1):
+        st.session_state.dashboard_cursors.pop()
+        st.rerun()
+with nav_col2:
+    if st.button("Next Page ➡️", disabled=next_cursor is None):
+        st.session_state.dashboard_cursors.append(next_cursor)
+        st.rerun()
 
 if not filtered_tasks:
     st.info("No tasks match the current filters or no tasks exist.")
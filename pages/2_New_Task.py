@@ -8,15 +8,19 @@ import json
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from app.database import crud
+from app.database import crud, init_db
+from app import image_store
 from app.core import ai_services
-from app.core.ai_services import call_ai_service
+from app.core.ai_services import stream_ai_service
 from app.config import UPLOADS_DIR, SPEC_SHEET_PROMPT_DIR, NAME_TAG_PROMPT_DIR
 from app.constants import MODEL_CAPABILITIES, DEFAULT_MODELS
 from app.settings_manager import load_settings
 from app.constants import MODEL_CAPABILITIES, DEFAULT_MODELS
 
 
+# --- Initialize Database ---
+init_db()
+
 # --- Helper Functions ---
 def get_prompt_files(prompt_dir):
     """Returns a list of .txt files in the specified prompt directory."""
@@ -122,6 +126,9 @@ def new_task_page():
     # Determine if test_mode should be enabled
     test_mode = model == "[TEST MODE]"
 
+    # Identical requests are answered from the response cache unless this is ticked
+    bypass_cache = st.checkbox("Regenerate (ignore cached response)", value=False, disabled=test_mode)
+
     button_text = "Retry Generate Spec Sheet" if is_retry else "Generate Spec Sheet"
     if st.button(button_text):
         # Validation
@@ -137,17 +144,16 @@ def new_task_page():
             if is_retry:
                 temp_image_path = image_path
             else:
-                # Save the uploaded file temporarily
-                temp_image_path = f"temp_{uploaded_file.name}"
-                with open(temp_image_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
+                # Store the upload once, under its content hash
+                stored_image = image_store.save_upload(uploaded_file)
+                temp_image_path = stored_image.path
 
             # Call the AI service with test_mode if selected
             ai_response = None
             try:
-                ai_response = call_ai_service(selected_prompt, model=model if not test_mode else "gpt-4o", image_path=temp_image_path, test_mode=test_mode)
-                st.success("Spec Sheet Generated:")
-                st.text(ai_response)
+                # Render the spec sheet as it streams in; write_stream returns the full text
+                ai_response = st.write_stream(stream_ai_service(selected_prompt, model=model if not test_mode else "gpt-4o", image_path=temp_image_path, test_mode=test_mode, bypass_cache=bypass_cache))
+                st.success("Spec Sheet Generated.")
             except RuntimeError as e:
                 st.error(f"Error: {e}")
                 ai_response = None
@@ -155,21 +161,27 @@ def new_task_page():
             if is_retry:
                 # Update existing task with the new spec sheet
                 if ai_response is not None:
-                    crud.add_initial_spec_sheet(retry_task_id, ai_response)
-                    st.success(f"Spec Sheet updated for Task ID: {retry_task_id}. It will appear in the Dashboard.")
+                    if crud.add_initial_spec_sheet(retry_task_id, ai_response, only_if_new=True):
+                        st.success(f"Spec Sheet updated for Task ID: {retry_task_id}. It will appear in the Dashboard.")
+                    else:
+                        st.info(f"Task {retry_task_id} already got a spec sheet from the pipeline; the retry result was discarded.")
                     # Clear the retry state
                     del st.session_state['retry_task_id']
                     st.rerun()
                 else:
                     st.warning("Spec sheet generation failed. Please try again.")
             else:
-                # Create new task (existing logic)
+                # Create new task with its spec sheet in one transaction, so the pipeline never
+                # sees it as NEW and queues a second spec sheet for it
                 batch_id = None  # You can update this if you have batch logic
-                task_id = crud.create_task(sku, [temp_image_path], batch_id)
+                with crud.unit_of_work():
+                    task_id = crud.create_task(sku, [temp_image_path], batch_id)
+                    if task_id:
+                        crud.set_task_images(task_id, [stored_image])
+                        if ai_response is not None:
+                            crud.add_initial_spec_sheet(task_id, ai_response)
 
-                # Save the generated spec sheet to the task
                 if task_id and ai_response is not None:
-                    crud.add_initial_spec_sheet(task_id, ai_response)
                     st.success(f"Spec Sheet saved to task ID: {task_id}. It will appear in the Dashboard.")
                 elif task_id and ai_response is None:
                     st.warning(f"Task created with ID: {task_id}, but spec sheet generation failed. You can try again from the Dashboard.")
@@ -6,8 +6,11 @@ import sys
 from PIL import Image
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from app.database import crud
-from app.core import ai_services
+from app.database import crud, init_db
+from app.core import workflow_manager
+
+# --- Initialize Database ---
+init_db()
 
 # --- Initialize State ---
 st.set_page_config(page_title="Review & Generate", layout="wide")
@@ -38,9 +41,19 @@ if 'current_task_id' in st.session_state and st.session_state['current_task_id']
                 st.subheader("Generated Spec Sheet (Editable)")
                 edited_spec_sheet = st.text_area("Edit and approve:", value=task.get('spec_sheet_text', ''), height=300, key=f"spec_{task_id}")
                 with st.expander("View Edit History"):
-                    for version in reversed(crud.get_spec_sheet_versions(task_id)):
-                        st.markdown(f"**Version {version['version_number']} (by {version['author']})**")
-                        st.text(version['spec_text'])
+                    # Only the selected version is decoded from storage.
+                    versions = crud.list_spec_versions(task_id)
+                    if versions:
+                        version_labels = {
+                            f"Version {version['version_number']} (by {version['author']})": version['version_number']
+                            for version in versions
+                        }
+                        selected_label = st.selectbox("Select a version", list(version_labels), key=f"history_{task_id}")
+                        version = crud.get_spec_version(task_id, version_labels[selected_label])
+                        if version:
+                            st.text(version['spec_text'])
+                    else:
+                        st.caption("No saved versions yet.")
                 
                 # --- NEW: Action Buttons with Save ---
                 b_col1, b_col2, b_col3, _ = st.columns([1, 1, 1, 4])
@@ -80,27 +93,17 @@ if 'current_task_id' in st.session_state and st.session_state['current_task_id']
                         st.image(Image.open(path), caption=os.path.basename(path))
             with col2:
                 st.subheader("Final Prompt for Generation")
-                base_model_prompt = "professional photograph of a female model wearing the garment, full body shot, studio lighting, hyperrealistic, 8k"
-                final_prompt = f"{base_model_prompt}, {task.get('spec_sheet_text', '')}"
+                final_prompt = workflow_manager.build_image_prompt(task.get('spec_sheet_text', ''))
                 st.text_area("This prompt will be sent to the image generation AI:", value=final_prompt, height=400, disabled=True)
             st.divider()
             if st.button(f"🚀 Generate On-Model Photo", type="primary"):
-                crud.update_task_status(task_id, 'GENERATING')
+                workflow_manager.queue_image_generation(task_id)
                 st.rerun()
 
         elif task['status'] == 'GENERATING':
-            st.info(f"⚙️ Calling Stable Diffusion... This can take up to a minute. Please do not navigate away from this page.")
-            with st.spinner("Generating image..."):
-                base_model_prompt = "professional photograph of a female model wearing the garment, full body shot, studio lighting, hyperrealistic, 8k"
-                final_prompt = f"{base_model_prompt}, {task.get('spec_sheet_text', '')}"
-                generated_path = ai_services.generate_image_from_prompt(final_prompt, task['product_code'])
-                if "Error" in generated_path:
-                    st.error(generated_path)
-                    crud.update_task_status(task_id, 'ERROR')
-                else:
-                    crud.add_generated_image_to_task(task_id, final_prompt, generated_path)
-                    st.success("Image generated successfully!")
-            st.rerun()
+            st.info("⚙️ This task is queued for image generation. Background workers (`python -m app.worker`) will process it; you can leave this page.")
+            if st.button("🔄 Refresh"):
+                st.rerun()
 
         elif task['status'] in ['PENDING_IMAGE_REVIEW', 'PENDING_REDO']:
             st.info("Review the generated image. You can approve it or request a redo with additional instructions.")
@@ -118,8 +121,7 @@ if 'current_task_id' in st.session_state and st.session_state['current_task_id']
                 if not redo_prompt:
                     st.warning("Please provide instructions for the redo.")
                 else:
-                    new_prompt = f"{task.get('final_prompt', '')}, {redo_prompt}"
-                    crud.update_task_status(task_id, 'GENERATING')
+                    workflow_manager.queue_image_generation(task_id, redo_prompt)
                     st.rerun()
 else:
     st.error("No task selected. Please go back to the dashboard and select a task to review.")
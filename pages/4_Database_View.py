@@ -2,7 +2,6 @@
 
 import streamlit as st
 import pandas as pd
-import sqlite3
 import os
 import sys
 import logging
@@ -11,9 +10,12 @@ from PIL import Image
 logger = logging.getLogger(__name__)
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from app.database.models import DATABASE_NAME, create_tables
-from app.database import crud
-from app.config import UPLOADS_DIR
+from app.database.models import create_tables
+from app.database import crud, init_db
+from app import image_store
+
+# --- Initialize Database ---
+init_db()
 
 # --- Initialize State ---
 st.set_page_config(page_title="Database View", layout="wide")
@@ -45,13 +47,10 @@ with st.form("bulk_task_creation"):
         if not base_sku.strip():
             st.error("Please provide a base SKU prefix.")
         else:
-            # Create tasks
-            created_tasks = []
-            for i in range(task_count):
-                sku = "04d"
-                task_id = crud.create_task(sku, [], None)  # Empty image list initially
-                if task_id:
-                    created_tasks.append(task_id)
+            # Create all tasks in one transaction, with an empty image list initially
+            created_tasks = crud.create_tasks_bulk(
+                (f"{base_sku.strip()}{i + 1:03d}", [], None) for i in range(task_count)
+            )
             
             if created_tasks:
                 st.success(f"✅ Created {len(created_tasks)} tasks: {', '.join(map(str, created_tasks))}")
@@ -69,72 +68,139 @@ with st.form("bulk_task_creation"):
                         
                         for j in range(num_images):
                             if image_index < len(uploaded_files):
-                                # Save the uploaded file
-                                uploaded_file = uploaded_files[image_index]
-                                image_path = os.path.join(UPLOADS_DIR, f"task_{task_id}_{j+1}_{uploaded_file.name}")
-                                
-                                # Ensure upload directory exists
-                                os.makedirs(UPLOADS_DIR, exist_ok=True)
-                                
-                                with open(image_path, "wb") as f:
-                                    f.write(uploaded_file.getbuffer())
-                                
-                                task_images.append(image_path)
+                                # Store the upload once, under its content hash
+                                task_images.append(image_store.save_upload(uploaded_files[image_index]))
                                 image_index += 1
                         
                         if task_images:
-                            # Update task with images
-                            crud.update_task_images(task_id, task_images)
+                            # Link the stored images to the task
+                            crud.set_task_images(task_id, task_images)
                 
-                st.info("💡 You can now generate spec sheets for these tasks from the Dashboard by selecting 'Retry Spec Sheet' on NEW tasks.")
+                st.info("💡 The pipeline workers (`python -m app.worker`) generate spec sheets for these tasks on their own. Without a running worker, select them on the Dashboard and use 'Generate Spec Sheets'.")
                 st.rerun()
             else:
                 st.error("Failed to create tasks.")
 
 st.divider()
 
-def fetch_table_as_dataframe(table_name: str):
+# --- Paged Table Browser ---
+PAGE_SIZE_OPTIONS = [50, 100, 250, 500]
+
+def build_page_dataframe(columns, rows):
+    """Build a DataFrame for one page using compact dtypes."""
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_integer_dtype(series):
+            df[column] = pd.to_numeric(series, downcast="integer")
+        elif pd.api.types.is_float_dtype(series):
+            df[column] = pd.to_numeric(series, downcast="float")
+        elif series.dtype == object and len(series) and series.nunique(dropna=True) <= len(series) // 2:
+            # Repetitive text such as statuses and authors is stored once per distinct value.
+            df[column] = series.astype("category")
+    return df
+
+def render_table_browser(table_name: str):
+    """Render filters, paging controls and the current page of one table."""
+    try:
+        column_info = crud.get_table_columns(table_name)
+    except Exception as e:
+        st.error(f"An error occurred while reading table '{table_name}': {e}")
+        return
+    all_columns = [name for name, _ in column_info]
+    # Binary payloads are unreadable in a grid, so they start deselected.
+    default_columns = [name for name, declared_type in column_info if declared_type.upper() != "BLOB"]
+
+    row_count, count_source = crud.estimate_row_count(table_name)
+    st.caption(f"≈ {row_count:,} rows (estimated from {count_source})")
+
+    with st.expander("Columns, filter and sort", expanded=False):
+        selected_columns = st.multiselect("Columns", all_columns, default=default_columns, key=f"{table_name}_columns")
+        f_col1, f_col2, f_col3 = st.columns(3)
+        filter_column = f_col1.selectbox("Filter column", ["(none)"] + all_columns, key=f"{table_name}_filter_column")
+        filter_operator = f_col2.selectbox("Operator", crud.BROWSER_FILTER_OPERATORS, key=f"{table_name}_filter_operator")
+        filter_value = f_col3.text_input("Value", key=f"{table_name}_filter_value")
+        s_col1, s_col2, s_col3 = st.columns(3)
+        order_by = s_col1.selectbox("Sort by", ["(row order)"] + all_columns, key=f"{table_name}_order_by")
+        descending = s_col2.checkbox("Descending", key=f"{table_name}_descending")
+        page_size = s_col3.selectbox("Rows per page", PAGE_SIZE_OPTIONS, key=f"{table_name}_page_size")
+
+    filters = []
+    if filter_column != "(none)" and (filter_value or filter_operator in ("IS NULL", "IS NOT NULL")):
+        filters.append((filter_column, filter_operator, filter_value))
+    order_column = None if order_by == "(row order)" else order_by
+
+    # Restart from the first page whenever the query changes.
+    cursors_key = f"{table_name}_cursors"
+    signature_key = f"{table_name}_signature"
+    signature = (tuple(selected_columns), tuple(filters), order_column, descending, page_size)
+    if st.session_state.get(signature_key) != signature:
+        st.session_state[signature_key] = signature
+        st.session_state[cursors_key] = [None]
+    cursors = st.session_state[cursors_key]
+
+    if not selected_columns:
+        st.info("Select at least one column to display.")
+        return
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-        return df
+        columns, rows, next_cursor = crud.fetch_table_page(
+            table_name,
+            columns=selected_columns,
+            filters=filters,
+            order_by=order_column,
+            descending=descending,
+            after_cursor=cursors[-1],
+            limit=page_size,
+        )
     except Exception as e:
         st.error(f"An error occurred while fetching data from table '{table_name}': {e}")
-        return pd.DataFrame()
-    finally:
-        if 'conn' in locals() and conn:
-            conn.close()
+        return
+
+    if rows:
+        st.dataframe(build_page_dataframe(columns, rows), use_container_width=True)
+    elif len(cursors) == 1:
+        st.info(f"The '{table_name}' table has no matching rows.")
+
+    nav_col1, nav_col2, nav_col3 = st.columns([1, 1, 4])
+    if nav_col1.button("⬅️ Previous", key=f"{table_name}_prev", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun()
+    if nav_col2.button("Next ➡️", key=f"{table_name}_next", disabled=next_cursor is None):
+        cursors.append(next_cursor)
+        st.rerun()
+    nav_col3.caption(f"Page {len(cursors)}")
 
 # --- Display the 'tasks' table ---
 st.subheader("Tasks Table")
 st.markdown("This table contains the main record for each generation task.")
-tasks_df = fetch_table_as_dataframe("tasks")
-if not tasks_df.empty:
-    st.dataframe(tasks_df, use_container_width=True)
-else:
-    st.info("The 'tasks' table is currently empty.")
+render_table_browser("tasks")
 
 st.divider()
 
 # --- Display the 'spec_sheet_versions' table ---
 st.subheader("Spec Sheet Versions Table")
 st.markdown("This table contains the complete edit history for every spec sheet.")
-versions_df = fetch_table_as_dataframe("spec_sheet_versions")
-if not versions_df.empty:
-    st.dataframe(versions_df, use_container_width=True)
-else:
-    st.info("The 'spec_sheet_versions' table is currently empty.")
+render_table_browser("spec_sheet_versions")
 
 st.divider()
 
 # --- Display the 'chat_history' table ---
 st.subheader("Chat History Table")
 st.markdown("This table contains the chat history for each task.")
-chat_history_df = fetch_table_as_dataframe("chat_history")
-if not chat_history_df.empty:
-    st.dataframe(chat_history_df, use_container_width=True)
-else:
-    st.info("The 'chat_history' table is currently empty.")
+render_table_browser("chat_history")
+
+st.divider()
+
+# --- Refresh Row Count Statistics ---
+st.subheader("Table Statistics")
+st.markdown("Row counts above are estimates. Refresh the statistics after large imports or deletions.")
+if st.button("Refresh Statistics"):
+    try:
+        crud.analyze_database()
+        st.success("Table statistics refreshed.")
+        st.rerun()
+    except Exception as e:
+        st.error(f"An error occurred while refreshing statistics: {e}")
 
 st.divider()
 
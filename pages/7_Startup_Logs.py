@@ -104,8 +104,9 @@ def run_diagnostic_check():
 
         # Check database connection
         try:
-            from app.database import crud
-            tasks = crud.get_all_tasks()
+            from app.database import crud, init_db
+            init_db()
+            crud.count_tasks()
             results['database_connection'] = True
         except Exception as e:
             results['errors'].append(f"Database connection failed: {str(e)}")
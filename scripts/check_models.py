@@ -7,21 +7,10 @@ import os
 import sys
 from dotenv import load_dotenv
 
-# Add the app directory to the path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+# Add the project root to the path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-# Monkey patch httpx to handle the proxies argument issue
-import httpx
-original_init = httpx.Client.__init__
-
-def patched_init(self, *args, **kwargs):
-    # Remove proxies from kwargs if it exists
-    kwargs.pop('proxies', None)
-    return original_init(self, *args, **kwargs)
-
-httpx.Client.__init__ = patched_init
-
-from openai import OpenAI
+from app.core.openai_client import get_openai_client
 from app.constants import OPENAI_MODELS, DEFAULT_MODELS
 from app.settings_manager import load_settings, save_settings
 
@@ -39,7 +28,7 @@ def check_model_availability():
         return False
 
     try:
-        client = OpenAI(api_key=api_key)
+        client = get_openai_client()
         available_models = client.models.list()
         available_model_ids = {model.id for model in available_models.data}
 